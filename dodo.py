@@ -7,7 +7,7 @@ sys.path.insert(1, './src/')
 
 import config
 from pathlib import Path
-from doit.tools import run_once
+from doit.tools import config_changed, run_once
 import platform
 
 
@@ -60,9 +60,12 @@ def copy_notebook_to_folder(notebook_stem, origin_folder, destination_folder):
 
 def task_pull_trace():
     """ """
-    file_dep = ["./src/load_trace.py","./data/manual/cusips.csv"]
+    modules = ["load_trace","trace_checkpoint","trace_clean","trace_join","trace_plan","trace_polars",
+               "trace_profile","trace_query","trace_spill","trace_store","wrds_cache","wrds_local"]
+    file_dep = [f"./src/{module}.py" for module in modules] + ["./data/manual/cusips.csv"]
     file_output = ["fisd.csv","Prices.csv.gzip","Volumes.csv.gzip","Illiq.csv.gzip"]
     targets = [DATA_DIR / "pulled" / file for file in file_output]
+    targets += [DATA_DIR / "pulled" / "trace_store" / name for name in ["Prices","Volumes","Illiq"]]
 
     return {
         "actions": [
@@ -111,8 +114,10 @@ def task_calc_spread_bias():
     '''
     Calculate spread and bias
     '''
-    file_input = ['Illiq.csv.gzip', 'rating.csv']
-    file_dep = ["./src/calc_spread_bias.py"] + [DATA_DIR / "pulled" / file for file in file_input]
+    file_input = ['rating.csv']
+    file_dep = ["./src/calc_spread_bias.py", "./src/trace_store.py"] + [DATA_DIR / "pulled" / file for file in file_input]
+    # the Illiq dataset of the trace store, one Parquet file per year
+    file_dep += sorted((DATA_DIR / "pulled" / "trace_store" / "Illiq").glob("*/*.parquet"))
     
     file_output = ["spread_bias.csv"]
     targets = [DATA_DIR / "pulled" / file for file in file_output]
@@ -126,6 +131,8 @@ def task_calc_spread_bias():
         "targets": targets,
         "task_dep": task_dep,
         "file_dep": file_dep,
+        "uptodate": [config_changed({"WINSORIZE_MODE": config.WINSORIZE_MODE,
+                                     "TRADING_CALENDAR": config.TRADING_CALENDAR})],
         "clean": True,
     }
 
@@ -149,6 +156,8 @@ def task_calc_daily_return_cs():
         "targets": targets,
         # "task_dep": task_dep,
         "file_dep": file_dep,
+        "uptodate": [config_changed({"WINSORIZE_MODE": config.WINSORIZE_MODE,
+                                     "TRADING_CALENDAR": config.TRADING_CALENDAR})],
         "clean": True,
     }
 
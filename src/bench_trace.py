@@ -0,0 +1,676 @@
+'''
+Overview
+-------------
+Benchmarks for the TRACE cleaning code on synthetic data.
+Every benchmark reports wall time and peak memory (tracemalloc, which
+sees numpy and pandas allocations) and checks that the compared versions
+return the same rows.
+
+    python src/bench_trace.py anti-join --rows 3000000
+    python src/bench_trace.py dtypes --rows 3000000
+    python src/bench_trace.py stream --rows 3000000 --batch-rows 100000
+    python src/bench_trace.py stages --trades 10000000
+    python src/bench_trace.py backend --trades 5000000
+    python src/bench_trace.py trade-gaps --rows 10000000
+    python src/bench_trace.py spill --trades 2000000 --memory-budget-mb 100
+    python src/bench_trace.py pipeline --trades 2000000 --fetch-rate 100000
+    python src/bench_trace.py spread-bias --rows 10000000 --partition-rows 1000000
+    python src/bench_trace.py winsorize --values 100000000
+    python src/bench_trace.py cross-section --values 10000000 --dates 5000
+'''
+
+import argparse
+import gc
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import polars as pl
+from pandas.testing import assert_frame_equal
+from pandas.tseries.holiday import USFederalHolidayCalendar
+from scipy.stats.mstats import winsorize as scipy_winsorize
+
+import calc_spread_bias
+import load_trace
+import trace_clean
+import trace_profile
+import trace_spill
+import trace_store
+import trace_synth
+import trade_gaps
+import winsorize
+
+
+def measure(func, *args, **kwargs):
+    '''
+    This function runs func once and returns its result, the wall time in
+    seconds and the peak traced memory in MB.
+    '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / 2**20
+
+
+def report(name, rows, elapsed, peak_mb):
+    print(f'{name:<28} {elapsed:8.2f} s {rows / elapsed / 1e6:8.2f} M rows/s {peak_mb:10.1f} MB peak')
+
+
+#* ************************************** */
+#* Post 2012 cancel/correction anti-join  */
+#* ************************************** */
+def synthetic_post_2012(rows, seed=0):
+    '''
+    This function builds a post 2012 trace frame with about 5% X/C
+    records and 5% Y records pointing at earlier trade reports.
+    '''
+    rng = np.random.default_rng(seed)
+    n = int(rows / 1.1)
+    post = pd.DataFrame({
+        'cusip_id':        pd.Series(rng.integers(0, 500, n)).map('{:06d}AB1'.format),
+        'bond_sym_id':     'SYM',
+        'trd_exctn_dt':    pd.Timestamp('2015-01-02') + pd.to_timedelta(rng.integers(0, 2000, n), 'D'),
+        'trd_exctn_tm':    pd.Series(rng.integers(0, 86400, n)).map(lambda s: f'{s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}'),
+        'msg_seq_nb':      pd.Series(np.arange(n) + 1000000).astype(str),
+        'trc_st':          rng.choice(['T', 'R'], n),
+        'trd_rpt_dt':      pd.Timestamp('2015-01-02'),
+        'entrd_vol_qt':    rng.choice([10000., 25000., 100000., 1000000.], n),
+        'rptd_pr':         np.round(rng.normal(100, 5, n), 3),
+        'asof_cd':         None,
+        'orig_msg_seq_nb': None,
+        'rpt_side_cd':     rng.choice(['B', 'S', 'D'], n),
+        'cntra_mp_id':     rng.choice(['C', 'D'], n)})
+
+    xc = post.sample(frac=0.05, random_state=seed).assign(trc_st=lambda df: rng.choice(['X', 'C'], len(df)))
+    y = post.sample(frac=0.05, random_state=seed + 1)
+    y = y.assign(trc_st='Y', orig_msg_seq_nb=y['msg_seq_nb'], msg_seq_nb=y['msg_seq_nb'] + 'Y')
+    return pd.concat([post, xc, y], ignore_index=True).sample(frac=1, random_state=seed)
+
+
+def merge_clean_post_2012(post):
+    '''
+    The merge-based C/X and Y matching that clean_post_2012 replaced,
+    kept here as the benchmark baseline.
+    '''
+    keys = trace_clean.POST_2012_KEYS
+    post_tr = post[(post['trc_st'] == 'T') | (post['trc_st'] == 'R')]
+    post_xc = post[(post['trc_st'] == 'X') | (post['trc_st'] == 'C')]
+    post_y  = post[(post['trc_st'] == 'Y')]
+
+    _clean_post1 = pd.merge(post_tr.drop_duplicates(), post_xc[keys + ['msg_seq_nb', 'trc_st']],
+                            on=keys + ['msg_seq_nb'], how='left')
+    _clean_post2 = pd.merge(_clean_post1.drop_duplicates(), post_y[keys + ['orig_msg_seq_nb', 'trc_st']],
+                            left_on=keys + ['msg_seq_nb'], right_on=keys + ['orig_msg_seq_nb'], how='left')
+    clean_post2 = _clean_post2[_clean_post2['trc_st_y'].isnull()].drop_duplicates()
+    clean_post2 = clean_post2.drop(['orig_msg_seq_nb_y', 'trc_st_y', 'trc_st'], axis=1)
+    return clean_post2.rename(columns={'orig_msg_seq_nb_x': 'orig_msg_seq_nb', 'trc_st_x': 'trc_st'})
+
+
+def bench_anti_join(rows, seed=0):
+    post = synthetic_post_2012(rows, seed)
+    print(f'post 2012 chunk: {len(post):,} rows')
+
+    merged, elapsed, peak = measure(merge_clean_post_2012, post)
+    report('merge (baseline)', len(post), elapsed, peak)
+    joined, elapsed, peak = measure(trace_clean.clean_post_2012, post)
+    report('anti_join', len(post), elapsed, peak)
+
+    assert_frame_equal(merged.reset_index(drop=True), joined.reset_index(drop=True))
+    print('same surviving rows:', len(joined))
+
+
+#* ************************************** */
+#* Typed ingestion schema                 */
+#* ************************************** */
+def raw_pull(post):
+    '''
+    This function turns a synthetic frame into the object columns a
+    raw_sql pull returns: strings for codes, flags, dates and times.
+    '''
+    raw = post.assign(trd_exctn_dt=post['trd_exctn_dt'].dt.strftime('%Y-%m-%d'),
+                      trd_rpt_dt=post['trd_rpt_dt'].dt.strftime('%Y-%m-%d'),
+                      trd_rpt_tm=post['trd_exctn_tm'],
+                      days_to_sttl_ct='002', lckd_in_ind=None, wis_fl='N', sale_cndtn_cd='@', yld_pt=5.0)
+    return raw.astype({col: object for col in raw.columns if raw[col].dtype != 'float64'})
+
+
+def memory_report(raw, compact):
+    '''
+    This function prints the bytes per trade of every column before and
+    after the conversion to the typed ingestion schema.
+    '''
+    before = raw.memory_usage(deep=True, index=False) / len(raw)
+    after = compact.memory_usage(deep=True, index=False) / len(compact)
+    print(f'{"column":<18} {"before":>10} {"after":>10}  dtype')
+    for col in raw.columns:
+        print(f'{col:<18} {before[col]:10.1f} {after[col]:10.1f}  {compact[col].dtype}')
+    print(f'{"bytes per trade":<18} {before.sum():10.1f} {after.sum():10.1f}')
+
+
+def bench_dtypes(rows, seed=0):
+    raw = raw_pull(synthetic_post_2012(rows, seed))
+    print(f'raw pull: {len(raw):,} rows')
+
+    compact, elapsed, peak = measure(trace_clean.prepare_trace, raw)
+    report('prepare_trace', len(raw), elapsed, peak)
+    memory_report(raw, compact)
+
+    objects = raw.assign(trd_exctn_dt=pd.to_datetime(raw['trd_exctn_dt']),
+                         trd_rpt_dt=pd.to_datetime(raw['trd_rpt_dt']))
+    cleaned_objects, elapsed, peak = measure(merge_clean_post_2012, objects)
+    report('clean_post_2012 (object)', len(raw), elapsed, peak)
+    cleaned, elapsed, peak = measure(trace_clean.clean_post_2012, compact)
+    report('clean_post_2012 (typed)', len(raw), elapsed, peak)
+    assert len(cleaned) == len(cleaned_objects)
+    print('same surviving rows:', len(cleaned))
+
+
+#* ************************************** */
+#* Streaming pull                         */
+#* ************************************** */
+class RecordsConnection:
+    '''
+    Serves rows held as tuples through the named-cursor interface of the
+    psycopg2 connection behind wrds.Connection, like a server-side cursor.
+    '''
+    def __init__(self, frame):
+        self.columns = list(frame.columns)
+        self.records = list(frame.itertuples(index=False, name=None))
+        self.connection = self
+
+    def cursor(self, name=None, withhold=False):
+        return RecordsCursor(self)
+
+    def raw_sql(self, sql, params=None):
+        return pd.DataFrame.from_records(self.records, columns=self.columns)
+
+
+class RecordsCursor:
+    def __init__(self, db):
+        self.db, self.position = db, 0
+        self.description = [(column,) for column in db.columns]
+
+    def execute(self, sql, params=None):
+        self.position = 0
+
+    def fetchmany(self, size):
+        rows = self.db.records[self.position:self.position + size]
+        self.position += size
+        return rows
+
+    def close(self):
+        pass
+
+
+def pull_whole(db, sql, params):
+    trace = db.raw_sql(sql, params=params)
+    return trace_clean.filter_rows(trace)
+
+
+def bench_stream(rows, batch_rows, seed=0):
+    raw = raw_pull(synthetic_post_2012(rows, seed))
+    # a busy pre 2012 chunk, where the BNS filters drop part of the rows
+    raw['trd_rpt_dt'] = '2010-06-01'
+    raw['days_to_sttl_ct'] = np.random.default_rng(seed).choice(['002', '003'], len(raw))
+    db = RecordsConnection(raw)
+    del raw
+    print(f'chunk: {len(db.records):,} rows')
+
+    (whole, _), elapsed, peak = measure(pull_whole, db, None, None)
+    report('whole pull', len(db.records), elapsed, peak)
+    (streamed, _, _), elapsed, peak = measure(load_trace.read_trace, db, None, None, batch_size=batch_rows)
+    report(f'streamed ({batch_rows:,} rows)', len(db.records), elapsed, peak)
+
+    assert_frame_equal(whole.reset_index(drop=True), streamed, check_categorical=False)
+    print('same surviving rows:', len(streamed))
+
+
+#* ************************************** */
+#* Cleaning stages at scale               */
+#* ************************************** */
+def bench_stages(trades, chunk_trades, seed=0):
+    '''
+    This function cleans trace_synth data chunk by chunk, checks every
+    chunk's daily output against the ground truth and prints the
+    throughput of each cleaning stage.
+    '''
+    records, n_rows, elapsed = [], 0, 0.0
+    for trace, survives in trace_synth.iter_synthetic_trace(trades, chunk_trades, seed=seed):
+        profile = trace_profile.StageProfile()
+        start = time.perf_counter()
+        PricesAll, VolumesAll, prc_BID_ASK, _ = trace_clean.clean_chunk(trace, profile=profile)
+        elapsed += time.perf_counter() - start
+        n_rows += len(trace)
+        records += profile.records()
+
+        expected = trace_clean.aggregate_daily(trace_synth.expected_trades(trace, survives))
+        for frame, expected_frame in zip((PricesAll, VolumesAll, prc_BID_ASK), expected):
+            assert_frame_equal(frame, expected_frame, check_exact=False)
+        print(f'{n_rows:,} records cleaned, output matches the ground truth')
+
+    print(f'clean_chunk {n_rows:,} records in {elapsed:.2f} s, {n_rows / elapsed / 1e6:.2f} M rows/s')
+    summary = trace_profile.summarize(pd.DataFrame(records))
+    print(f'{"stage":<20} {"seconds":>9} {"share":>7} {"rows in":>14} {"M rows/s":>9}')
+    for stage in summary.itertuples():
+        rows_in = stage.rows_in if stage.rows_in > 0 else stage.rows_out
+        print(f'{stage.stage:<20} {stage.seconds:9.2f} {stage.share:7.1%} {rows_in:14,.0f} '
+              f'{rows_in / stage.seconds / 1e6:9.2f}')
+
+
+#* ************************************** */
+#* pandas and polars backends             */
+#* ************************************** */
+def rss_mb():
+    '''
+    This function returns the resident set size of the process in MB (Linux).
+    '''
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+
+def measure_rss(func, *args, interval=0.005, **kwargs):
+    '''
+    This function runs func once, sampling the resident set size in a
+    thread. Unlike tracemalloc it also sees the memory polars allocates.
+    Output: result, wall time in seconds, peak MB above the resident set
+    size at the start
+    '''
+    start_mb = rss_mb()
+    peak_mb, done = [start_mb], threading.Event()
+    def sample():
+        while not done.wait(interval):
+            peak_mb[0] = max(peak_mb[0], rss_mb())
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    done.set()
+    sampler.join()
+    return result, elapsed, max(peak_mb[0], rss_mb()) - start_mb
+
+
+def _clean_synthetic_chunk(backend, n_trades, n_cusips, seed, first_cusip, memory_budget_mb=None):
+    trace, _ = trace_synth.synthetic_trace(n_trades, n_cusips=n_cusips, seed=seed, first_cusip=first_cusip)
+    gc.collect()
+    result, elapsed, peak_mb = measure_rss(load_trace.CLEANERS[backend].clean_chunk, trace,
+                                           memory_budget_mb=memory_budget_mb)
+    return result, elapsed, peak_mb, len(trace)
+
+
+def bench_backend(trades, chunk_trades, cusips_per_chunk=500, seed=0):
+    '''
+    This function cleans the chunks of trace_synth.iter_synthetic_trace with
+    the pandas and the polars backend side by side, each chunk and backend
+    in a fresh process so the memory of one run does not carry over to the
+    next, checks that the outputs are identical and prints the time and
+    peak memory of both per chunk.
+    '''
+    context = multiprocessing.get_context('spawn')
+    print(f'polars on {pl.threadpool_size()} threads')
+    print(f'{"chunk":>5} {"records":>11} {"pandas s":>9} {"MB":>7} {"polars s":>9} {"MB":>7} {"speed-up":>8}')
+    totals = {'pandas': 0.0, 'polars': 0.0}
+    for i, start in enumerate(range(0, trades, chunk_trades)):
+        chunk = (min(chunk_trades, trades - start), cusips_per_chunk, seed, i * cusips_per_chunk)
+        runs = {}
+        for backend in totals:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                runs[backend] = executor.submit(_clean_synthetic_chunk, backend, *chunk).result()
+            totals[backend] += runs[backend][1]
+
+        (expected, pd_s, pd_mb, n_rows), (result, pl_s, pl_mb, _) = runs['pandas'], runs['polars']
+        for expected_frame, frame in zip(expected[:3], result[:3]):
+            assert_frame_equal(expected_frame, frame, check_exact=True)
+        assert expected[3] == result[3]
+        print(f'{i:5d} {n_rows:11,} {pd_s:9.2f} {pd_mb:7.0f} {pl_s:9.2f} {pl_mb:7.0f} {pd_s / pl_s:7.2f}x')
+
+    print(f'total: pandas {totals["pandas"]:.2f} s, polars {totals["polars"]:.2f} s, identical outputs')
+
+
+#* ************************************** */
+#* Trade gap and trade count filters      */
+#* ************************************** */
+def synthetic_panel(rows, n_bonds=20000, seed=0):
+    '''
+    This function draws a daily (cusip_id, trd_exctn_dt) panel like
+    BondDailyPublic, sorted by bond and date, with a few missing prices.
+    '''
+    rng = np.random.default_rng(seed)
+    days = pd.bdate_range('2003-01-01', '2023-12-31').values
+    bonds = np.sort(rng.integers(0, n_bonds, rows))
+    # a random business day per row, made unique within a bond
+    panel = pd.DataFrame({'cusip_id': bonds, 'day': rng.integers(0, len(days), rows)})
+    panel = panel.drop_duplicates().sort_values(['cusip_id', 'day'])
+    cusips = trace_synth.cusip_ids(0, n_bonds)
+    prclean = rng.normal(100, 5, len(panel))
+    prclean[rng.random(len(panel)) < 0.01] = np.nan
+    return pd.DataFrame({'cusip_id': np.asarray(cusips, dtype=object)[panel['cusip_id'].to_numpy()],
+                         'trd_exctn_dt': days[panel['day'].to_numpy()],
+                         'prclean': prclean,
+                         'cs_dur_bps': rng.normal(150, 50, len(panel))})
+
+
+def merge_trades_info(df, start_date, end_date):
+    '''
+    This function is the merge-based get_trades_info that calc_spread_bias.py
+    and calc_daily_return_cs.py used before trade_gaps.py.
+    '''
+    holiday_date_list = USFederalHolidayCalendar().holidays(start_date, end_date).date.tolist()
+    df = df.rename(columns={'trd_exctn_dt': 'date'})
+    df['date_lag'] = df.groupby('cusip_id')['date'].shift(1)
+    dfDC = df.dropna()
+    dfDC['n'] = np.busday_count(dfDC['date_lag'].values.astype('M8[D]'),
+                                dfDC['date'].values.astype('M8[D]'),
+                                holidays=holiday_date_list)
+    df = df.merge(dfDC[['cusip_id', 'date', 'n']], on=['cusip_id', 'date'], how='left')
+    df = df.dropna()
+    df['month_year'] = pd.to_datetime(df['date']).dt.to_period('M')
+    df['trade_counts'] = df.groupby(['cusip_id', 'month_year'])['date'].transform('count')
+    return df
+
+
+def bench_trade_gaps(rows, seed=0):
+    panel = synthetic_panel(rows, seed=seed)
+    print(f'panel: {len(panel):,} bond-days')
+    window = ('2003-01-01', '2023-12-31')
+
+    expected, elapsed, peak = measure(merge_trades_info, panel, *window)
+    report('merge get_trades_info', len(panel), elapsed, peak)
+    result, elapsed, peak = measure(trade_gaps.get_trades_info, panel, *window)
+    report('trade_gaps.get_trades_info', len(panel), elapsed, peak)
+
+    assert_frame_equal(expected, result, check_dtype=False)
+    print('same rows, gaps and counts:', len(result))
+
+
+#* ************************************** */
+#* Out-of-core daily aggregation          */
+#* ************************************** */
+def bench_spill(trades, memory_budget_mb, backend='pandas', n_cusips=500, seed=0):
+    '''
+    This function cleans one chunk of trace_synth data in memory and with
+    the daily aggregation spilled to date partitions under memory_budget_mb,
+    each in a fresh process, checks that the outputs are identical and
+    prints the time and peak memory of both.
+    '''
+    context = multiprocessing.get_context('spawn')
+    chunk = (backend, trades, n_cusips, seed, 0)
+    runs = {}
+    for name, budget in (('in memory', None), (f'budget {memory_budget_mb:g} MB', memory_budget_mb)):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            runs[name] = executor.submit(_clean_synthetic_chunk, *chunk, memory_budget_mb=budget).result()
+        _, elapsed, peak_mb, n_rows = runs[name]
+        print(f'{name:<18} {n_rows:11,} records {elapsed:8.2f} s {peak_mb:8.0f} MB peak')
+
+    expected, result = (run[0] for run in runs.values())
+    for expected_frame, frame in zip(expected[:3], result[:3]):
+        assert_frame_equal(expected_frame, frame, check_exact=True)
+    assert expected[3] == result[3]
+    print(f'{trace_spill.n_partitions(expected[3]["Obs.PostBBW"], memory_budget_mb)} partitions, '
+          'identical outputs')
+
+
+#* ************************************** */
+#* Prefetching pipeline                   */
+#* ************************************** */
+class SlowConnection:
+    '''
+    Serves the chunks of trace_synth data by CUSIP after waiting as long as
+    a pull of that many rows at fetch_rate rows per second would take.
+    The wait releases the GIL, like a socket read.
+    '''
+    def __init__(self, chunks, fetch_rate):
+        self.chunks = {cusip: trace for trace in chunks for cusip in trace['cusip_id'].unique()}
+        self.fetch_rate = fetch_rate
+
+    def raw_sql(self, sql, params=None):
+        traces = {id(self.chunks[cusip]): self.chunks[cusip] for cusip in params['cusip_id'] if cusip in self.chunks}
+        trace = pd.concat(traces.values(), ignore_index=True)
+        trace = trace[trace['cusip_id'].isin(params['cusip_id'])].reset_index(drop=True)
+        time.sleep(len(trace) / self.fetch_rate)
+        return trace
+
+
+def bench_pipeline(trades, chunk_trades, fetch_rate, cusips_per_chunk=500, seed=0, prefetch=2, fetchers=1):
+    '''
+    This function runs load_trace.run_chunks over trace_synth chunks served
+    by a SlowConnection, pulling and cleaning in turn and then as the
+    prefetching pipeline, checks that the outputs match and prints the wall
+    time against the fetch and cleaning time of the chunks and the peak
+    resident memory of both runs.
+    '''
+    chunks = [trace for trace, _ in trace_synth.iter_synthetic_trace(trades, chunk_trades, cusips_per_chunk, seed)]
+    cusip_chunks = [list(trace['cusip_id'].unique()) for trace in chunks]
+    connect = lambda: SlowConnection(chunks, fetch_rate)
+    print(f'{len(chunks)} chunks, {sum(map(len, chunks)):,} records, fetched at {fetch_rate:,} rows/s')
+
+    # the time the connection waits, the rest of a run in turn is spent cleaning
+    fetch_s = sum(map(len, chunks)) / fetch_rate
+    outputs, seconds = {}, {}
+    for name, options in (('in turn', {}), (f'prefetch {prefetch}', {'prefetch': prefetch, 'fetchers': fetchers})):
+        gc.collect()
+        outputs[name], seconds[name], peak_mb = measure_rss(load_trace.run_chunks, cusip_chunks, connect=connect,
+                                                            pushdown=False, **options)
+        print(f'{name:<12} {seconds[name]:8.2f} s {peak_mb:8.0f} MB peak')
+    clean_s = seconds['in turn'] - fetch_s
+    print(f'fetch {fetch_s:.2f} s, clean {clean_s:.2f} s: max {max(fetch_s, clean_s):.2f} s, '
+          f'sum {fetch_s + clean_s:.2f} s')
+    expected, result = outputs.values()
+    for expected_list, result_list in zip(expected[:3], result[:3]):
+        assert_frame_equal(pd.concat(expected_list), pd.concat(result_list), check_exact=True)
+    print('same outputs')
+
+
+#* ************************************** */
+#* Streaming spread and bias              */
+#* ************************************** */
+def _spread_bias(store_dir, output_path, partition_rows):
+    gc.collect()
+    if partition_rows:
+        run = calc_spread_bias.stream_spread_bias
+        args = (output_path, partition_rows, store_dir, store_dir)
+    else:
+        run, args = calc_spread_bias.write_spread_bias, (output_path, store_dir)
+    _, elapsed, peak_mb = measure_rss(run, *args)
+    return elapsed, peak_mb
+
+
+def bench_spread_bias(rows, partition_rows, seed=0):
+    '''
+    This function writes a synthetic Illiq panel to a temporary trace store
+    and runs calc_spread_bias.py on it with the whole panel in memory and
+    streamed in bond ranges of partition_rows rows, each in a fresh
+    process. It checks that both write the same csv and prints the time
+    and peak memory of each.
+    '''
+    rng = np.random.default_rng(seed)
+    # about half of the business days of every bond, so most bond-months pass the filters
+    panel = synthetic_panel(rows, n_bonds=max(rows // 2500, 1), seed=seed).dropna(subset=['prclean'])
+    panel = pd.DataFrame({'cusip_id': panel['cusip_id'], 'trd_exctn_dt': panel['trd_exctn_dt'],
+                          'prc_bid': panel['prclean'] + rng.exponential(0.5, len(panel)),
+                          'prc_ask': panel['prclean']})
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory(prefix='bench_spread_bias_') as tmp:
+        tmp = Path(tmp)
+        trace_store.write_dataset(panel, 'Illiq', store_dir=tmp)
+        del panel
+        paths = {}
+        for name, partition in (('in memory', 0), (f'{partition_rows:,} rows', partition_rows)):
+            paths[name] = tmp / f'spread_bias_{partition}.csv'
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                elapsed, peak_mb = executor.submit(_spread_bias, tmp, paths[name], partition).result()
+            print(f'{name:<18} {elapsed:8.2f} s {peak_mb:8.0f} MB peak')
+        expected, result = (path.read_bytes() for path in paths.values())
+        assert expected == result
+        n_rows = expected.count(b'\n') - 1
+        print(f'{n_rows:,} rows, identical outputs')
+
+
+#* ************************************** */
+#* Winsorization                          */
+#* ************************************** */
+def _winsorize_streamed(values, chunk_values):
+    chunks = np.array_split(values, max(1, len(values) // chunk_values))
+    selector = winsorize.RankSelector()
+    for chunk in chunks:
+        selector.add(chunk)
+    winsorizer = winsorize.Winsorizer().fit_selector(selector, lambda: iter(chunks))
+    winsorized, start = np.empty_like(values), 0
+    for chunk in chunks:
+        winsorized[start:start + len(chunk)] = winsorizer.transform(chunk)
+        start += len(chunk)
+    return winsorized
+
+
+def bench_winsorize(n_values, chunk_values=10_000_000, seed=0):
+    '''
+    This function winsorizes n_values bias-like values (squared relative
+    spreads in bps, rounded, so with many ties) at 0.5%/99.5% with scipy,
+    with the Winsorizer and streamed through a RankSelector in chunks of
+    chunk_values, checks that the outputs are identical and prints the time
+    and peak memory of each.
+    '''
+    rng = np.random.default_rng(seed)
+    values = np.round((rng.standard_t(3, n_values) * 0.003) ** 2 * 10000, 4)
+    print(f'{n_values:,} values, {values.nbytes / 2**20:,.0f} MB')
+
+    expected, elapsed, peak = measure(lambda: np.asarray(scipy_winsorize(values, limits=winsorize.LIMITS)))
+    report('scipy mstats.winsorize', n_values, elapsed, peak)
+    result, elapsed, peak = measure(winsorize.winsorize, values)
+    report('winsorize.winsorize', n_values, elapsed, peak)
+    assert np.array_equal(expected, result)
+    del result
+    result, elapsed, peak = measure(_winsorize_streamed, values, chunk_values)
+    report('RankSelector, streamed', n_values, elapsed, peak)
+    assert np.array_equal(expected, result)
+    print('identical outputs')
+
+
+def groupby_winsorize(values, dates):
+    '''
+    This function winsorizes the values of every date with scipy, one
+    date at a time.
+    '''
+    winsorize_date = lambda s: np.asarray(scipy_winsorize(s.to_numpy().copy(), limits=winsorize.LIMITS), dtype='float64')
+    return pd.Series(values).groupby(dates).transform(winsorize_date).to_numpy()
+
+
+def bench_cross_section(n_values, n_dates, workers, seed=0):
+    '''
+    This function winsorizes n_values values spread over n_dates business
+    days date by date, with scipy in a groupby and with
+    winsorize.winsorize_by_date on 1 and `workers` threads, checks that the
+    outputs are identical and prints the time and peak memory of each.
+    '''
+    rng = np.random.default_rng(seed)
+    days = pd.bdate_range('2003-01-01', periods=n_dates).values
+    dates = days[rng.integers(0, n_dates, n_values)]
+    values = np.round((rng.standard_t(3, n_values) * 0.003) ** 2 * 10000, 4)
+    print(f'{n_values:,} values over {n_dates:,} dates')
+
+    expected, elapsed, peak = measure(groupby_winsorize, values, dates)
+    report('groupby scipy winsorize', n_values, elapsed, peak)
+    for n_workers in sorted({1, workers}):
+        result, elapsed, peak = measure(winsorize.winsorize_by_date, values, dates, workers=n_workers)
+        report(f'winsorize_by_date, {n_workers} thread(s)', n_values, elapsed, peak)
+        assert np.array_equal(expected, result)
+    print('identical outputs')
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmarks for the TRACE cleaning code.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    anti_join_parser = subparsers.add_parser('anti-join', help='post 2012 C/X and Y matching')
+    anti_join_parser.add_argument('--rows', type=int, default=3_000_000)
+    anti_join_parser.add_argument('--seed', type=int, default=0)
+
+    dtypes_parser = subparsers.add_parser('dtypes', help='memory of the typed ingestion schema')
+    dtypes_parser.add_argument('--rows', type=int, default=3_000_000)
+    dtypes_parser.add_argument('--seed', type=int, default=0)
+
+    stream_parser = subparsers.add_parser('stream', help='batched pull with row-local filters')
+    stream_parser.add_argument('--rows', type=int, default=3_000_000)
+    stream_parser.add_argument('--batch-rows', type=int, default=100_000)
+    stream_parser.add_argument('--seed', type=int, default=0)
+
+    stages_parser = subparsers.add_parser('stages', help='throughput per cleaning stage on trace_synth data')
+    stages_parser.add_argument('--trades', type=int, default=1_000_000)
+    stages_parser.add_argument('--chunk-trades', type=int, default=1_000_000)
+    stages_parser.add_argument('--seed', type=int, default=0)
+
+    backend_parser = subparsers.add_parser('backend', help='pandas and polars cleaning side by side, per chunk')
+    backend_parser.add_argument('--trades', type=int, default=1_000_000)
+    backend_parser.add_argument('--chunk-trades', type=int, default=500_000)
+    backend_parser.add_argument('--seed', type=int, default=0)
+
+    gaps_parser = subparsers.add_parser('trade-gaps', help='business-day gaps and monthly trade counts')
+    gaps_parser.add_argument('--rows', type=int, default=5_000_000)
+    gaps_parser.add_argument('--seed', type=int, default=0)
+
+    spill_parser = subparsers.add_parser('spill', help='daily aggregation in memory and by date partition')
+    spill_parser.add_argument('--trades', type=int, default=1_000_000)
+    spill_parser.add_argument('--memory-budget-mb', type=float, default=100)
+    spill_parser.add_argument('--backend', choices=sorted(load_trace.CLEANERS), default='pandas')
+    spill_parser.add_argument('--seed', type=int, default=0)
+
+    pipeline_parser = subparsers.add_parser('pipeline', help='pulling and cleaning in turn against the pipeline')
+    pipeline_parser.add_argument('--trades', type=int, default=1_000_000)
+    pipeline_parser.add_argument('--chunk-trades', type=int, default=250_000)
+    pipeline_parser.add_argument('--fetch-rate', type=int, default=100_000, help='rows per second of the pull')
+    pipeline_parser.add_argument('--prefetch', type=int, default=2)
+    pipeline_parser.add_argument('--fetchers', type=int, default=1)
+    pipeline_parser.add_argument('--seed', type=int, default=0)
+
+    spread_bias_parser = subparsers.add_parser('spread-bias', help='spread and bias in memory and streamed by bond')
+    spread_bias_parser.add_argument('--rows', type=int, default=5_000_000)
+    spread_bias_parser.add_argument('--partition-rows', type=int, default=500_000)
+    spread_bias_parser.add_argument('--seed', type=int, default=0)
+
+    winsorize_parser = subparsers.add_parser('winsorize', help='scipy winsorize against selection of the bounds')
+    winsorize_parser.add_argument('--values', type=int, default=10_000_000)
+    winsorize_parser.add_argument('--chunk-values', type=int, default=10_000_000)
+    winsorize_parser.add_argument('--seed', type=int, default=0)
+
+    cross_section_parser = subparsers.add_parser('cross-section', help='per-date winsorization, groupby against sorted blocks')
+    cross_section_parser.add_argument('--values', type=int, default=10_000_000)
+    cross_section_parser.add_argument('--dates', type=int, default=5_000)
+    cross_section_parser.add_argument('--workers', type=int, default=os.cpu_count())
+    cross_section_parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'anti-join':
+        bench_anti_join(args.rows, args.seed)
+    elif args.benchmark == 'dtypes':
+        bench_dtypes(args.rows, args.seed)
+    elif args.benchmark == 'stream':
+        bench_stream(args.rows, args.batch_rows, args.seed)
+    elif args.benchmark == 'stages':
+        bench_stages(args.trades, args.chunk_trades, args.seed)
+    elif args.benchmark == 'backend':
+        bench_backend(args.trades, args.chunk_trades, seed=args.seed)
+    elif args.benchmark == 'trade-gaps':
+        bench_trade_gaps(args.rows, args.seed)
+    elif args.benchmark == 'spill':
+        bench_spill(args.trades, args.memory_budget_mb, args.backend, seed=args.seed)
+    elif args.benchmark == 'pipeline':
+        bench_pipeline(args.trades, args.chunk_trades, args.fetch_rate, seed=args.seed,
+                       prefetch=args.prefetch, fetchers=args.fetchers)
+    elif args.benchmark == 'spread-bias':
+        bench_spread_bias(args.rows, args.partition_rows, args.seed)
+    elif args.benchmark == 'winsorize':
+        bench_winsorize(args.values, args.chunk_values, args.seed)
+    elif args.benchmark == 'cross-section':
+        bench_cross_section(args.values, args.dates, args.workers, args.seed)
@@ -5,18 +5,21 @@ This Python script
 1. Takes in the data generated from load_return_cs.py   
 2. cleans the merged data based on the conditions mentioned from the paper
 3. Output daily_return.csvcalculate daily returns and extract credit spread on corporate bonds.
+
+With WINSORIZE_MODE=cross_sectional in .env, the credit spread and the
+daily return are winsorized across the bonds of every date (see
+winsorize.py); by default only the credit spread is, over the whole panel.
 '''
 
 import pandas as pd
-from pandas.tseries.holiday import USFederalHolidayCalendar
-from pandas.tseries.offsets import CustomBusinessDay
 import numpy as np
-from scipy.stats.mstats import winsorize
 import datetime as dt
 import warnings
 warnings.filterwarnings("ignore")
 
 import config
+import trade_gaps
+import winsorize
 from pathlib import Path
 
 OUTPUT_DIR = Path(config.OUTPUT_DIR)
@@ -24,6 +27,12 @@ DATA_DIR = Path(config.DATA_DIR)
 WRDS_USERNAME = config.WRDS_USERNAME
 START_DATE = config.START_DATE
 END_DATE = config.END_DATE
+WINSORIZE_MODE = config.WINSORIZE_MODE
+
+# Keep bonds with at least MIN_TRADES observations in the month, at most
+# MAX_GAP business days after the previous one
+MIN_TRADES = trade_gaps.MIN_TRADES
+MAX_GAP = 5
 
 
 def extract_price_cs(data):
@@ -48,41 +57,17 @@ def extract_price_cs(data):
     return df_return_cs
 
 
-def process_credit_spread(df):
+def process_credit_spread(df, mode=WINSORIZE_MODE):
     '''
     This function winsorize credit spread data
+    (over the panel, or per date in mode 'cross_sectional')
     '''
     df['cs_dur'] = df['cs_dur']*10000
-    df['cs_dur'] = winsorize(df['cs_dur'], limits=[0.005, 0.005])
+    df['cs_dur'] = winsorize.winsorize_panel(df['cs_dur'], df['trd_exctn_dt'], mode=mode, limits=winsorize.LIMITS)
     df.rename(columns={'cs_dur': 'cs_dur_bps'}, inplace=True)
     return df
 
 
-def get_trades_info(df, start_date = START_DATE, end_date = END_DATE):
-    '''
-    This function is used to process the illiquid data by adding 2 columns 
-    to denote the business days count between 2 trades and the total number of trades of a bond winthin a month.
-    '''
-    calendar = USFederalHolidayCalendar()
-    holidays = calendar.holidays(start_date, end_date)
-    holiday_date_list = holidays.date.tolist()
-    df = df.rename(columns={'trd_exctn_dt':'date'})
-
-    df['date_lag'] = df.groupby('cusip_id')['date'].shift(1)
-    dfDC = df.dropna()
-    dfDC['n']  = np.busday_count(dfDC['date_lag'].values.astype('M8[D]') , 
-                                      dfDC['date'].values.astype('M8[D]'),
-                                      holidays = holiday_date_list)
-
-    df = df.merge(dfDC[['cusip_id','date','n']], left_on = ['cusip_id','date'], right_on = ['cusip_id','date'] ,how = "left")
-    
-    df = df.dropna()
-    df['month_year']   = pd.to_datetime(df['date']).dt.to_period('M') 
-    df['trade_counts'] = df.groupby(['cusip_id',
-                                    'month_year'] )['date'].transform("count")    
-    return df
-
-
 # def filter_less_than_five_busn_days(data):
 #     '''
 #     This function filter based on business days between trades (<= 5 days)
@@ -124,13 +109,14 @@ def get_trades_info(df, start_date = START_DATE, end_date = END_DATE):
 #     return data
 
 
-def calc_daily_returns_remove_large_reversals(data):
+def calc_daily_returns_remove_large_reversals(data, mode=WINSORIZE_MODE):
     
     '''
     calculate the daily returns, remove large return reversals 
     and exclude returns with absolute value > 20%. 
     winsorize credit spread data at 95%
     returns and credit spread are in bps    
+    in mode 'cross_sectional', the returns are winsorized per date
     '''
     # Calculate daily returns
     data['daily_return'] = data.groupby('cusip_id')['prclean'].pct_change()
@@ -144,6 +130,8 @@ def calc_daily_returns_remove_large_reversals(data):
     
     # Multiply the 'daily_return' by 10,000
     data['daily_return'] = data['daily_return'] * 10000
+    if mode == 'cross_sectional':
+        data['daily_return'] = winsorize.winsorize_by_date(data['daily_return'], data['date'], limits=winsorize.LIMITS)
     
     # Rename the 'daily_return' column to 'daily_return_bps'
     data.rename(columns={'daily_return': 'daily_return_bps'}, inplace=True)
@@ -160,9 +148,8 @@ if __name__ == "__main__":
 
     df_wcs = process_credit_spread(df)
 
-    df_filter = get_trades_info(df_wcs)
-    df_wo5 = df_filter[df_filter['trade_counts'] >= 5]
-    df_wo5 = df_wo5[df_wo5['n'] <= 5]
+    df_filter = trade_gaps.get_trades_info(df_wcs)
+    df_wo5 = trade_gaps.filter_trades(df_filter, min_trades=MIN_TRADES, max_gap=MAX_GAP)
     
     # df_filter_less_five = filter_less_than_five_busn_days(df_wcs)
     # df_less_five_trade = filter_less_than_five_trades_per_months(df_filter_less_five)
@@ -5,18 +5,41 @@ This Python script
 1. merges the ratings data with the illiquid data (value-weighted bid and ask price)
 2. cleans the merged data
 3. generates the bid ask spread and bid ask bias
+
+With --partition-rows N (SPREAD_BIAS_PARTITION_ROWS in .env) the stage
+streams Illiq from the trace store in bond ranges of about N rows instead
+of reading the whole panel. The trade filters only look at the rows of the
+same bond, so every range is processed on its own; a first pass writes the
+spread and bias of each range to a temporary Parquet file under
+TRACE_SPILL_DIR and counts the bias with a winsorize.RankSelector, from
+which a winsorize.Winsorizer fits the exact global 0.5%/99.5% bounds of
+the winsorization. A second pass clips the bias of each range and appends
+it to spread_bias.csv. The output is identical to the in-memory run,
+which bench_trace.py spread-bias --rows 5000000 --partition-rows 500000
+compares it with.
+
+With WINSORIZE_MODE=cross_sectional in .env, the bias and the spread are
+winsorized across the bonds of every date instead of over the pooled
+panel (winsorize.winsorize_panel). When streaming, the per-date bounds are
+fitted between the passes from the spilled ranges, read back in blocks of
+dates.
 '''
 
+import argparse
+import tempfile
+
 import pandas as pd
-from pandas.tseries.holiday import USFederalHolidayCalendar
-from pandas.tseries.offsets import CustomBusinessDay
+import pyarrow as pa
+import pyarrow.dataset as ds
 import numpy as np
-from scipy.stats.mstats import winsorize
 import datetime as dt
 import warnings
 warnings.filterwarnings("ignore")
 
 import config
+import trace_store
+import trade_gaps
+import winsorize
 from pathlib import Path
 
 OUTPUT_DIR = Path(config.OUTPUT_DIR)
@@ -24,6 +47,18 @@ DATA_DIR = Path(config.DATA_DIR)
 WRDS_USERNAME = config.WRDS_USERNAME
 START_DATE = config.START_DATE
 END_DATE = config.END_DATE
+SPREAD_BIAS_PARTITION_ROWS = config.SPREAD_BIAS_PARTITION_ROWS
+SPILL_DIR = Path(config.TRACE_SPILL_DIR)
+WINSORIZE_MODE = config.WINSORIZE_MODE
+
+# Keep bonds with at least MIN_TRADES observations in the month, at most
+# MAX_GAP business days after the previous one
+MIN_TRADES = trade_gaps.MIN_TRADES
+MAX_GAP = 7
+# Share of the bias winsorized at each end
+LIMITS = winsorize.LIMITS
+
+OUTPUT_COLUMNS = ['cusip_id', 'date', 'spread', 'winsorized_bias']
 
 
 def process_illiquid_data(df):
@@ -37,64 +72,147 @@ def process_illiquid_data(df):
     return df
 
 
-def get_trades_info(df, start_date = START_DATE, end_date = END_DATE):
-    '''
-    This function is used to process the illiquid data by adding 2 columns 
-    to denote the business days count between 2 trades and the total number of trades of a bond winthin a month.
-    '''
-    calendar = USFederalHolidayCalendar()
-    holidays = calendar.holidays(start_date, end_date)
-    holiday_date_list = holidays.date.tolist()
-
-    df['date_lag'] = df.groupby('cusip_id')['date'].shift(1)
-    dfDC = df.dropna()
-    dfDC['n']  = np.busday_count(dfDC['date_lag'].values.astype('M8[D]') , 
-                                      dfDC['date'].values.astype('M8[D]'),
-                                      holidays = holiday_date_list)
-
-    df = df.merge(dfDC[['cusip_id','date','n']], left_on = ['cusip_id','date'], right_on = ['cusip_id','date'] ,how = "left")
-    
-    df = df.dropna()
-    df['month_year']   = pd.to_datetime(df['date']).dt.to_period('M') 
-    df['trade_counts'] = df.groupby(['cusip_id',
-                                    'month_year'] )['date'].transform("count")    
-    return df
-
-
-def calc_spread_bias(df):
+def calc_spread_bias(df, mode=WINSORIZE_MODE):
     '''
     This function is used to calculate the bid and ask spread and bid ask bias,
     also, as denoted in the paper, the bias should be winsorized
+    (over the panel, or per date with the spread in mode 'cross_sectional')
     '''
     df['date'] = pd.to_datetime(df['date'])
     df = df.sort_values(by=['cusip_id','date'])
 
-    df['spread'] = (df['prc_bid'] - df['prc_ask'])/(df['prc_bid'] + df['prc_ask']) * 10000 * 2
-    df['bias'] = (((df['prc_bid'] - df['prc_ask']) / (df['prc_bid'] + df['prc_ask'])) ** 2) * 10000
-    df['winsorized_bias'] = winsorize(df['bias'], limits=[0.005, 0.005])
+    df = calc_spread(df)
+    df['winsorized_bias'] = winsorize.winsorize_panel(df['bias'], df['date'], mode=mode, limits=LIMITS)
+    if mode == 'cross_sectional':
+        df['spread'] = winsorize.winsorize_by_date(df['spread'], df['date'], limits=LIMITS)
 
     return df
 
 
-if __name__ == "__main__":
-    
-    raw_illiqs = pd.read_csv( DATA_DIR / "pulled" /'Illiq.csv.gzip', compression='gzip')
+def calc_spread(df):
+    '''
+    This function adds the bid and ask spread and the bid ask bias (before
+    the winsorization)
+    '''
+    df['spread'] = (df['prc_bid'] - df['prc_ask'])/(df['prc_bid'] + df['prc_ask']) * 10000 * 2
+    df['bias'] = (((df['prc_bid'] - df['prc_ask']) / (df['prc_bid'] + df['prc_ask'])) ** 2) * 10000
+    return df
 
+
+def spread_bias_partition(raw_illiqs):
+    '''
+    This function runs the steps of the script up to the winsorization on
+    the Illiq rows of a range of bonds, and returns cusip_id, date, spread
+    and bias sorted by bond and date
+    '''
     illiqs = process_illiquid_data(raw_illiqs)
+    df = trade_gaps.get_trades_info(illiqs)
+    df = trade_gaps.filter_trades(df, min_trades=MIN_TRADES, max_gap=MAX_GAP)
+    df = calc_spread(df[['cusip_id', 'date', 'prc_bid', 'prc_ask']].copy())
+    return df[['cusip_id', 'date', 'spread', 'bias']]
 
-    df = get_trades_info(illiqs)
 
-    df_wo5 = df[df['trade_counts'] >= 5]
+def write_spread_bias(output_path, store_dir=trace_store.STORE_DIR, mode=WINSORIZE_MODE):
+    '''
+    This function writes spread_bias.csv to output_path from the whole
+    Illiq panel in memory
+    '''
+    raw_illiqs = trace_store.read_dataset('Illiq', columns=['prc_bid', 'prc_ask'], store_dir=store_dir)
 
-    df_wo5 = df_wo5[df_wo5['n'] <= 7]
+    illiqs = process_illiquid_data(raw_illiqs)
+
+    df = trade_gaps.get_trades_info(illiqs)
 
-    df_final = calc_spread_bias(df_wo5)
+    df_wo5 = trade_gaps.filter_trades(df, min_trades=MIN_TRADES, max_gap=MAX_GAP)
+
+    df_final = calc_spread_bias(df_wo5, mode=mode)
 
     df_final['date'] = pd.to_datetime(df_final['date'])
     df_final.sort_values(['cusip_id', 'date'], inplace = True)
-    df_res = df_final[['cusip_id', 'date', 'spread','winsorized_bias']]
+    df_res = df_final[OUTPUT_COLUMNS]
+
+    df_res.to_csv(output_path, index=False)
 
-    df_res.to_csv( Path(DATA_DIR) / "pulled" / 'spread_bias.csv', index=False)
-    
 
+def fit_by_date(paths, date_counts, block_rows):
+    '''
+    This function fits the per-date winsorization of the spread and the
+    bias from the spilled ranges at paths, reading blocks of whole dates of
+    about block_rows rows at a time.
+    Output: dict of column name to winsorize.DateWinsorizer
+    '''
+    winsorizers = {column: winsorize.DateWinsorizer(LIMITS) for column in ['spread', 'bias']}
+    spilled = ds.dataset([str(path) for path in paths], format='parquet')
+    # the same split as the bond ranges of the trace store, on dates
+    for first, last in trace_store.cusip_ranges(date_counts.sort_index(), block_rows):
+        date = ds.field('date')
+        block_filter = (date >= pa.scalar(first, pa.timestamp('ns'))) & (date <= pa.scalar(last, pa.timestamp('ns')))
+        block = spilled.to_table(columns=['date', 'spread', 'bias'], filter=block_filter).to_pandas()
+        for column, winsorizer in winsorizers.items():
+            winsorizer.fit(block[column], block['date'])
+    return winsorizers
+
+
+def stream_spread_bias(output_path, partition_rows=SPREAD_BIAS_PARTITION_ROWS, store_dir=trace_store.STORE_DIR,
+                       spill_dir=SPILL_DIR, mode=WINSORIZE_MODE):
+    '''
+    This function writes spread_bias.csv to output_path in two passes over
+    bond ranges of about partition_rows rows of Illiq, without holding the
+    whole panel:
+    1. every range is processed and spilled to Parquet, and its bias counted
+    2. the global winsorization bounds (or those of every date in mode
+       'cross_sectional') are fitted, the bias of every range is clipped and
+       the range is appended to the csv
+    The output is the same as that of the in-memory script.
+    Output: the winsorize.Winsorizer with the bounds, or a dict of
+    winsorize.DateWinsorizer by column in mode 'cross_sectional'
+    '''
+    if mode not in winsorize.MODES:
+        raise ValueError(f'unknown WINSORIZE_MODE {mode!r}, expected one of {list(winsorize.MODES)}')
+    Path(spill_dir).mkdir(parents=True, exist_ok=True)
+    selector = winsorize.RankSelector()
+    date_counts = pd.Series(dtype='int64')
+    with tempfile.TemporaryDirectory(prefix='spread_bias_', dir=spill_dir) as tmp:
+        paths = []
+        partitions = trace_store.iter_cusip_partitions('Illiq', columns=['prc_bid', 'prc_ask'],
+                                                       partition_rows=partition_rows, store_dir=store_dir)
+        for i, raw_illiqs in enumerate(partitions):
+            df = spread_bias_partition(raw_illiqs)
+            selector.add(df['bias'])
+            date_counts = date_counts.add(df['date'].value_counts(), fill_value=0).astype('int64')
+            paths.append(Path(tmp) / f'part-{i:04d}.parquet')
+            df.to_parquet(paths[-1], index=False)
+
+        def bias_chunks():
+            for path in paths:
+                yield pd.read_parquet(path, columns=['bias'])['bias'].to_numpy()
+
+        if mode == 'pooled':
+            winsorizer = winsorize.Winsorizer(LIMITS).fit_selector(selector, bias_chunks)
+        else:
+            winsorizer = fit_by_date(paths, date_counts, partition_rows)
+
+        pd.DataFrame(columns=OUTPUT_COLUMNS).to_csv(output_path, index=False)
+        for path in paths:
+            df = pd.read_parquet(path)
+            if mode == 'pooled':
+                df['winsorized_bias'] = winsorizer.transform(df['bias'])
+            else:
+                df['spread'] = winsorizer['spread'].transform(df['spread'], df['date'])
+                df['winsorized_bias'] = winsorizer['bias'].transform(df['bias'], df['date'])
+            df[OUTPUT_COLUMNS].to_csv(output_path, mode='a', header=False, index=False)
+    return winsorizer
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Calculate the bid ask spread and bias from the trace store.')
+    parser.add_argument('--partition-rows', type=int, default=SPREAD_BIAS_PARTITION_ROWS,
+                        help='stream the bonds in ranges of about this many rows, 0 to read the whole panel')
+    args = parser.parse_args()
 
+    output_path = Path(DATA_DIR) / "pulled" / 'spread_bias.csv'
+    if args.partition_rows > 0:
+        stream_spread_bias(output_path, args.partition_rows)
+    else:
+        write_spread_bias(output_path)
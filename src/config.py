@@ -28,6 +28,27 @@ OUTPUT_DIR = config('OUTPUT_DIR', default=(BASE_DIR / 'output'), cast=Path)
 WRDS_USERNAME = config("WRDS_USERNAME", default="")
 START_DATE = config("START_DATE", default="2022-07-01", cast=pd.to_datetime)
 END_DATE = config("END_DATE", default="2024-02-29", cast=pd.to_datetime)
+TRACE_WORKERS = config("TRACE_WORKERS", default=1, cast=int)
+TRACE_PUSHDOWN = config("TRACE_PUSHDOWN", default=True, cast=bool)
+TRACE_LOOKBACK_DAYS = config("TRACE_LOOKBACK_DAYS", default=30, cast=int)
+TRACE_BATCH_ROWS = config("TRACE_BATCH_ROWS", default=100_000, cast=int)
+TRACE_CHUNK_ROWS = config("TRACE_CHUNK_ROWS", default=2_000_000, cast=int)
+TRACE_CHUNK_CUSIPS = config("TRACE_CHUNK_CUSIPS", default=500, cast=int)
+WRDS_CACHE = config("WRDS_CACHE", default=False, cast=bool)
+WRDS_OFFLINE = config("WRDS_OFFLINE", default=False, cast=bool)
+WRDS_CACHE_TTL_DAYS = config("WRDS_CACHE_TTL_DAYS", default=30, cast=float)
+WRDS_CACHE_MAX_GB = config("WRDS_CACHE_MAX_GB", default=20, cast=float)
+WRDS_BACKEND = config("WRDS_BACKEND", default="wrds")
+WRDS_LOCAL_DIR = config("WRDS_LOCAL_DIR", default=(DATA_DIR / 'wrds_local'), cast=Path)
+TRACE_BACKEND = config("TRACE_BACKEND", default="pandas")
+TRACE_PREFETCH = config("TRACE_PREFETCH", default=0, cast=int)
+TRACE_FETCHERS = config("TRACE_FETCHERS", default=2, cast=int)
+TRACE_MEMORY_BUDGET_MB = config("TRACE_MEMORY_BUDGET_MB", default=4096, cast=float)
+TRACE_SPILL_DIR = config("TRACE_SPILL_DIR", default=(DATA_DIR / 'pulled' / 'trace_spill'), cast=Path)
+TRADING_CALENDAR = config("TRADING_CALENDAR", default="federal")
+SPREAD_BIAS_PARTITION_ROWS = config("SPREAD_BIAS_PARTITION_ROWS", default=0, cast=int)
+WINSORIZE_MODE = config("WINSORIZE_MODE", default="pooled")
+WINSORIZE_WORKERS = config("WINSORIZE_WORKERS", default=1, cast=int)
 
 if __name__ == "__main__":
     
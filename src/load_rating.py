@@ -16,6 +16,7 @@ import warnings
 warnings.filterwarnings("ignore")
 
 import config
+import wrds_cache
 from pathlib import Path
 OUTPUT_DIR = Path(config.OUTPUT_DIR)
 DATA_DIR = Path(config.DATA_DIR)
@@ -136,7 +137,7 @@ def concat_moody_sp(ratsp, ratsmd):
 
 if __name__ == "__main__":
 
-    db = wrds.Connection(wrds_username=WRDS_USERNAME)
+    db = wrds_cache.connect(wrds_username=WRDS_USERNAME)
 
     #* ************************************** */
     #* Download Mergent File                  */
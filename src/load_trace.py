@@ -12,798 +12,691 @@
 #* ************************************** */  
 import pandas as pd
 pd.options.mode.chained_assignment = None  # default='warn'
-import numpy as np
-import wrds
 from itertools import chain
 import datetime as dt
 import zipfile
 import csv
 import gzip
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import queue
+import threading
+from functools import partial
 import warnings
 warnings.filterwarnings("ignore")
 
 import config
+import trace_checkpoint
+import trace_clean
+import trace_plan
+import trace_polars
+import trace_profile
+import trace_query
+import trace_store
+import wrds_cache
 from pathlib import Path
 OUTPUT_DIR = Path(config.OUTPUT_DIR)
 DATA_DIR = Path(config.DATA_DIR)
 WRDS_USERNAME = config.WRDS_USERNAME
+TRACE_WORKERS = config.TRACE_WORKERS
+
+START_DATE = config.START_DATE
+END_DATE = config.END_DATE
+TRACE_PUSHDOWN = config.TRACE_PUSHDOWN
+TRACE_LOOKBACK_DAYS = config.TRACE_LOOKBACK_DAYS
+TRACE_BATCH_ROWS = config.TRACE_BATCH_ROWS
+TRACE_BACKEND = config.TRACE_BACKEND
+TRACE_PREFETCH = config.TRACE_PREFETCH
+TRACE_FETCHERS = config.TRACE_FETCHERS
+TRACE_MEMORY_BUDGET_MB = config.TRACE_MEMORY_BUDGET_MB
+
+# Cleaning backends, selected with --backend / TRACE_BACKEND
+CLEANERS = {'pandas': trace_clean,
+            'polars': trace_polars}
 
 #* ************************************** */
 #* Connect to WRDS                        */
 #* ************************************** */  
-db = wrds.Connection(wrds_username=WRDS_USERNAME)
+def connect_wrds():
+    '''
+    Open a new WRDS connection. Worker processes call this once each,
+    so it has to stay a module-level (picklable) function.
+    With WRDS_CACHE or WRDS_OFFLINE the query results are cached on disk
+    (see wrds_cache.py).
+    '''
+    return wrds_cache.connect(wrds_username=WRDS_USERNAME)
+
 
 #* ************************************** */
 #* Download Mergent File                  */
 #* ************************************** */  
-fisd_issuer = db.raw_sql("""SELECT issuer_id,country_domicile                 
-                  FROM fisd.fisd_mergedissuer 
-                  """)
-
-fisd_issue = db.raw_sql("""SELECT complete_cusip, issue_id,
-                  issuer_id, foreign_currency,
-                  coupon_type,coupon,convertible,
-                  asset_backed,rule_144a,
-                  bond_type,private_placement,
-                  interest_frequency,dated_date,
-                  day_count_basis,offering_date,
-                  offering_amt, maturity, principal_amt                
-                  FROM fisd.fisd_mergedissue  
-                  """)
-                  
-fisd = pd.merge(fisd_issue, fisd_issuer, on = ['issuer_id'], how = "left")                              
-#* ************************************** */
-#* Apply BBW Bond Filters                 */
-#* ************************************** */  
-#1: Discard all non-US Bonds (i) in BBW
-fisd = fisd[(fisd.country_domicile == 'USA')]
-
-#2.1: US FX
-fisd = fisd[(fisd.foreign_currency == 'N')]
-
-#3: Must have a fixed coupon
-fisd = fisd[(fisd.coupon_type != 'V')]
-
-#4: Discard ALL convertible bonds
-fisd = fisd[(fisd.convertible == 'N')]
-
-#5: Discard all asset-backed bonds
-fisd = fisd[(fisd.asset_backed == 'N')]
-
-#6: Discard all bonds under Rule 144A
-fisd = fisd[(fisd.rule_144a == 'N')]
-
-#7: Remove Agency bonds, Muni Bonds, Government Bonds, 
-mask_corp = ((fisd.bond_type != 'TXMU')&  (fisd.bond_type != 'CCOV') &  (fisd.bond_type != 'CPAS')\
-            &  (fisd.bond_type != 'MBS') &  (fisd.bond_type != 'FGOV')\
-            &  (fisd.bond_type != 'USTC')   &  (fisd.bond_type != 'USBD')\
-            &  (fisd.bond_type != 'USNT')  &  (fisd.bond_type != 'USSP')\
-            &  (fisd.bond_type != 'USSI') &  (fisd.bond_type != 'FGS')\
-            &  (fisd.bond_type != 'USBL') &  (fisd.bond_type != 'ABS')\
-            &  (fisd.bond_type != 'O30Y')\
-            &  (fisd.bond_type != 'O10Y') &  (fisd.bond_type != 'O3Y')\
-            &  (fisd.bond_type != 'O5Y') &  (fisd.bond_type != 'O4W')\
-            &  (fisd.bond_type != 'CCUR') &  (fisd.bond_type != 'O13W')\
-            &  (fisd.bond_type != 'O52W')\
-            &  (fisd.bond_type != 'O26W')\
-            # Remove all Agency backed / Agency bonds #
-            &  (fisd.bond_type != 'ADEB')\
-            &  (fisd.bond_type != 'AMTN')\
-            &  (fisd.bond_type != 'ASPZ')\
-            &  (fisd.bond_type != 'EMTN')\
-            &  (fisd.bond_type != 'ADNT')\
-            &  (fisd.bond_type != 'ARNT'))
-fisd = fisd[(mask_corp)]
-
-#8: No Private Placement
-fisd = fisd[(fisd.private_placement == 'N')]
-
-#9: Remove floating-rate, bi-monthly and unclassified coupons
-fisd = fisd[(fisd.interest_frequency != "-1") ]   # Unclassified by Mergent
-fisd = fisd[(fisd.interest_frequency != "13") ]   # Variable Coupon (V)
-fisd = fisd[(fisd.interest_frequency != "14") ]   # Bi-Monthly Coupon
-fisd = fisd[(fisd.interest_frequency != "16") ]   # Unclassified by Mergent
-fisd = fisd[(fisd.interest_frequency != "15") ]   # Unclassified by Mergent
-
-#10 Remove bonds lacking information for accrued interest (and hence returns)
-fisd['offering_date']            = pd.to_datetime(fisd['offering_date'], format='%Y-%m-%d')
-fisd['dated_date']               = pd.to_datetime(fisd['dated_date'],    format='%Y-%m-%d')
-fisd['maturity']               = pd.to_datetime(fisd['maturity'],        format='%Y-%m-%d')
-
-# 10.1 Dated date
-fisd = fisd[~fisd.dated_date.isnull()]
-# 10.2 Interest frequency
-fisd = fisd[~fisd.interest_frequency.isnull()]
-# 10.3 Day count basis
-fisd = fisd[~fisd.day_count_basis.isnull()]
-# 10.4 Offering date
-fisd = fisd[~fisd.offering_date.isnull()]
-# 10.5 Coupon type
-fisd = fisd[~fisd.coupon_type.isnull()]
-# 10.6 Coupon value
-fisd = fisd[~fisd.coupon.isnull()]
-
-# save fisd
-path = Path(DATA_DIR) / "pulled" / "fisd.csv"
-path.parent.mkdir(parents=True, exist_ok=True)
-fisd.to_csv(path, index=False)
+def load_fisd(db, pushdown=TRACE_PUSHDOWN):
+    '''
+    This function downloads the Mergent FISD issue and issuer tables
+    and applies the BBW bond filters.
+    With pushdown the filters are also applied by WRDS in the queries
+    (see trace_query.build_fisd_queries); the filters below then only
+    verify the pull.
+    '''
+    (issuer_sql, issuer_params), (issue_sql, issue_params) = trace_query.build_fisd_queries(pushdown)
 
-#* ************************************** */
-#* Ensure KPP Bonds are in the sample     */
-#* ************************************** */  
-# This ensures all CUSIPs from the paper,
-# "Reconciling TRACE bond returns", by
-# Bryan Kelly and Seth Pruitt are included.
-# The paper is here: 
-# https://sethpruitt.net/2022/03/29/reconciling-trace-bond-returns/
-IDs_KPP = pd.read_csv('.'/ Path(DATA_DIR) / "manual" / "cusips.csv")
-IDs_KPP.drop(['Unnamed: 0'], axis = 1, inplace = True)
-IDs_KPP.columns = ['complete_cusip']
+    fisd_issuer = db.raw_sql(issuer_sql, params=issuer_params or None)
 
+    fisd_issue = db.raw_sql(issue_sql, params=issue_params or None)
 
-#* ************************************** */
-#* Parse out bonds for processing         */
-#* ************************************** */           
-IDs = fisd[['complete_cusip']]
+    fisd = pd.merge(fisd_issue, fisd_issuer, on = ['issuer_id'], how = "left")                              
+    #* ************************************** */
+    #* Apply BBW Bond Filters                 */
+    #* ************************************** */  
+    #1: Discard all non-US Bonds (i) in BBW
+    fisd = fisd[(fisd.country_domicile == 'USA')]
+
+    #2.1: US FX
+    fisd = fisd[(fisd.foreign_currency == 'N')]
+
+    #3: Must have a fixed coupon
+    fisd = fisd[(fisd.coupon_type != 'V')]
+
+    #4: Discard ALL convertible bonds
+    fisd = fisd[(fisd.convertible == 'N')]
+
+    #5: Discard all asset-backed bonds
+    fisd = fisd[(fisd.asset_backed == 'N')]
+
+    #6: Discard all bonds under Rule 144A
+    fisd = fisd[(fisd.rule_144a == 'N')]
+
+    #7: Remove Agency bonds, Muni Bonds, Government Bonds, 
+    mask_corp = ((fisd.bond_type != 'TXMU')&  (fisd.bond_type != 'CCOV') &  (fisd.bond_type != 'CPAS')\
+                &  (fisd.bond_type != 'MBS') &  (fisd.bond_type != 'FGOV')\
+                &  (fisd.bond_type != 'USTC')   &  (fisd.bond_type != 'USBD')\
+                &  (fisd.bond_type != 'USNT')  &  (fisd.bond_type != 'USSP')\
+                &  (fisd.bond_type != 'USSI') &  (fisd.bond_type != 'FGS')\
+                &  (fisd.bond_type != 'USBL') &  (fisd.bond_type != 'ABS')\
+                &  (fisd.bond_type != 'O30Y')\
+                &  (fisd.bond_type != 'O10Y') &  (fisd.bond_type != 'O3Y')\
+                &  (fisd.bond_type != 'O5Y') &  (fisd.bond_type != 'O4W')\
+                &  (fisd.bond_type != 'CCUR') &  (fisd.bond_type != 'O13W')\
+                &  (fisd.bond_type != 'O52W')\
+                &  (fisd.bond_type != 'O26W')\
+                # Remove all Agency backed / Agency bonds #
+                &  (fisd.bond_type != 'ADEB')\
+                &  (fisd.bond_type != 'AMTN')\
+                &  (fisd.bond_type != 'ASPZ')\
+                &  (fisd.bond_type != 'EMTN')\
+                &  (fisd.bond_type != 'ADNT')\
+                &  (fisd.bond_type != 'ARNT'))
+    fisd = fisd[(mask_corp)]
+
+    #8: No Private Placement
+    fisd = fisd[(fisd.private_placement == 'N')]
+
+    #9: Remove floating-rate, bi-monthly and unclassified coupons
+    fisd = fisd[(fisd.interest_frequency != "-1") ]   # Unclassified by Mergent
+    fisd = fisd[(fisd.interest_frequency != "13") ]   # Variable Coupon (V)
+    fisd = fisd[(fisd.interest_frequency != "14") ]   # Bi-Monthly Coupon
+    fisd = fisd[(fisd.interest_frequency != "16") ]   # Unclassified by Mergent
+    fisd = fisd[(fisd.interest_frequency != "15") ]   # Unclassified by Mergent
+
+    #10 Remove bonds lacking information for accrued interest (and hence returns)
+    fisd['offering_date']            = pd.to_datetime(fisd['offering_date'], format='%Y-%m-%d')
+    fisd['dated_date']               = pd.to_datetime(fisd['dated_date'],    format='%Y-%m-%d')
+    fisd['maturity']               = pd.to_datetime(fisd['maturity'],        format='%Y-%m-%d')
+
+    # 10.1 Dated date
+    fisd = fisd[~fisd.dated_date.isnull()]
+    # 10.2 Interest frequency
+    fisd = fisd[~fisd.interest_frequency.isnull()]
+    # 10.3 Day count basis
+    fisd = fisd[~fisd.day_count_basis.isnull()]
+    # 10.4 Offering date
+    fisd = fisd[~fisd.offering_date.isnull()]
+    # 10.5 Coupon type
+    fisd = fisd[~fisd.coupon_type.isnull()]
+    # 10.6 Coupon value
+    fisd = fisd[~fisd.coupon.isnull()]
+
+    return fisd
 
-#* ************************************** */
-#* Ensure IDs unique                      */
-#* ************************************** */ 
-IDs = pd.concat([IDs, IDs_KPP], axis = 0)
-IDS = IDs.drop_duplicates(subset='complete_cusip')
 
 #* ************************************** */
 #* Break into chunks for WRDS             */
 #* ************************************** */  
-CUSIP_Sample = list( fisd['complete_cusip'].unique() )
 def divide_chunks(l, n): 	
 	# looping till length l 
 	for i in range(0, len(l), n): 
 		yield l[i:i + n] 
 
-cusip_chunks  = list(divide_chunks(CUSIP_Sample, 500)) 
 
-    
+def stream_rows(db, sql, params=None, batch_size=TRACE_BATCH_ROWS):
+    '''
+    This function yields the result of a query as DataFrames of at most
+    batch_size rows. On a WRDS connection the rows are fetched through a
+    server-side (named) cursor, so the client only ever holds one batch.
+    Connections without an SQLAlchemy connection (the local stand-ins in
+    the tests) return the full result, which is then split into batches.
+    At least one, possibly empty, batch is always yielded.
+    '''
+    connection = getattr(db, 'connection', None)
+    if connection is None:
+        frame = db.raw_sql(sql, params=params)
+        for start in range(0, max(len(frame), 1), batch_size):
+            yield frame.iloc[start:start + batch_size]
+        return
+
+    # WITH HOLD lets the named cursor live outside a transaction, as the
+    # WRDS connection runs in autocommit mode
+    cursor = connection.connection.cursor(name='trace_stream', withhold=True)
+    cursor.itersize = batch_size
+    try:
+        cursor.execute(sql, params)
+        columns = [column[0] for column in cursor.description]
+        rows = cursor.fetchmany(batch_size)
+        yield pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+        while rows:
+            rows = cursor.fetchmany(batch_size)
+            if rows:
+                yield pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+    finally:
+        cursor.close()
+
+
+def read_trace(db, sql, params=None, start_date=None, end_date=None, days=None, batch_size=TRACE_BATCH_ROWS,
+               profile=trace_profile.NO_PROFILE, backend=TRACE_BACKEND):
+    '''
+    This function streams the rows of a trace_enhanced query in batches
+    and applies the row-local filters of trace_clean.filter_rows to each
+    batch as it arrives, so memory is bounded by the surviving rows rather
+    than by the size of the pull. With days (a (cusip_id, trd_exctn_dt)
+    MultiIndex) only the records of those bond-days are kept. The time spent
+    waiting for batches is recorded in `profile` as the fetch stage.
+    With backend 'polars' the surviving rows are a polars DataFrame.
+    Output: trace (the surviving rows), n_pre (rows pulled), n_post_bbw
+    '''
+    cleaner = CLEANERS[backend]
+    batches, n_pre, n_post_bbw = [], 0, 0
+    for batch in profile.iterate('fetch', stream_rows(db, sql, params, batch_size)):
+        if days is not None:
+            batch = batch[pd.MultiIndex.from_arrays([batch['cusip_id'],
+                                                     pd.to_datetime(batch['trd_exctn_dt'])]).isin(days)]
+        n_pre += len(batch)
+        batch, n = cleaner.filter_rows(batch, start_date, end_date, profile=profile)
+        n_post_bbw += n
+        batches.append(batch)
+    return profile.run('concat', cleaner.concat_trace, batches), n_pre, n_post_bbw
+
+
+def fetch_chunk(db, cusips, start_date=None, end_date=None, pushdown=TRACE_PUSHDOWN,
+                profile=trace_profile.NO_PROFILE, backend=TRACE_BACKEND):
+    '''
+    This function streams and filters the trace_enhanced rows of one chunk
+    of CUSIPs from `db` (see read_trace), the part of process_chunk that
+    waits on the connection. The cleaning statistics and the MIN_OBS rule
+    count the rows before the filters, so with pushdown both counts come
+    from a COUNT query instead of the filtered pull.
+    Output: trace, n_pre, n_post_bbw, watermark
+    '''
+    sql, params = trace_query.build_trace_query(cusips, start_date, end_date, pushdown)
+    trace, n_pre, n_post_bbw = read_trace(db, sql, params, start_date, end_date, profile=profile, backend=backend)
+    watermark = pd.Timestamp(trace['trd_rpt_dt'].max()) if len(trace) else None
+
+    if pushdown:
+        sql, params = trace_query.build_count_query(cusips, start_date, end_date)
+        counts = profile.run('count_query', db.raw_sql, sql, params=params)
+        n_pre, n_post_bbw = int(counts['n'].iloc[0]), int(counts['n_post_bbw'].iloc[0])
+    return trace, n_pre, n_post_bbw, watermark
+
+
+def clean_fetched(fetched, profile=trace_profile.NO_PROFILE, backend=TRACE_BACKEND,
+                  memory_budget_mb=TRACE_MEMORY_BUDGET_MB):
+    '''
+    This function cleans the rows returned by fetch_chunk with the
+    clean_filtered of the backend and adds the stage records of profile
+    to the statistics as 'stages'. A chunk whose daily aggregation would
+    take more than memory_budget_mb is aggregated through temporary
+    date partitions (trace_spill.py).
+    '''
+    trace, n_pre, n_post_bbw, _ = fetched
+    result = CLEANERS[backend].clean_filtered(trace, n_pre, n_post_bbw, profile=profile,
+                                              memory_budget_mb=memory_budget_mb)
+    result[3]['stages'] = profile.records()
+    return result
+
+
+def process_chunk(db, cusips, checkpoint_dir=None, start_date=None, end_date=None, pushdown=TRACE_PUSHDOWN,
+                  profile_memory=False, backend=TRACE_BACKEND, memory_budget_mb=TRACE_MEMORY_BUDGET_MB):
+    '''
+    This function streams the trace_enhanced rows of one chunk of CUSIPs
+    from `db` (fetch_chunk) and cleans them with trace_clean.clean_filtered
+    (clean_fetched). Only trades executed between start_date and end_date
+    are kept. With pushdown the volume and pre 2012 filters also run in the
+    query. With a checkpoint_dir the result is persisted as soon as the
+    chunk is done.
+    The stage records of trace_profile are added to the statistics as
+    'stages' (with profile_memory, the traced peak memory of each stage too).
+    backend selects the cleaning code, trace_clean ('pandas') or
+    trace_polars ('polars'); both return the same outputs.
+    '''
+    profile = trace_profile.StageProfile(track_memory=profile_memory)
+
+    #* ************************************** */
+    #* Load data from WRDS per chunk          */
+    #* ************************************** */
+    fetched = fetch_chunk(db, cusips, start_date, end_date, pushdown, profile=profile, backend=backend)
+    result = clean_fetched(fetched, profile=profile, backend=backend, memory_budget_mb=memory_budget_mb)
+
+    if checkpoint_dir is not None:
+        trace_checkpoint.save_chunk(result, cusips, start_date, end_date, checkpoint_dir=checkpoint_dir,
+                                    watermark=fetched[3])
+
+    return result
+
+
+def update_chunk(db, cusips, checkpoint_dir, start_date=None, end_date=None, pushdown=TRACE_PUSHDOWN,
+                 lookback_days=TRACE_LOOKBACK_DAYS, profile_memory=False, backend=TRACE_BACKEND,
+                 memory_budget_mb=TRACE_MEMORY_BUDGET_MB):
+    '''
+    This function refreshes a checkpointed chunk incrementally. It finds the
+    bond-days with records reported since the chunk's watermark, less
+    lookback_days for late cancellations, corrections and reversals, pulls
+    all records of those bond-days, cleans them and upserts their daily rows
+    into the partition. The cleaning only matches records within a bond-day,
+    so the partition ends up as a full pull would have left it.
+    A chunk without a watermark, or one that had too few observations to be
+    cleaned (chunks are only cleaned as a whole), is pulled in full.
+    The stages of the refresh replace those in the statistics.
+    '''
+    manifest = trace_checkpoint.load_manifest(cusips, start_date, end_date, checkpoint_dir)
+    if manifest is None or manifest['watermark'] is None or not manifest['outputs']:
+        return process_chunk(db, cusips, checkpoint_dir, start_date, end_date, pushdown, profile_memory, backend,
+                             memory_budget_mb)
+
+    profile = trace_profile.StageProfile(track_memory=profile_memory)
+    watermark = manifest['watermark']
+    since = watermark - pd.Timedelta(days=lookback_days)
+    sql, params = trace_query.build_affected_days_query(cusips, since, start_date, end_date)
+    affected = profile.run('affected_days_query', db.raw_sql, sql, params=params)
+    if affected.empty:
+        *frames, stats = trace_checkpoint.load_chunk(cusips, start_date, end_date, checkpoint_dir)
+        return (*frames, {**stats, 'stages': profile.records()})
+
+    days = pd.MultiIndex.from_arrays([affected['cusip_id'].astype(object),
+                                      pd.to_datetime(affected['trd_exctn_dt'])],
+                                     names=['cusip_id', 'trd_exctn_dt'])
+
+    # the pull covers every CUSIP on the affected dates, keep the affected bond-days
+    sql, params = trace_query.build_trace_query(cusips, start_date, end_date, pushdown,
+                                                exctn_dates=days.get_level_values('trd_exctn_dt').unique())
+    trace, n_pre, n_post_bbw = read_trace(db, sql, params, start_date, end_date, days=days, profile=profile,
+                                          backend=backend)
+
+    result = CLEANERS[backend].clean_filtered(trace, n_pre, n_post_bbw, min_obs=0, profile=profile,
+                                              memory_budget_mb=memory_budget_mb)
+    watermark = max(watermark, pd.to_datetime(affected['trd_rpt_dt']).max())
+    *frames, stats = profile.run('upsert', trace_checkpoint.upsert_chunk, result, days, cusips,
+                                 start_date, end_date, checkpoint_dir, watermark=watermark)
+    return (*frames, {**stats, 'stages': profile.records()})
+
+
+#* ************************************** */
+#* Worker pool                            */
+#* ************************************** */
+# Each worker process holds its own connection, opened once by the
+# initializer and reused for every chunk the worker is handed.
+_worker_db = None
+
+def _init_worker(connect):
+    global _worker_db
+    _worker_db = connect()
+
+
+def _process_chunk_in_worker(chunk, incremental=False, **kwargs):
+    cusips, start_date, end_date = chunk
+    if incremental:
+        return update_chunk(_worker_db, cusips, start_date=start_date, end_date=end_date, **kwargs)
+    return process_chunk(_worker_db, cusips, start_date=start_date, end_date=end_date, **kwargs)
+
+
 #* ************************************** */
-#* Pre-allocate for Cleaning Statistics   */
-#* ************************************** */ 
-CleaningExport   = pd.DataFrame( index   = range(0,len(cusip_chunks)),
-                               columns = ['Obs.Pre',
-                                          'Obs.PostBBW',
-                                          'Obs.PostDickNielsen'])
+#* Prefetching pipeline                   */
 #* ************************************** */
-#* Iterate over the chunks                */
-#* ************************************** */ 
-
-price_super_list       = []
-volume_super_list      = []
-illiquidity_super_list = []
-
-for i in range(0,len(cusip_chunks)):  
-    print(i)
-    tempList = cusip_chunks[i]    
-    tempTuple = tuple(tempList)
-    parm = {'cusip_id': (tempTuple)}
-    
+# End of a fetcher's or the writer's work in their queues
+_DONE = object()
+
+def _put(q, item, stop):
+    '''
+    This function puts item into the bounded queue q, waiting while it is
+    full (the backpressure of the pipeline), unless the run is stopped.
+    Output: whether the item was put
+    '''
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def run_pipeline(chunks, todo=None, connect=connect_wrds, prefetch=TRACE_PREFETCH, fetchers=TRACE_FETCHERS,
+                 checkpoint_dir=None, pushdown=TRACE_PUSHDOWN, backend=TRACE_BACKEND,
+                 memory_budget_mb=TRACE_MEMORY_BUDGET_MB):
+    '''
+    This function runs process_chunk on the chunks in `todo` (indices into
+    chunks, a list of (cusips, start_date, end_date)) as a pipeline, so the
+    cleaning does not wait on the network and the network not on the cleaning:
+    1. `fetchers` threads, each with its own connection from `connect`,
+       pull and filter the chunks in order (fetch_chunk) into a queue that
+       holds at most `prefetch` chunks; a fetcher waits while it is full
+    2. this thread cleans the fetched chunks as they come in (clean_fetched)
+    3. with a checkpoint_dir a writer thread saves the cleaned chunks,
+       at most `prefetch` of them waiting to be written
+    So at most prefetch + fetchers raw chunks are in memory at once. Chunks
+    are cleaned in the order they finish fetching. The first error of any
+    thread stops the pipeline and is raised here. The stages are timed but
+    their memory is not traced, as the threads would reset each other's
+    tracemalloc peak (trace the whole run with trace_profile.ProcessPeak).
+    Output: dict of the result of every chunk in todo, by index
+    '''
+    if prefetch < 1 or fetchers < 1:
+        raise ValueError('the pipeline needs prefetch >= 1 and fetchers >= 1')
+    todo = range(len(chunks)) if todo is None else todo
+    tasks = queue.Queue()
+    for i in todo:
+        tasks.put(i)
+    fetched = queue.Queue(maxsize=prefetch)
+    finished = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    errors = []
+
+    def fetch():
+        try:
+            db = connect()
+            while not stop.is_set():
+                try:
+                    i = tasks.get_nowait()
+                except queue.Empty:
+                    break
+                cusips, start, end = chunks[i]
+                profile = trace_profile.StageProfile()
+                chunk = fetch_chunk(db, cusips, start, end, pushdown, profile=profile, backend=backend)
+                if not _put(fetched, (i, profile, chunk), stop):
+                    break
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            _put(fetched, _DONE, stop)
+
+    def write():
+        try:
+            while True:
+                try:
+                    item = finished.get(timeout=0.1)
+                except queue.Empty:
+                    # after an error the chunks already cleaned are still written
+                    if stop.is_set():
+                        return
+                    continue
+                if item is _DONE:
+                    return
+                i, result, watermark = item
+                trace_checkpoint.save_chunk(result, *chunks[i], checkpoint_dir=checkpoint_dir, watermark=watermark)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    threads = [threading.Thread(target=fetch, name=f'trace-fetch-{n}', daemon=True) for n in range(fetchers)]
+    writer = threading.Thread(target=write, name='trace-write', daemon=True)
+    if checkpoint_dir is not None:
+        threads.append(writer)
+    for thread in threads:
+        thread.start()
+
+    results = {}
+    try:
+        running = fetchers
+        while running and not stop.is_set():
+            try:
+                item = fetched.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                running -= 1
+                continue
+            i, profile, chunk = item
+            print(i)
+            results[i] = clean_fetched(chunk, profile=profile, backend=backend, memory_budget_mb=memory_budget_mb)
+            watermark = chunk[3]
+            # drop the raw rows before waiting for the next chunk
+            del item, chunk
+            if checkpoint_dir is not None:
+                _put(finished, (i, results[i], watermark), stop)
+    finally:
+        if checkpoint_dir is not None:
+            _put(finished, _DONE, stop)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return results
+
+
+def run_chunks(cusip_chunks, connect=connect_wrds, workers=1, checkpoint_dir=None,
+               start_date=None, end_date=None, pushdown=TRACE_PUSHDOWN,
+               incremental=False, lookback_days=TRACE_LOOKBACK_DAYS, chunk_windows=None,
+               report_path=None, profile_memory=False, backend=TRACE_BACKEND,
+               prefetch=TRACE_PREFETCH, fetchers=TRACE_FETCHERS, memory_budget_mb=TRACE_MEMORY_BUDGET_MB):
+    '''
+    This function processes every chunk of CUSIPs and gathers the results.
+    With workers > 1 the chunks run concurrently in a process pool where each
+    worker opens its own connection with `connect`. Results are always
+    gathered in chunk order, so the output does not depend on `workers`.
+    With a checkpoint_dir, chunks that already have a finished partition are
+    skipped and their results are read back from disk. The date range is
+    part of the checkpoint key, so a run over another window never reuses them.
+    With incremental, every chunk is refreshed with update_chunk instead
+    (chunks without a partition are pulled in full).
+    chunk_windows gives every chunk its own (start_date, end_date), as
+    planned by trace_plan.plan_chunks; by default all chunks use the
+    start_date and end_date of the run.
+    With a report_path the cleaning statistics and stage timings of every
+    chunk are written to a JSON run report (trace_profile.write_report).
+    With profile_memory it holds the traced peak memory of every stage, or
+    of the whole run for the pipeline, whose stages overlap on several threads.
+    backend is the cleaning backend of process_chunk and memory_budget_mb
+    the memory above which its daily aggregation spills to disk.
+    With prefetch > 0 a full pull in one process (workers 1) runs as the
+    pipeline of run_pipeline: `fetchers` threads keep up to `prefetch`
+    chunks pulled ahead while the current one is cleaned.
+    Output: price_super_list, volume_super_list, illiquidity_super_list, CleaningExport
+    '''
+    if incremental and checkpoint_dir is None:
+        raise ValueError('the incremental mode updates checkpoints and needs a checkpoint_dir')
+    if chunk_windows is None:
+        chunk_windows = [(start_date, end_date)] * len(cusip_chunks)
+    chunks = [(cusips, start, end) for cusips, (start, end) in zip(cusip_chunks, chunk_windows)]
+
+    if checkpoint_dir is None or incremental:
+        todo = list(range(0,len(cusip_chunks)))
+    else:
+        todo = [i for i in range(0,len(cusip_chunks))
+                if not trace_checkpoint.is_chunk_done(*chunks[i], checkpoint_dir=checkpoint_dir)]
+        print(f'{len(cusip_chunks) - len(todo)} of {len(cusip_chunks)} chunks already checkpointed')
+
+    chunk_args = {'checkpoint_dir': checkpoint_dir, 'pushdown': pushdown, 'profile_memory': profile_memory,
+                  'backend': backend, 'memory_budget_mb': memory_budget_mb}
+    if incremental:
+        chunk_args['lookback_days'] = lookback_days
+    run_chunk = update_chunk if incremental else process_chunk
+    results = {}
+    memory_scope, peak_mb = ('stage' if profile_memory else None), None
+    if workers <= 1 and prefetch > 0 and not incremental:
+        pipeline_args = {key: value for key, value in chunk_args.items() if key != 'profile_memory'}
+        with trace_profile.ProcessPeak(track_memory=profile_memory) as process_peak:
+            results = run_pipeline(chunks, todo, connect, prefetch, fetchers, **pipeline_args)
+        if profile_memory:
+            memory_scope, peak_mb = 'process', process_peak.peak_mb
+    elif workers <= 1:
+        if todo:
+            db = connect()
+        for i in todo:
+            print(i)
+            cusips, start, end = chunks[i]
+            results[i] = run_chunk(db, cusips, start_date=start, end_date=end, **chunk_args)
+    else:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(connect,)) as executor:
+            # executor.map yields in submission order
+            worker = partial(_process_chunk_in_worker, incremental=incremental, **chunk_args)
+            for i, result in zip(todo, executor.map(worker, [chunks[i] for i in todo])):
+                print(i)
+                results[i] = result
+
+    # Chunks finished by an earlier run are merged back from their partitions
+    results = [results[i] if i in results
+               else trace_checkpoint.load_chunk(*chunks[i], checkpoint_dir=checkpoint_dir)
+               for i in range(0,len(cusip_chunks))]
+
     #* ************************************** */
-    #* Load data from WRDS per chunk          */
+    #* Cleaning Statistics                    */
+    #* ************************************** */
+    if report_path is not None:
+        trace_profile.write_report(chunks, [stats for *_, stats in results], path=report_path,
+                                   memory_scope=memory_scope, peak_mb=peak_mb)
+    CleaningExport = pd.DataFrame([stats for *_, stats in results],
+                                  index   = range(0,len(cusip_chunks)),
+                                  columns = trace_clean.CLEANING_COLUMNS)
+
+    price_super_list       = [prices  for prices, _, _, _ in results if prices is not None]
+    volume_super_list      = [volumes for _, volumes, _, _ in results if volumes is not None]
+    illiquidity_super_list = [illiq   for _, _, illiq, _ in results if illiq is not None]
+
+    return price_super_list, volume_super_list, illiquidity_super_list, CleaningExport
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Pull and clean TRACE Enhanced from WRDS.')
+    parser.add_argument('--workers', type=int, default=TRACE_WORKERS,
+                        help='number of chunks processed concurrently (default: TRACE_WORKERS)')
+    parser.add_argument('--checkpoint-dir', type=Path, default=trace_checkpoint.CHECKPOINT_DIR,
+                        help='directory of the per-chunk partitions used to resume a run')
+    parser.add_argument('--no-checkpoint', action='store_true',
+                        help='keep all chunks in memory and do not write partitions')
+    parser.add_argument('--no-pushdown', dest='pushdown', action='store_false', default=TRACE_PUSHDOWN,
+                        help='pull unfiltered rows and only filter client-side, to verify the pushed-down pull')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only pull the bond-days reported since the last run and update the checkpoints')
+    parser.add_argument('--lookback-days', type=int, default=TRACE_LOOKBACK_DAYS,
+                        help='days before the watermark pulled again for late cancels and reversals')
+    parser.add_argument('--chunk-rows', type=int, default=trace_plan.TRACE_CHUNK_ROWS,
+                        help='row budget of a planned chunk (default: TRACE_CHUNK_ROWS)')
+    parser.add_argument('--refresh-counts', action='store_true',
+                        help='count the rows of every CUSIP again instead of using the cached statistics')
+    parser.add_argument('--equal-chunks', action='store_true',
+                        help='split the CUSIPs into chunks of 500 instead of planning chunks by row count')
+    parser.add_argument('--report', type=Path, default=trace_profile.REPORT_PATH,
+                        help='JSON run report with the cleaning statistics and stage timings of every chunk')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='also trace the peak memory of every stage, or of the whole run with '
+                             '--prefetch (slows the cleaning down)')
+    parser.add_argument('--backend', choices=sorted(CLEANERS), default=TRACE_BACKEND,
+                        help='cleaning code: eager pandas (trace_clean) or a lazy polars query (trace_polars)')
+    parser.add_argument('--prefetch', type=int, default=TRACE_PREFETCH,
+                        help='chunks pulled ahead while one is cleaned, 0 to pull and clean in turn')
+    parser.add_argument('--fetchers', type=int, default=TRACE_FETCHERS,
+                        help='threads (and connections) pulling chunks ahead with --prefetch')
+    parser.add_argument('--memory-budget-mb', type=float, default=TRACE_MEMORY_BUDGET_MB,
+                        help='memory of the daily aggregation above which it runs by date partition on disk '
+                             '(0: never)')
+    args = parser.parse_args()
+
+    db = connect_wrds()
+    fisd = load_fisd(db, pushdown=args.pushdown)
+    db.close()
+
+    # save fisd
+    path = Path(DATA_DIR) / "pulled" / "fisd.csv"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fisd.to_csv(path, index=False)
+
+    #* ************************************** */
+    #* Ensure KPP Bonds are in the sample     */
+    #* ************************************** */  
+    # This ensures all CUSIPs from the paper,
+    # "Reconciling TRACE bond returns", by
+    # Bryan Kelly and Seth Pruitt are included.
+    # The paper is here: 
+    # https://sethpruitt.net/2022/03/29/reconciling-trace-bond-returns/
+    IDs_KPP = pd.read_csv('.'/ Path(DATA_DIR) / "manual" / "cusips.csv")
+    IDs_KPP.drop(['Unnamed: 0'], axis = 1, inplace = True)
+    IDs_KPP.columns = ['complete_cusip']
+
+
+    #* ************************************** */
+    #* Parse out bonds for processing         */
+    #* ************************************** */           
+    IDs = fisd[['complete_cusip']]
+
+    #* ************************************** */
+    #* Ensure IDs unique                      */
     #* ************************************** */ 
-        
-    trace = db.raw_sql('SELECT cusip_id,bond_sym_id,trd_exctn_dt,trd_exctn_tm,days_to_sttl_ct,lckd_in_ind,wis_fl,sale_cndtn_cd,msg_seq_nb, trc_st, trd_rpt_dt,trd_rpt_tm, entrd_vol_qt, rptd_pr,yld_pt,asof_cd,orig_msg_seq_nb,rpt_side_cd,cntra_mp_id FROM trace.trace_enhanced WHERE cusip_id in %(cusip_id)s', 
-                  params=parm)
-           
-    CleaningExport['Obs.Pre'].iloc[i] = int(len(trace))
-    
-    #### Basically try-catch --> ensure >100 obs in the pulled data, handles
-    #### edge cases where there is not any data     
-    if len(trace) <= 100:
-        CleaningExport['Obs.PostBBW'].iloc[i] = int(len(trace))
-        CleaningExport['Obs.PostDickNielsen'].iloc[i] = int(len(trace))
-        continue
+    IDs = pd.concat([IDs, IDs_KPP], axis = 0)
+    IDS = IDs.drop_duplicates(subset='complete_cusip')
+
+    #* ************************************** */
+    #* Break into chunks for WRDS             */
+    #* ************************************** */  
+    CUSIP_Sample = list( fisd['complete_cusip'].unique() )
+    if args.equal_chunks:
+        cusip_chunks  = list(divide_chunks(CUSIP_Sample, 500))
+        chunk_windows = None
     else:
-        
-        # Convert dates to datetime        
-        trace['trd_exctn_dt']         = pd.to_datetime(trace['trd_exctn_dt'], format = '%Y-%m-%d')
-        trace['trd_rpt_dt']           = pd.to_datetime(trace['trd_rpt_dt'],   format = '%Y-%m-%d')         
-               
-        #* ************************************ */
-        #* Variable Handling                    */
-        #* ************************************ */
-        # Convert Settlement indicator to string     
-        trace['days_to_sttl_ct'] = trace['days_to_sttl_ct'].astype('str')                   
-        
-        # Convert when-issued indicator to string    
-        trace['wis_fl'] = trace['wis_fl'].astype('str')     
-        
-        # Convert locked-in indicator to string    
-        trace['lckd_in_ind'] = trace['lckd_in_ind'].astype('str') 
-        
-        # Convert sale condition indicator to string    
-        trace['sale_cndtn_cd'] = trace['sale_cndtn_cd'].astype('str') 
-                                                  
-        # Remove trades with volume < $10,000
-        trace = trace[ (trace['entrd_vol_qt']) >= 10000  ]      
-                        
-        CleaningExport['Obs.PostBBW'].iloc[i] = int(len(trace))                                                                                          
-    
-        #* ************************************ */
-        #* 1.0 Parsing out Post 2012/02/06 Data */
-        #* ************************************ */              
-        post= trace[(trace['cusip_id'] != '') & (trace['trd_rpt_dt'] >="2012-02-06")]
-        pre = trace[(trace['cusip_id'] != '') & (trace['trd_rpt_dt'] < "2012-02-06")]   
-        
-        #* ************************************** */
-        #* 1.1 Remove Cancellation and Correction */
-        #* ************************************** */        
-        
-        # * Match Cancellation and Correction using following 7 keys:
-        # * Cusip_id, Execution Date and Time, Quantity, Price, Buy/Sell Indicator, Contra Party
-        # * C and X records show the same MSG_SEQ_NB as the original record;
-                
-        post_tr = post[(post['trc_st'] == 'T') | (post['trc_st'] == 'R')]       
-        post_xc = post[(post['trc_st'] == 'X') | (post['trc_st'] == 'C')]       
-        post_y  = post[(post['trc_st'] == 'Y')]      
-        
-        _clean_post1 = pd.merge(post_tr.drop_duplicates(), post_xc[[
-                          'cusip_id',        # 1
-                          'trd_exctn_dt',    # 2
-                          'trd_exctn_tm',    # 3
-                          'rptd_pr',         # 4
-                          'entrd_vol_qt',    # 5
-                          'rpt_side_cd',     # 6
-                          'cntra_mp_id',     # 7
-                          'msg_seq_nb',      # 8
-                          'trc_st']],    
-                           left_on=[
-                              'cusip_id',        # 1
-                              'trd_exctn_dt',    # 2
-                              'trd_exctn_tm',    # 3
-                              'rptd_pr',         # 4
-                              'entrd_vol_qt',    # 5
-                              'rpt_side_cd',     # 6
-                              'cntra_mp_id',     # 7
-                              'msg_seq_nb'],     # 8
-                                          right_on=[ 
-                                         'cusip_id',          # 1
-                                           'trd_exctn_dt',    # 2
-                                           'trd_exctn_tm',    # 3
-                                           'rptd_pr',         # 4
-                                           'entrd_vol_qt',    # 5
-                                           'rpt_side_cd',     # 6
-                                           'cntra_mp_id',     # 7
-                                           'msg_seq_nb'],     # 8                       
-                        how = "left")
-                             
-        # Remove the matched "Trade Report" observations;
-        clean_post1 = _clean_post1[_clean_post1['trc_st_y'].isnull()]
-                        
-        # Clean-up clean_post1#
-        clean_post1.drop(['trc_st_y'], axis = 1, inplace = True)
-        clean_post1.rename(columns={'trc_st_x':'trc_st'}, inplace=True) 
-                
-        #* ******************** */
-        #* 1.2 Remove Reversals */
-        #* ******************** */
-
-        # * Match Reversal using the same 7 keys:
-        # * Cusip_id, Execution Date and Time, Quantity, Price, Buy/Sell Indicator, Contra Party
-        # * R records show ORIG_MSG_SEQ_NB matching orignal record MSG_SEQ_NB;
-        _clean_post2 = pd.merge(_clean_post1.drop_duplicates(), post_y[[
-                          'cusip_id',        # 1
-                          'trd_exctn_dt',    # 2
-                          'trd_exctn_tm',    # 3
-                          'rptd_pr',         # 4
-                          'entrd_vol_qt',    # 5
-                          'rpt_side_cd',     # 6
-                          'cntra_mp_id',     # 7
-                          'orig_msg_seq_nb', # 8
-                          'trc_st']],    
-                           left_on=[
-                              'cusip_id',        # 1
-                              'trd_exctn_dt',    # 2
-                              'trd_exctn_tm',    # 3
-                              'rptd_pr',         # 4
-                              'entrd_vol_qt',    # 5
-                              'rpt_side_cd',     # 6
-                              'cntra_mp_id',     # 7
-                              'msg_seq_nb'],     # 8
-                                          right_on=[ 
-                                         'cusip_id',          # 1
-                                           'trd_exctn_dt',    # 2
-                                           'trd_exctn_tm',    # 3
-                                           'rptd_pr',         # 4
-                                           'entrd_vol_qt',    # 5
-                                           'rpt_side_cd',     # 6
-                                           'cntra_mp_id',     # 7
-                                           'orig_msg_seq_nb'],# 8                       
-                        how = "left")
-                             
-        # Remove the matched "Trade Report" observations;
-        clean_post2 = _clean_post2[_clean_post2['trc_st_y'].isnull()].drop_duplicates()
-                        
-        # Clean-up clean_post1#
-        clean_post2.drop(['orig_msg_seq_nb_y','trc_st_y','trc_st'], axis = 1, inplace = True)
-        clean_post2.rename(columns={'orig_msg_seq_nb_x':'orig_msg_seq_nb',
-                                    'trc_st_x':'trc_st'}, inplace=True) 
-              
-        #* ********************************* */
-        #* Pre 2012-02-06 Data               */
-        #* ********************************* */
-        
-        #* ************************************ */
-        #*  van Binsbergen, Nozawa, and Schwert */
-        #*  We restrict the bond transactions in */
-        #*  our sample by removing those that are */
-        #*  whenissued, have special conditions, are  */
-        #*  locked in, and have days-to-settlement  */
-        #*  of more than two */
-        #*  days in the pre-2012 database */
-        #* ************************************ */     
-                
-        # Remove trades with > 2-days to settlement #
-        # Keep all with days_to_sttl_ct equal to None, 000, 001 or 002
-        pre = pre[   (pre['days_to_sttl_ct'] == '002') | (pre['days_to_sttl_ct'] == '000')\
-                  | (pre['days_to_sttl_ct']  == '001') | (pre['days_to_sttl_ct'] == 'None') ]
-        
-        # Remove when-issued indicator #
-        pre = pre[  (pre['wis_fl'] != 'Y')        ]  
-
-        # Remove locked-in indicator #
-        pre = pre[  (pre['lckd_in_ind'] != 'Y')   ]
-        
-        # Remove trades with special conditions #
-        pre = pre[  (pre['sale_cndtn_cd'] == 'None') | (pre['sale_cndtn_cd'] == '@')   ]
-                    
-        #* ********************************* */
-        #* 2.1 Remove Cancellation Cases (C) */
-        #* ********************************* */
-        pre_c = pre[pre['trc_st'] == 'C']       
-        pre_w = pre[pre['trc_st'] == 'W']       
-        pre_t = pre[pre['trc_st'] == 'T']        
-        
-        # Match Cancellation by the 7 keys:
-        # Cusip_ID, Execution Date and Time, Quantity, Price, Buy/Sell Indicator, Contra Party
-        # C records show ORIG_MSG_SEQ_NB matching orignal record MSG_SEQ_NB;
-        merged = pd.merge(pre_t.drop_duplicates(), pre_c[[
-                          'cusip_id',
-                          'trd_exctn_dt',
-                          'trd_exctn_tm',
-                          'rptd_pr',
-                          'entrd_vol_qt',
-                          'trd_rpt_dt',
-                          'orig_msg_seq_nb',
-                          'trc_st']],
-                           left_on=[        'cusip_id', 
-                                            'trd_exctn_dt', 
-                                            'trd_exctn_tm', 
-                                            'rptd_pr', 
-                                            'entrd_vol_qt', 
-                                            'trd_rpt_dt', 
-                                            'msg_seq_nb'], # msg
-                                          right_on=['cusip_id', 
-                                            'trd_exctn_dt', 
-                                            'trd_exctn_tm', 
-                                            'rptd_pr', 
-                                            'entrd_vol_qt', 
-                                            'trd_rpt_dt', 
-                                            'orig_msg_seq_nb']  ,  # orig_msg                      
-                        how = "left")
-        
-        
-        merged = merged.drop_duplicates()
-        
-        # Filter out C cases
-        _del_c     = merged[merged['trc_st_y'] == 'C']
-        clean_pre1 = merged[merged['trc_st_y'] != 'C']
-        
-        # Clean-up clean_pre1#
-        clean_pre1.drop(['orig_msg_seq_nb_y', 'trc_st_y'], axis = 1, inplace = True)
-        clean_pre1.rename(columns={'trc_st_x':'trc_st',
-                                   'orig_msg_seq_nb_x':'orig_msg_seq_nb'}, inplace=True) 
-        
-        #* ******************************* */
-        #* 2.2 Remove Correction Cases (W) */
-        #* ******************************* */
-        
-        # * NOTE: on a given day, a bond can have more than one round of correction
-        # * One W to correct an older W, which then corrects the original T
-        # * Before joining back to the T data, first need to clean out the W to
-        # * handle the situation described above;
-        # * The following section handles the chain of W cases;
-        
-        # 2.2.1 Sort out all msg_seq_nb;
-        w_msg = pre_w[['cusip_id', 'bond_sym_id', 'trd_exctn_dt', 'trd_exctn_tm', 'msg_seq_nb']]
-        w_msg['flag'] = 'msg'
-        
-        # 2.2.1 Sort out all mapped original msg_seq_nb;
-        w_omsg = pre_w[['cusip_id', 'bond_sym_id', 'trd_exctn_dt', 'trd_exctn_tm', 'orig_msg_seq_nb']]
-        w_omsg = w_omsg.rename(columns={'orig_msg_seq_nb': 'msg_seq_nb'})
-        w_omsg['flag'] = 'omsg'
-        
-        w = pd.concat([w_omsg, w_msg])
-        
-        # 2.2.2 Count the number of appearance (napp) of a msg_seq_nb: 
-        w_napp = w.groupby(['cusip_id', 
-                            'bond_sym_id', 
-                            'trd_exctn_dt', 
-                            'trd_exctn_tm', 
-                            'msg_seq_nb']).size().reset_index(name='napp')
-        
-        # * 2.2.3 Check whether one msg_seq_nb is associated with both msg and orig_msg or only to orig_msg;
-        # * If msg_seq_nb appearing more than once is associated with only orig_msg - 
-        # * It means that more than one msg_seq_nb is linked to the same orig_msg_seq_nb for correction. 
-        # * Examples: cusip_id='362320AX1' and trd_Exctn_dt='04FEB2005'd (3 cases like this in total)
-        # * If ntype=2 then a msg_seq_nb is associated with being both msg_seq_nb and orig_msg_seq_nb;
-        
-        w_mult = w.drop_duplicates(subset = [ 'cusip_id', 
-                                              'bond_sym_id', 
-                                              'trd_exctn_dt', 
-                                              'trd_exctn_tm', 
-                                              'msg_seq_nb', 
-                                              'flag'])
-       
-    
-        w_mult1 = w_mult.groupby(['cusip_id', 
-                                  'bond_sym_id', 
-                                  'trd_exctn_dt', 
-                                  'trd_exctn_tm', 
-                                  'msg_seq_nb',
-                                  ]).size().reset_index(name='ntype')
-        
-        # 2.2.4 Combine the npair and ntype info;       
-        w_comb = pd.merge(w_napp, w_mult1, on=['cusip_id', 
-                                               'bond_sym_id', 
-                                               'trd_exctn_dt', 
-                                               'trd_exctn_tm', 
-                                               'msg_seq_nb'], 
-                    how='left').sort_values(by= ['cusip_id',  
-                                                 'trd_exctn_dt', 
-                                                 'trd_exctn_tm'])
-                                       
-        # Map back by matching CUSIP Excution Date and Time to remove msg_seq_nb that appears more than once;
-        # If napp=1 or (napp>1 but ntype=1);
-        __w_keep = pd.merge(w_comb[(w_comb['napp'] == 1) | ((w_comb['napp'] > 1) & (w_comb['ntype'] == 1))], 
-                          w, 
-                          on=['cusip_id',                               
-                              'trd_exctn_dt', 
-                              'trd_exctn_tm', 
-                              'msg_seq_nb',
-                              ], 
-          how = "inner",
-          suffixes=('', '_DROP')).filter(regex='^(?!.*_DROP)').sort_values(by=
-                                   ['cusip_id',                               
-                                   'trd_exctn_dt', 
-                                   'trd_exctn_tm'])
-  
-        # =====================================================================
-       
-        # 2.2.5 Caluclate no of pair of records;
-        # Assuming the original table is named "__w_keep"
-       
-        __w_keep['npair'] = __w_keep.drop_duplicates().groupby(by=[
-                                                 'cusip_id', 
-                                                 'trd_exctn_dt',
-                                                 'trd_exctn_tm'])['cusip_id'].transform("count")/2
-        __w_keep =  __w_keep.sort_values(by=
-                                 ['cusip_id',                               
-                                 'trd_exctn_dt', 
-                                 'trd_exctn_tm'])
-        
-        # For records with only one pair of entry at a given time stamp 
-        # - transpose using the flag information;
-        __w_keep1 = __w_keep[__w_keep['npair']==1].pivot(index=['cusip_id', 
-                                                                'trd_exctn_dt', 
-                                                                'trd_exctn_tm',
-                                                                ],
-                                                         columns='flag', 
-                                                         values='msg_seq_nb')
-       
-        
-        
-        __w_keep1.reset_index(inplace=True)
-        __w_keep1.rename(columns={'msg': 'msg_seq_nb', 'omsg': 'orig_msg_seq_nb'}, inplace=True)
-        
-        # For records with more than one pair of entry at a given time stamp 
-        # - join back the original msg_seq_nb;
-        __w_keep2 = pd.merge(__w_keep[(__w_keep['flag'] == 'msg') & (__w_keep['npair'] > 1)], pre_w, 
-                    left_on = ['cusip_id', 'trd_exctn_dt', 'trd_exctn_tm', 'msg_seq_nb'], 
-                    right_on = ['cusip_id', 'trd_exctn_dt', 'trd_exctn_tm', 'msg_seq_nb'], 
-                    how = 'left',
-                    suffixes=('', '_DROP')).filter(regex='^(?!.*_DROP)').sort_values(by=
-                                             ['cusip_id',                               
-                                             'trd_exctn_dt', 
-                                             'trd_exctn_tm'])
-              
-        __w_keep2 = __w_keep2[['cusip_id',                             
-                               'trd_exctn_dt',
-                               'trd_exctn_tm',
-                               'msg_seq_nb',
-                               'orig_msg_seq_nb']].drop_duplicates()
-        
-        
-        __w_clean = pd.concat([__w_keep1, __w_keep2], axis=0)
-        
-        # * 2.2.6 Join back to get all the other information;
-        w_clean = pd.merge(__w_clean, pre_w.drop(columns = ['orig_msg_seq_nb']), 
-                   left_on  = ['cusip_id', 'trd_exctn_dt', 'trd_exctn_tm', 'msg_seq_nb'], 
-                   right_on = ['cusip_id', 'trd_exctn_dt', 'trd_exctn_tm', 'msg_seq_nb'], 
-                   how = 'left').drop_duplicates(subset = ['orig_msg_seq_nb',
-                                                           'cusip_id',
-                                                           'trd_exctn_dt',
-                                                           'trd_exctn_tm',
-                                                           'msg_seq_nb'])
-        
-        
-        
-        # /* 2.2.7 Match up with Trade Record data to delete the matched T record */;
-        # * Matching by Cusip_ID, Date, and MSG_SEQ_NB;
-        # * W records show ORIG_MSG_SEQ_NB matching orignal record MSG_SEQ_NB;
-        clean_pre2 = pd.merge(clean_pre1.drop_duplicates(), w_clean[[
-                                                   'cusip_id', 
-                                                   'trd_exctn_dt', 
-                                                   'msg_seq_nb',
-                                                   'orig_msg_seq_nb',
-                                                   'trc_st' ]], 
-                      left_on  = ['cusip_id', 'trd_exctn_dt', 'msg_seq_nb'], 
-                      right_on = ['cusip_id', 'trd_exctn_dt', 'orig_msg_seq_nb'], 
-                      how = 'left')
-               
-        # Clean-up clean_pre2 #
-        clean_pre2.rename(columns={ 'trc_st_x':'trc_st',
-                                    'trc_st_y':'trc_st_w',
-                                    'msg_seq_nb_x':'msg_seq_nb',
-                                    'msg_seq_nb_y':'mod_msg_seq_nb',
-                                    'orig_msg_seq_nb_x':'orig_msg_seq_nb',
-                                    'orig_msg_seq_nb_y':'mod_orig_msg_seq_nb'}, inplace=True) 
-        
-        _del_w =  clean_pre2[clean_pre2.trc_st_w == "W"]                                                                              
-
-       # * Delete matched T records;
-        _clean_pre2 =  clean_pre2[clean_pre2['trc_st_w'].isnull()]
-                       
-        _clean_pre2 = _clean_pre2.drop(columns = ['trc_st_w', 
-                                                  'mod_msg_seq_nb', 
-                                                  'mod_orig_msg_seq_nb'])
-        
-        # * Replace T records with corresponding W records;
-        # * Filter out W records with valid matching T from the previous step;
-
-        rep_w = pd.merge(w_clean.drop_duplicates(), _del_w[['cusip_id',
-                                                            'trd_exctn_dt',
-                                                            'trc_st_w',
-                                                            'mod_msg_seq_nb',
-                                                            'mod_orig_msg_seq_nb']], 
-                 left_on  = ['cusip_id', 'trd_exctn_dt', 'msg_seq_nb'], 
-                 right_on = ['cusip_id', 'trd_exctn_dt', 'mod_msg_seq_nb'], 
-                how = 'left')
-        
-        
-        rep_w = rep_w[rep_w['trc_st_w'] == 'W']
-        
-        rep_w = rep_w.drop_duplicates(subset = ['cusip_id',
-                                                'trd_exctn_dt',
-                                                'msg_seq_nb',
-                                                'orig_msg_seq_nb',
-                                                'rptd_pr',
-                                                'entrd_vol_qt'])
-        rep_w = rep_w.drop(columns = [            'trc_st_w', 
-                                                  'mod_msg_seq_nb', 
-                                                  'mod_orig_msg_seq_nb'])
-              
-        clean_pre3 = pd.concat([_clean_pre2, rep_w], axis = 0)
-        
-       #* ***************** */
-       #* 2.3 Reversal Case */
-       #* ***************** */
-       # Filter data by asof_cd = 'R' and keep only certain columns
-       
-        _rev_header = clean_pre3[ clean_pre3['asof_cd'] == 'R'][[  'cusip_id', 
-                                                                   'bond_sym_id',
-                                                                   'trd_exctn_dt',
-                                                                   'trd_exctn_tm',
-                                                                   'trd_rpt_dt',
-                                                                   'trd_rpt_tm',
-                                                                   'entrd_vol_qt', 
-                                                                   'rptd_pr',
-                                                                   'rpt_side_cd',
-                                                                   'cntra_mp_id']]       
-        #* Option B: Match by only 6 keys: CUSIP_ID, 
-        # Execution Date, Vol, Price, B/S and C/D (remove the time dimension);
-        _rev_header = _rev_header.sort_values(by=['cusip_id',
-                                                 'bond_sym_id', 
-                                                 'trd_exctn_dt', 
-                                                 'entrd_vol_qt', 
-                                                 'rptd_pr', 
-                                                 'rpt_side_cd',
-                                                 'cntra_mp_id', 
-                                                 'trd_exctn_tm', 
-                                                 'trd_rpt_dt', 
-                                                 'trd_rpt_tm'])
-              
-        _rev_header6 = _rev_header.copy()
-        _rev_header6['seq'] = _rev_header6.groupby(['cusip_id', 
-                                                    'bond_sym_id',
-                                                    'trd_exctn_dt',
-                                                    'entrd_vol_qt',
-                                                    'rptd_pr',
-                                                    'rpt_side_cd', 
-                                                    'cntra_mp_id']).cumcount() + 1
-        
-        # * Create the same ordering among the non-reversal records;
-        # * Remove records that are R (reversal) D (Delayed dissemination) and 
-        # X (delayed reversal);
-        _clean_pre4 = clean_pre3[~clean_pre3['asof_cd'].isin(['R', 'X', 'D'])]
-        
-        _clean_pre4_header = _clean_pre4[['cusip_id',
-                                          'bond_sym_id',
-                                          'trd_exctn_dt',
-                                          'trd_exctn_tm',
-                                          'entrd_vol_qt',
-                                          'rptd_pr', 
-                                          'rpt_side_cd',
-                                          'cntra_mp_id',
-                                          'trd_rpt_dt', 
-                                          'trd_rpt_tm', 
-                                          'msg_seq_nb']]
-        
-        # Match by 6 keys (excluding execution time);
-        _clean_pre4_header = _clean_pre4_header.sort_values(by=['cusip_id', 
-                                                                'bond_sym_id',
-                                                                'trd_exctn_dt',
-                                                                'entrd_vol_qt',
-                                                                'rptd_pr', 
-                                                                'rpt_side_cd', 
-                                                                'cntra_mp_id',
-                                                                'trd_exctn_tm', 
-                                                                'trd_rpt_dt', 
-                                                                'trd_rpt_tm', 
-                                                                'msg_seq_nb'])
-        
-        _clean_pre4_header['seq6'] = _clean_pre4_header.groupby(['cusip_id', 
-                                                                'bond_sym_id', 
-                                                                'trd_exctn_dt', 
-                                                                'entrd_vol_qt',
-                                                                'rptd_pr', 
-                                                                'rpt_side_cd', 
-                                                                'cntra_mp_id']).cumcount() + 1
-        
-        _clean_pre5_header = pd.merge(_clean_pre4_header.drop_duplicates(), _rev_header6, left_on=['cusip_id',
-                                                                            'trd_exctn_dt', 
-                                                                            'entrd_vol_qt',
-                                                                            'rptd_pr', 
-                                                                            'rpt_side_cd', 
-                                                                            'cntra_mp_id',
-                                                                            'seq6'], 
-                                                                        right_on=['cusip_id',
-                                                                            'trd_exctn_dt', 
-                                                                            'entrd_vol_qt',
-                                                                            'rptd_pr', 
-                                                                            'rpt_side_cd', 
-                                                                            'cntra_mp_id',
-                                                                           'seq'],                                    
-                                                        how = "left", 
-                                                        suffixes=('', '_DROP')).filter(regex='^(?!.*_DROP)')
-                               
-        _clean_pre5_header = _clean_pre5_header.rename(columns={'seq': 'rev_seq6'}).drop_duplicates()
-        _rev_matched6      = _clean_pre5_header[_clean_pre5_header['rev_seq6'].notna()]
-
-
-        # As 6 key matching has a higher record of finding reversal match, 
-        # use the 6 keys results now;
-        _clean_pre5_header = _clean_pre5_header[_clean_pre5_header['rev_seq6'].isna()]
-        _clean_pre5_header = _clean_pre5_header.drop(columns=['rev_seq6',
-                                                              'seq6']    )
-        
-        
-        _clean_pre5 = _clean_pre4.merge(_clean_pre5_header, on=['cusip_id',
-                                                                'trd_exctn_dt',
-                                                                'trd_exctn_tm',
-                                                                'entrd_vol_qt', 
-                                                                'rptd_pr', 
-                                                                'rpt_side_cd', 
-                                                                'cntra_mp_id', 
-                                                                'msg_seq_nb', 
-                                                                'trd_rpt_dt',
-                                                                'trd_rpt_tm'], how='inner',                                      
-                                        suffixes=('', '_DROP')).filter(regex='^(?!.*_DROP)')
-        
-        _clean_pre5 = _clean_pre5.drop_duplicates()
-        
-        # =====================================================================
-        # * Combine the pre and post data together */;
-        clean_post2 = clean_post2[[                    'cusip_id',
-                                                       'trd_exctn_dt',                                                    
-                                                       'rptd_pr',
-                                                       'entrd_vol_qt',
-                                                       'rpt_side_cd',
-                                                       ]]
-        _clean_pre5 = _clean_pre5[clean_post2.columns]
-              
-        trace_post = pd.concat([_clean_pre5, clean_post2], ignore_index=True)
-    
-        trace = trace_post.set_index(['cusip_id','trd_exctn_dt']).sort_index(level = 'cusip_id') 
-        
-        CleaningExport['Obs.PostDickNielsen'].iloc[i] = int(len(trace))
-        
-        #* ***************** */
-        #* Prices / Volume   */
-        #* ***************** */
-        # Price - Equal-Weight   #
-        prc_EW = trace.groupby(['cusip_id','trd_exctn_dt'])[['rptd_pr']].mean().sort_index(level  =  'cusip_id').round(4) 
-        prc_EW.columns = ['prc_ew']
-        
-        # Price - Volume-Weight # 
-        trace['dollar_vol']    = ( trace['entrd_vol_qt'] * trace['rptd_pr']/100 ).round(0) # units x clean prc                               
-        trace['value-weights'] = trace.groupby([ 'cusip_id','trd_exctn_dt'],
-                                                group_keys=False)[['entrd_vol_qt']].apply( lambda x: x/np.nansum(x) )
-        prc_VW = trace.groupby(['cusip_id','trd_exctn_dt'])[['rptd_pr','value-weights']].apply( lambda x: np.nansum( x['rptd_pr'] * x['value-weights']) ).to_frame().round(4)
-        prc_VW.columns = ['prc_vw']
-        
-        PricesAll = prc_EW.merge(prc_VW, how = "inner", left_index = True, right_index = True)  
-        PricesAll.columns                = ['prc_ew','prc_vw']   
-           
-        # Volume #
-        VolumesAll                        = trace.groupby(['cusip_id','trd_exctn_dt'])[['entrd_vol_qt']].sum().sort_index(level  =  "cusip_id")                       
-        VolumesAll['dollar_volume']       = trace.groupby(['cusip_id','trd_exctn_dt'])[['dollar_vol']].sum().sort_index(level  =  "cusip_id").round(0)
-        VolumesAll.columns                = ['qvolume','dvolume']      
-
-        # Illiquidity #
-        # (1) Daily bid prices          #
-        # (2) Daily ask prices          #
-        # (3) Number of daily trades    #
-        
-        # Bid and Ask prices #
-        _bid       = trace[trace['rpt_side_cd'] == 'S']
-        _ask       = trace[trace['rpt_side_cd'] == 'B']
-        
-        # Volume weight Bids #
-        _bid['dollar_vol']    = ( _bid['entrd_vol_qt'] * _bid['rptd_pr']/100 )\
-            .round(0) # units x clean prc                               
-        _bid['value-weights'] = _bid.groupby([ 'cusip_id','trd_exctn_dt'],
-                    group_keys=False)[['entrd_vol_qt']]\
-            .apply( lambda x: x/np.nansum(x) )
-        
-        prc_BID = _bid.groupby(['cusip_id',
-                               'trd_exctn_dt'])[['rptd_pr',
-                                                 'value-weights']]\
-            .apply( lambda x: np.nansum( x['rptd_pr'] * x['value-weights']) )\
-                .to_frame().round(4)
-                
-        prc_BID.columns = ['prc_bid']
-        
-        # Volume weight Asks #
-        _ask['dollar_vol']    = ( _ask['entrd_vol_qt'] * _ask['rptd_pr']/100 )\
-            .round(0) # units x clean prc                               
-        _ask['value-weights'] = _ask.groupby([ 'cusip_id','trd_exctn_dt'],
-                    group_keys=False)[['entrd_vol_qt']]\
-            .apply( lambda x: x/np.nansum(x) )
-        
-        prc_ASK = _ask.groupby(['cusip_id',
-                               'trd_exctn_dt'])[['rptd_pr',
-                                                 'value-weights']]\
-            .apply( lambda x: np.nansum( x['rptd_pr'] * x['value-weights']) )\
-                .to_frame().round(4)
-                
-        prc_ASK.columns = ['prc_ask']
-              
-        prc_BID_ASK =  prc_BID.merge(prc_ASK, 
-                                     how = "inner", 
-                                     left_index = True, 
-                                     right_index = True) 
-                                                                                                                                                                                                                                              
-        # =============================================================================          
-        price_super_list.append(PricesAll)      
-        volume_super_list.append(VolumesAll)
-        illiquidity_super_list.append(prc_BID_ASK)
-        # =============================================================================  
-        
-PricesExport = pd.concat(price_super_list , axis=0     , ignore_index=False)
-VolumeExport = pd.concat(volume_super_list, axis=0     , ignore_index=False)
-IlliqExport  = pd.concat(illiquidity_super_list, axis=0, ignore_index=False)
-
-
-# Save in compressed GZIP format # 
-PricesExport.to_csv(Path(DATA_DIR) / "pulled" / 'Prices.csv.gzip'     , compression='gzip')   
-VolumeExport.to_csv(Path(DATA_DIR) / "pulled" / 'Volumes.csv.gzip'    , compression='gzip')     
-IlliqExport.to_csv( Path(DATA_DIR) / "pulled" / 'Illiq.csv.gzip'      , compression='gzip')    
-# =============================================================================  
\ No newline at end of file
+        # chunks sized by their row counts, large bonds split by date
+        db = connect_wrds()
+        counts = trace_plan.load_row_counts(db, CUSIP_Sample, refresh=args.refresh_counts)
+        db.close()
+        plan = trace_plan.plan_chunks(counts, CUSIP_Sample, START_DATE, END_DATE, max_rows=args.chunk_rows)
+        cusip_chunks  = [cusips for cusips, _, _, _ in plan]
+        chunk_windows = [(start, end) for _, start, end, _ in plan]
+        print(f'{len(plan)} chunks, at most {plan[0][3] if plan else 0} rows each (estimated)')
+
+    #* ************************************** */
+    #* Iterate over the chunks                */
+    #* ************************************** */
+    price_super_list, volume_super_list, illiquidity_super_list, CleaningExport = \
+        run_chunks(cusip_chunks,
+                   workers=args.workers,
+                   checkpoint_dir=None if args.no_checkpoint else args.checkpoint_dir,
+                   start_date=START_DATE,
+                   end_date=END_DATE,
+                   pushdown=args.pushdown,
+                   incremental=args.incremental,
+                   lookback_days=args.lookback_days,
+                   chunk_windows=chunk_windows,
+                   report_path=args.report,
+                   profile_memory=args.profile_memory,
+                   backend=args.backend,
+                   prefetch=args.prefetch,
+                   fetchers=args.fetchers,
+                   memory_budget_mb=args.memory_budget_mb)
+
+    PricesExport = pd.concat(price_super_list , axis=0     , ignore_index=False)
+    VolumeExport = pd.concat(volume_super_list, axis=0     , ignore_index=False)
+    IlliqExport  = pd.concat(illiquidity_super_list, axis=0, ignore_index=False)
+
+
+    # Save in compressed GZIP format # 
+    PricesExport.to_csv(Path(DATA_DIR) / "pulled" / 'Prices.csv.gzip'     , compression='gzip')   
+    VolumeExport.to_csv(Path(DATA_DIR) / "pulled" / 'Volumes.csv.gzip'    , compression='gzip')     
+    IlliqExport.to_csv( Path(DATA_DIR) / "pulled" / 'Illiq.csv.gzip'      , compression='gzip')    
+
+    # Save as partitioned Parquet for the downstream scripts #
+    trace_store.write_dataset(PricesExport, 'Prices')
+    trace_store.write_dataset(VolumeExport, 'Volumes')
+    trace_store.write_dataset(IlliqExport , 'Illiq')
+    # =============================================================================  
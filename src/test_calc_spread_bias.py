@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import calc_spread_bias
+import trace_store
+
+
+def make_illiq(n_bonds=60, seed=0):
+    rng = np.random.default_rng(seed)
+    days = pd.bdate_range('2010-11-01', '2011-03-31')
+    frames = []
+    for i in range(n_bonds):
+        dates = np.sort(rng.choice(days, rng.integers(1, 90), replace=False))
+        ask = rng.normal(100, 5, len(dates))
+        frames.append(pd.DataFrame({'cusip_id': f'{i:06d}AB1', 'trd_exctn_dt': dates,
+                                    'prc_bid': ask + rng.exponential(0.5, len(dates)), 'prc_ask': ask}))
+    return pd.concat(frames, ignore_index=True).set_index(['cusip_id', 'trd_exctn_dt'])
+
+
+@pytest.mark.parametrize('mode', ['pooled', 'cross_sectional'])
+def test_streaming_matches_in_memory(tmp_path, mode):
+    trace_store.write_dataset(make_illiq(), 'Illiq', store_dir=tmp_path)
+
+    in_memory_path = tmp_path / 'in_memory.csv'
+    calc_spread_bias.write_spread_bias(in_memory_path, store_dir=tmp_path, mode=mode)
+
+    output_path = tmp_path / 'spread_bias.csv'
+    calc_spread_bias.stream_spread_bias(output_path, partition_rows=300, store_dir=tmp_path, spill_dir=tmp_path,
+                                        mode=mode)
+
+    assert len(pd.read_csv(output_path)) > 1_000
+    assert output_path.read_text() == in_memory_path.read_text()
+    assert list(tmp_path.glob('spread_bias_*')) == []
+
+
+@pytest.mark.parametrize('mode', ['pooled', 'cross_sectional'])
+@pytest.mark.parametrize('n_missing', [3, 300])
+def test_streaming_ranks_missing_bias_like_in_memory(tmp_path, mode, n_missing):
+    # zero bid and ask prices give a missing (0/0) bias; a few missing values
+    # take the upper bound, many turn off the top cut
+    illiq = make_illiq(seed=1)
+    illiq.iloc[np.random.default_rng(2).choice(len(illiq), n_missing, replace=False)] = 0.0
+    trace_store.write_dataset(illiq, 'Illiq', store_dir=tmp_path)
+
+    in_memory_path = tmp_path / 'in_memory.csv'
+    calc_spread_bias.write_spread_bias(in_memory_path, store_dir=tmp_path, mode=mode)
+    output_path = tmp_path / 'spread_bias.csv'
+    calc_spread_bias.stream_spread_bias(output_path, partition_rows=300, store_dir=tmp_path, spill_dir=tmp_path,
+                                        mode=mode)
+
+    # the missing values survive the trade filters and reach the winsorization
+    assert pd.read_csv(in_memory_path)['spread'].isna().any()
+    assert output_path.read_text() == in_memory_path.read_text()
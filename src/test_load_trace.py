@@ -0,0 +1,327 @@
+import json
+import re
+import sqlite3
+import tracemalloc
+
+import pandas as pd
+from pandas.testing import assert_frame_equal
+import numpy as np
+import pytest
+
+import load_trace
+import trace_clean
+import trace_plan
+import trace_query
+import wrds_cache
+
+
+def make_trace(cusips, n_per_cusip=60, seed=0):
+    '''
+    Build a small trace_enhanced-like frame with pre and post 2012 trades,
+    a few post-2012 cancellations and a few pre-2012 cancellations.
+    '''
+    rng = np.random.default_rng(seed)
+    days = pd.bdate_range('2011-12-01', '2012-03-30')
+    rows = []
+    msg = 1000
+    for cusip in cusips:
+        for _ in range(n_per_cusip):
+            msg += 1
+            d = days[rng.integers(0, len(days))]
+            row = {'cusip_id': cusip, 'bond_sym_id': 'SYM' + cusip[:4],
+                   'trd_exctn_dt': d.date(), 'trd_exctn_tm': f"{rng.integers(9, 17):02d}:{rng.integers(0, 60):02d}:00",
+                   'days_to_sttl_ct': '002', 'lckd_in_ind': None, 'wis_fl': 'N', 'sale_cndtn_cd': '@',
+                   'msg_seq_nb': str(msg), 'trc_st': 'T', 'trd_rpt_dt': d.date(), 'trd_rpt_tm': '17:00:00',
+                   'entrd_vol_qt': float(rng.choice([5000, 20000, 100000])),
+                   'rptd_pr': float(np.round(rng.normal(100, 2), 3)), 'yld_pt': 5.0,
+                   'asof_cd': None, 'orig_msg_seq_nb': None,
+                   'rpt_side_cd': rng.choice(['B', 'S', 'D']), 'cntra_mp_id': rng.choice(['C', 'D'])}
+            rows.append(row)
+            if rng.random() < 0.05:
+                if d >= pd.Timestamp('2012-02-06'):
+                    rows.append({**row, 'trc_st': 'X'})
+                else:
+                    msg += 1
+                    rows.append({**row, 'trc_st': 'C', 'msg_seq_nb': str(msg),
+                                 'orig_msg_seq_nb': row['msg_seq_nb']})
+    return pd.DataFrame(rows)
+
+
+CUSIPS = [f"{i:06d}AA{i % 10}" for i in range(9)]
+TRACE = make_trace(CUSIPS)
+
+
+class FakeConnection:
+    '''
+    Local stand-in for wrds.Connection that serves TRACE from memory.
+    '''
+    def raw_sql(self, sql, params=None):
+        trace = TRACE[TRACE['cusip_id'].isin(params['cusip_id'])].reset_index(drop=True)
+        if 'COUNT(*)' in sql:
+            return pd.DataFrame({'n': [len(trace)], 'n_post_bbw': [int((trace['entrd_vol_qt'] >= 10000).sum())]})
+        return trace
+
+
+def test_run_chunks_parallel_matches_serial():
+    cusip_chunks = list(load_trace.divide_chunks(CUSIPS, 2))
+    serial = load_trace.run_chunks(cusip_chunks, connect=FakeConnection, workers=1)
+    parallel = load_trace.run_chunks(cusip_chunks, connect=FakeConnection, workers=3)
+
+    for serial_list, parallel_list in zip(serial[:3], parallel[:3]):
+        assert_frame_equal(pd.concat(serial_list), pd.concat(parallel_list))
+    assert_frame_equal(serial[3], parallel[3])
+
+
+def test_run_chunks_keeps_chunk_order():
+    cusip_chunks = list(load_trace.divide_chunks(CUSIPS, 2))
+    price_super_list, _, _, CleaningExport = load_trace.run_chunks(cusip_chunks, connect=FakeConnection, workers=3)
+
+    # the last chunk holds a single CUSIP with fewer than 100 trades
+    assert len(price_super_list) == len(cusip_chunks) - 1
+    for prices, cusips in zip(price_super_list, cusip_chunks):
+        assert set(prices.index.get_level_values('cusip_id')) <= set(cusips)
+    assert list(CleaningExport['Obs.Pre']) == [int(TRACE['cusip_id'].isin(c).sum()) for c in cusip_chunks]
+
+
+class FailingConnection:
+    '''
+    Stand-in that fails on every query, to prove a resumed run never hits WRDS.
+    '''
+    def raw_sql(self, sql, params=None):
+        raise RuntimeError('no connection')
+
+
+def test_run_chunks_resumes_from_checkpoints(tmp_path):
+    cusip_chunks = list(load_trace.divide_chunks(CUSIPS, 2))
+    expected = load_trace.run_chunks(cusip_chunks, connect=FakeConnection)
+
+    # a first run that only gets through part of the universe
+    load_trace.run_chunks(cusip_chunks[:2], connect=FakeConnection, checkpoint_dir=tmp_path)
+    load_trace.run_chunks(cusip_chunks, connect=FakeConnection, workers=2, checkpoint_dir=tmp_path)
+    resumed = load_trace.run_chunks(cusip_chunks, connect=FailingConnection, checkpoint_dir=tmp_path)
+
+    for expected_list, resumed_list in zip(expected[:3], resumed[:3]):
+        assert_frame_equal(pd.concat(expected_list), pd.concat(resumed_list))
+    assert_frame_equal(expected[3], resumed[3])
+
+
+def test_pipelined_run_matches_serial(tmp_path):
+    cusip_chunks = list(load_trace.divide_chunks(CUSIPS, 2))
+    expected = load_trace.run_chunks(cusip_chunks, connect=FakeConnection)
+    pipelined = load_trace.run_chunks(cusip_chunks, connect=FakeConnection, prefetch=1, fetchers=3,
+                                      checkpoint_dir=tmp_path)
+    # the writer thread has checkpointed every chunk
+    resumed = load_trace.run_chunks(cusip_chunks, connect=FailingConnection, checkpoint_dir=tmp_path)
+
+    for result in (pipelined, resumed):
+        for expected_list, result_list in zip(expected[:3], result[:3]):
+            assert_frame_equal(pd.concat(expected_list), pd.concat(result_list))
+        assert_frame_equal(expected[3], result[3])
+
+
+class BrokenChunkConnection(FakeConnection):
+    def raw_sql(self, sql, params=None):
+        if CUSIPS[4] in params['cusip_id']:
+            raise RuntimeError('connection lost')
+        return super().raw_sql(sql, params)
+
+
+def test_pipeline_raises_fetch_errors(tmp_path):
+    cusip_chunks = list(load_trace.divide_chunks(CUSIPS, 2))
+    with pytest.raises(RuntimeError, match='connection lost'):
+        load_trace.run_chunks(cusip_chunks, connect=BrokenChunkConnection, prefetch=1, fetchers=2,
+                              checkpoint_dir=tmp_path)
+
+
+def test_run_report_records_every_stage(tmp_path):
+    cusip_chunks = list(load_trace.divide_chunks(CUSIPS, 4))
+    _, _, _, CleaningExport = load_trace.run_chunks(cusip_chunks, connect=FakeConnection, profile_memory=True,
+                                                    report_path=tmp_path / 'report.json')
+    with open(tmp_path / 'report.json') as f:
+        report = json.load(f)
+
+    chunk = report['chunks'][0]
+    assert chunk['Obs.PostDickNielsen'] == CleaningExport['Obs.PostDickNielsen'].iloc[0]
+    stages = {stage['stage']: stage for stage in chunk['stages']}
+    assert {'fetch', 'volume_filter', 'split_pre_post', 'post_cx_removal', 'pre_c_removal',
+            'pre_w_corrections', 'pre_reversals', 'daily_aggregation'} <= set(stages)
+    assert stages['fetch']['rows_out'] == chunk['Obs.Pre']
+    assert stages['volume_filter']['rows_out'] == chunk['Obs.PostBBW']
+    assert stages['combine']['rows_out'] == chunk['Obs.PostDickNielsen']
+    assert all(stage['peak_mb'] > 0 for stage in chunk['stages'])
+    assert report['memory_scope'] == 'stage'
+
+    seconds = [stage['seconds'] for stage in report['summary']]
+    assert seconds == sorted(seconds, reverse=True)
+    assert abs(sum(stage['share'] for stage in report['summary']) - 1) < 1e-9
+    tracemalloc.stop()
+
+
+def test_pipeline_report_traces_the_memory_of_the_whole_run(tmp_path):
+    cusip_chunks = list(load_trace.divide_chunks(CUSIPS, 4))
+    load_trace.run_chunks(cusip_chunks, connect=FakeConnection, profile_memory=True, prefetch=1, fetchers=2,
+                          report_path=tmp_path / 'report.json')
+    with open(tmp_path / 'report.json') as f:
+        report = json.load(f)
+
+    # the fetchers and the cleaning would reset each other's tracemalloc peak
+    assert report['memory_scope'] == 'process' and report['peak_mb'] > 0
+    assert all(stage['peak_mb'] is None for chunk in report['chunks'] for stage in chunk['stages'])
+    tracemalloc.stop()
+
+
+class SqliteConnection:
+    '''
+    Stand-in that runs the generated SQL on an in-memory SQLite copy of
+    trace_enhanced, translating the schema and the psycopg2 parameter style.
+    '''
+    def __init__(self, trace):
+        self.con = sqlite3.connect(':memory:')
+        trace.to_sql('trace_enhanced', self.con, index=False)
+
+    @staticmethod
+    def translate(sql, params=None):
+        sql = sql.replace('trace.trace_enhanced', 'trace_enhanced')
+        sql = sql.replace('EXTRACT(YEAR FROM trd_exctn_dt)', "CAST(strftime('%Y', trd_exctn_dt) AS INTEGER)")
+        params = dict(params or {})
+        for name, value in list(params.items()):
+            if isinstance(value, tuple):
+                names = [f'{name}_{i}' for i in range(len(value))]
+                sql = sql.replace(f'%({name})s', '(' + ', '.join(':' + n for n in names) + ')')
+                params.update(zip(names, value))
+                del params[name]
+        return re.sub(r'%\((\w+)\)s', r':\1', sql), params
+
+    def raw_sql(self, sql, params=None):
+        sql, params = self.translate(sql, params)
+        return pd.read_sql_query(sql, self.con, params=params)
+
+
+def test_pushdown_matches_client_side_filters():
+    rng = np.random.default_rng(1)
+    trace = TRACE.assign(days_to_sttl_ct = rng.choice(['000', '002', '003', None], len(TRACE)),
+                         wis_fl          = rng.choice(['N', 'Y', None], len(TRACE), p=[.8, .1, .1]),
+                         lckd_in_ind     = rng.choice(['Y', None], len(TRACE), p=[.1, .9]),
+                         sale_cndtn_cd   = rng.choice(['@', 'C', None], len(TRACE), p=[.6, .1, .3]))
+    db = SqliteConnection(trace)
+    window = {'start_date': '2011-12-15', 'end_date': '2012-03-15'}
+
+    pushed = load_trace.process_chunk(db, CUSIPS, pushdown=True, **window)
+    client = load_trace.process_chunk(db, CUSIPS, pushdown=False, **window)
+    for pushed_frame, client_frame in zip(pushed[:3], client[:3]):
+        assert_frame_equal(pushed_frame, client_frame)
+
+    # the pushed-down query returns fewer rows, the statistics still count the full pull
+    fetch = next(stage for stage in pushed[3]['stages'] if stage['stage'] == 'fetch')
+    assert fetch['rows_out'] < client[3]['Obs.PostBBW']
+    for column in ['Obs.Pre', 'Obs.PostBBW', 'Obs.PostDickNielsen']:
+        assert pushed[3][column] == client[3][column]
+    dates = pushed[0].index.get_level_values('trd_exctn_dt')
+    assert dates.min() >= pd.Timestamp(window['start_date']) and dates.max() <= pd.Timestamp(window['end_date'])
+
+
+def test_pushdown_keeps_chunks_above_min_obs():
+    # 60 trades per bond, most of them removed by the volume filter: only the
+    # unfiltered count of the chunk is above MIN_OBS
+    trace = make_trace(CUSIPS[:2]).assign(entrd_vol_qt=5000.0)
+    trace.loc[trace.index[::4], 'entrd_vol_qt'] = 20000.0
+    db = SqliteConnection(trace)
+
+    pushed = load_trace.process_chunk(db, CUSIPS[:2], pushdown=True)
+    client = load_trace.process_chunk(db, CUSIPS[:2], pushdown=False)
+    assert client[3]['Obs.Pre'] > trace_clean.MIN_OBS >= client[3]['Obs.PostBBW']
+    assert pushed[0] is not None
+    for pushed_frame, client_frame in zip(pushed[:3], client[:3]):
+        assert_frame_equal(pushed_frame, client_frame)
+    assert {k: pushed[3][k] for k in trace_clean.CLEANING_COLUMNS} == {k: client[3][k] for k in trace_clean.CLEANING_COLUMNS}
+
+
+def test_incremental_update_matches_full_pull(tmp_path):
+    cusip_chunks = list(load_trace.divide_chunks(CUSIPS, 3))
+    # a post-2012 trade cancelled three weeks after it was reported
+    cancelled = TRACE[(TRACE['trd_exctn_dt'] >= pd.Timestamp('2012-02-10').date())
+                      & (TRACE['trd_exctn_dt'] <= pd.Timestamp('2012-02-20').date())
+                      & (TRACE['trc_st'] == 'T') & (TRACE['entrd_vol_qt'] >= 10000)].iloc[0]
+    late_cancel = cancelled.to_frame().T.assign(trc_st='X', trd_rpt_dt=pd.Timestamp('2012-03-20').date())
+    trace = pd.concat([TRACE, late_cancel], ignore_index=True)
+    first_pull = trace[trace['trd_rpt_dt'] <= pd.Timestamp('2012-03-01').date()]
+
+    load_trace.run_chunks(cusip_chunks, connect=lambda: SqliteConnection(first_pull), checkpoint_dir=tmp_path)
+    updated = load_trace.run_chunks(cusip_chunks, connect=lambda: SqliteConnection(trace), checkpoint_dir=tmp_path,
+                                    incremental=True, lookback_days=5)
+    expected = load_trace.run_chunks(cusip_chunks, connect=lambda: SqliteConnection(trace))
+
+    for expected_list, updated_list in zip(expected[:3], updated[:3]):
+        assert_frame_equal(pd.concat(expected_list), pd.concat(updated_list))
+    # the late cancellation changed a bond-day from before the lookback window
+    day = (cancelled['cusip_id'], pd.Timestamp(cancelled['trd_exctn_dt']))
+    before = load_trace.run_chunks(cusip_chunks, connect=lambda: SqliteConnection(first_pull))
+    assert not pd.concat(before[1]).reindex([day]).equals(pd.concat(updated[1]).reindex([day]))
+
+
+def test_planned_chunks_match_equal_chunks(tmp_path):
+    trace = make_trace(CUSIPS[:4], n_per_cusip=600)
+    db = SqliteConnection(trace)
+    counts = trace_plan.load_row_counts(db, CUSIPS[:4], path=tmp_path / 'counts.csv')
+    # a budget below one bond's trades splits every bond at the turn of the year
+    plan = trace_plan.plan_chunks(counts, CUSIPS[:4], max_rows=500)
+    assert any(start is not None for _, start, _, _ in plan)
+
+    planned = load_trace.run_chunks([cusips for cusips, _, _, _ in plan], connect=lambda: db,
+                                    chunk_windows=[(start, end) for _, start, end, _ in plan])
+    expected = load_trace.run_chunks(list(load_trace.divide_chunks(CUSIPS[:4], 2)), connect=lambda: db)
+    for expected_list, planned_list in zip(expected[:3], planned[:3]):
+        assert_frame_equal(pd.concat(expected_list).sort_index(), pd.concat(planned_list).sort_index())
+    assert planned[3]['Obs.Pre'].sum() == expected[3]['Obs.Pre'].sum()
+
+
+def test_offline_cached_pull_matches_live_pull(tmp_path):
+    db = SqliteConnection(TRACE)
+    live = load_trace.process_chunk(wrds_cache.CachedConnection(db, cache_dir=tmp_path), CUSIPS[:3])
+    offline = load_trace.process_chunk(wrds_cache.CachedConnection(cache_dir=tmp_path, offline=True), CUSIPS[:3])
+    for live_frame, offline_frame in zip(live[:3], offline[:3]):
+        assert_frame_equal(live_frame, offline_frame)
+
+
+class StreamingSqliteConnection(SqliteConnection):
+    '''
+    SqliteConnection that also exposes a named-cursor interface like the
+    psycopg2 connection behind wrds.Connection, recording the batch sizes.
+    '''
+    def __init__(self, trace):
+        super().__init__(trace)
+        self.connection = self
+        self.fetched = []
+
+    def cursor(self, name=None, withhold=False):
+        return StreamingCursor(self)
+
+
+class StreamingCursor:
+    def __init__(self, db):
+        self.db, self.cursor = db, db.con.cursor()
+
+    def execute(self, sql, params=None):
+        self.cursor.execute(*self.db.translate(sql, params))
+        self.description = self.cursor.description
+
+    def fetchmany(self, size):
+        rows = self.cursor.fetchmany(size)
+        self.db.fetched.append(len(rows))
+        return rows
+
+    def close(self):
+        self.cursor.close()
+
+
+def test_streamed_pull_matches_full_pull():
+    db = StreamingSqliteConnection(TRACE)
+    sql, params = trace_query.build_trace_query(CUSIPS, pushdown=False)
+    trace, n_pre, n_post_bbw = load_trace.read_trace(db, sql, params, batch_size=25)
+    assert max(db.fetched) == 25 and n_pre == len(TRACE)
+
+    streamed = trace_clean.clean_filtered(trace, n_pre, n_post_bbw)
+    expected = trace_clean.clean_chunk(TRACE)
+    for streamed_frame, expected_frame in zip(streamed[:3], expected[:3]):
+        assert_frame_equal(streamed_frame, expected_frame)
+    assert streamed[3] == expected[3]
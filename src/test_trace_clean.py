@@ -0,0 +1,209 @@
+import pandas as pd
+from pandas.testing import assert_frame_equal
+import numpy as np
+
+import trace_clean
+
+
+def trade(msg_seq_nb, **fields):
+    '''
+    One trace_enhanced row with sensible defaults.
+    '''
+    row = {'cusip_id': '000000AA0', 'bond_sym_id': 'SYM0',
+           'trd_exctn_dt': '2013-03-01', 'trd_exctn_tm': '10:00:00',
+           'days_to_sttl_ct': '002', 'lckd_in_ind': None, 'wis_fl': 'N', 'sale_cndtn_cd': '@',
+           'msg_seq_nb': str(msg_seq_nb), 'trc_st': 'T',
+           'trd_rpt_dt': fields.get('trd_exctn_dt', '2013-03-01'), 'trd_rpt_tm': '10:00:00',
+           'entrd_vol_qt': 20000.0, 'rptd_pr': 100.0, 'yld_pt': 5.0,
+           'asof_cd': None, 'orig_msg_seq_nb': None, 'rpt_side_cd': 'B', 'cntra_mp_id': 'D'}
+    row.update(fields)
+    return row
+
+
+def prepare(rows):
+    return trace_clean.prepare_trace(pd.DataFrame(rows))
+
+
+def test_prepare_trace_uses_the_typed_schema():
+    trace = prepare([trade(1, trd_exctn_tm='09:30:05', days_to_sttl_ct=None),
+                     trade(2, trd_exctn_tm=None)])
+
+    assert isinstance(trace['cusip_id'].dtype, pd.CategoricalDtype)
+    assert list(trace['days_to_sttl_ct']) == ['None', '002']
+    assert str(trace['trd_exctn_tm'].dtype) == 'Int32'
+    assert trace['trd_exctn_tm'].iloc[0] == 9 * 3600 + 30 * 60 + 5
+    assert trace['trd_exctn_tm'].isna().iloc[1]
+    # converting again leaves the frame unchanged
+    assert_frame_equal(trace_clean.compact_trace(trace.copy()), trace)
+
+
+def test_post_2012_removes_cancelled_trades():
+    rows = [trade(1, rptd_pr=101.0),
+            trade(2, rptd_pr=102.0),
+            trade(2, rptd_pr=102.0, trc_st='X')]
+    clean = trace_clean.clean_post_2012(prepare(rows))
+    assert list(clean['msg_seq_nb']) == ['1']
+
+
+def test_pre_2012_removes_cancelled_trades_and_applies_corrections():
+    day = {'trd_exctn_dt': '2010-03-01'}
+    rows = [trade(1, rptd_pr=101.0, **day),
+            trade(2, rptd_pr=102.0, **day),
+            trade(3, rptd_pr=102.0, trc_st='C', orig_msg_seq_nb='2', **day),
+            trade(4, rptd_pr=103.0, trd_exctn_tm='11:00:00', **day),
+            trade(5, rptd_pr=104.0, trd_exctn_tm='11:00:00', trc_st='W', orig_msg_seq_nb='4', **day)]
+    clean = trace_clean.clean_pre_2012(prepare(rows))
+    assert sorted(zip(clean['msg_seq_nb'], clean['rptd_pr'])) == [('1', 101.0), ('5', 104.0)]
+
+
+def test_resolve_w_chains_follows_chains_to_their_root():
+    day = {'trd_exctn_dt': '2010-03-01'}
+    rows = [# T 1 <- W 2 <- W 3 <- W 4 and, at the same time stamp, T 5 <- W 6
+            trade(2, rptd_pr=102.0, trc_st='W', orig_msg_seq_nb='1', **day),
+            trade(3, rptd_pr=103.0, trc_st='W', orig_msg_seq_nb='2', **day),
+            trade(4, rptd_pr=104.0, trc_st='W', orig_msg_seq_nb='3', **day),
+            trade(6, rptd_pr=106.0, trc_st='W', orig_msg_seq_nb='5', **day)]
+    w_clean = trace_clean.resolve_w_chains(prepare(rows))
+    assert sorted(zip(w_clean['msg_seq_nb'], w_clean['orig_msg_seq_nb'])) == [('4', '1'), ('6', '5')]
+
+
+def test_pre_2012_replaces_each_chain_at_a_time_stamp():
+    day = {'trd_exctn_dt': '2010-03-01'}
+    rows = [trade(1, rptd_pr=101.0, **day),
+            trade(2, rptd_pr=102.0, trc_st='W', orig_msg_seq_nb='1', **day),
+            trade(3, rptd_pr=103.0, trc_st='W', orig_msg_seq_nb='2', **day),
+            trade(5, rptd_pr=105.0, rpt_side_cd='S', **day),
+            trade(6, rptd_pr=106.0, rpt_side_cd='S', trc_st='W', orig_msg_seq_nb='5', **day)]
+    clean = trace_clean.clean_pre_2012(prepare(rows))
+    assert sorted(zip(clean['msg_seq_nb'], clean['rptd_pr'])) == [('3', 103.0), ('6', 106.0)]
+
+
+def test_pre_2012_removes_reversed_trades():
+    day = {'trd_exctn_dt': '2010-03-01'}
+    rows = [trade(1, rptd_pr=101.0, **day),
+            trade(2, rptd_pr=102.0, **day),
+            trade(3, rptd_pr=102.0, trd_exctn_tm='10:05:00', asof_cd='R', **day)]
+    clean = trace_clean.clean_pre_2012(prepare(rows))
+    assert list(clean['msg_seq_nb']) == ['1']
+
+
+def test_reversal_keep_mask_with_exec_time():
+    day = {'trd_exctn_dt': '2010-03-01'}
+    trades = prepare([trade(1, **day),
+                      trade(2, cntra_mp_id=None, **day)])
+    rev = prepare([trade(3, trd_exctn_tm='10:05:00', asof_cd='R', **day),
+                   trade(4, cntra_mp_id=None, asof_cd='R', **day)])
+    keep6, keep7 = trace_clean.reversal_keep_mask(trades, rev, with_exec_time=True)
+
+    # the reversal at 10:05 only matches trade 1 when the exec time is ignored,
+    # and records with a missing key are never matched
+    assert list(keep6) == [False, True]
+    assert list(keep7) == [True, True]
+
+
+def legacy_aggregate(trace):
+    '''
+    The daily aggregation of the original load_trace.py loop.
+    '''
+    trace = trace.copy()
+    prc_EW = trace.groupby(['cusip_id','trd_exctn_dt'])[['rptd_pr']].mean().sort_index(level = 'cusip_id').round(4)
+    prc_EW.columns = ['prc_ew']
+    trace['dollar_vol']    = ( trace['entrd_vol_qt'] * trace['rptd_pr']/100 ).round(0)
+    trace['value-weights'] = trace.groupby([ 'cusip_id','trd_exctn_dt'],
+                                            group_keys=False)[['entrd_vol_qt']].apply( lambda x: x/np.nansum(x) )
+    prc_VW = trace.groupby(['cusip_id','trd_exctn_dt'])[['rptd_pr','value-weights']].apply( lambda x: np.nansum( x['rptd_pr'] * x['value-weights']) ).to_frame().round(4)
+    prc_VW.columns = ['prc_vw']
+    PricesAll = prc_EW.merge(prc_VW, how = "inner", left_index = True, right_index = True)
+
+    VolumesAll                  = trace.groupby(['cusip_id','trd_exctn_dt'])[['entrd_vol_qt']].sum().sort_index(level  =  "cusip_id")
+    VolumesAll['dollar_volume'] = trace.groupby(['cusip_id','trd_exctn_dt'])[['dollar_vol']].sum().sort_index(level  =  "cusip_id").round(0)
+    VolumesAll.columns          = ['qvolume','dvolume']
+
+    sides = []
+    for side, name in (('S', 'prc_bid'), ('B', 'prc_ask')):
+        _side = trace[trace['rpt_side_cd'] == side].copy()
+        _side['value-weights'] = _side.groupby([ 'cusip_id','trd_exctn_dt'],
+                    group_keys=False)[['entrd_vol_qt']].apply( lambda x: x/np.nansum(x) )
+        prc = _side.groupby(['cusip_id','trd_exctn_dt'])[['rptd_pr','value-weights']]\
+            .apply( lambda x: np.nansum( x['rptd_pr'] * x['value-weights']) ).to_frame().round(4)
+        prc.columns = [name]
+        sides.append(prc)
+    prc_BID_ASK = sides[0].merge(sides[1], how = "inner", left_index = True, right_index = True)
+    return PricesAll, VolumesAll, prc_BID_ASK
+
+
+def random_trades(n, n_days, seed=0):
+    '''
+    Cleaned trades indexed by (cusip_id, trd_exctn_dt) with prices to three
+    decimals, so weighted prices often fall on a rounding midpoint, bond-days
+    of up to a few hundred trades and the dates of a CUSIP out of order.
+    '''
+    rng = np.random.default_rng(seed)
+    day = np.minimum(rng.geometric(1 / n_days * 3, n), n_days) - 1
+    trace = pd.DataFrame({'cusip_id': np.array(['A', 'B', 'C'])[day % 3],
+                          'trd_exctn_dt': pd.Timestamp('2013-03-01') + pd.to_timedelta(day // 3, unit='D'),
+                          'rptd_pr': np.round(rng.normal(100, 0.01, n), 3),
+                          'entrd_vol_qt': rng.choice([1000.0, 5000.0, 10000.0, 25000.0, 1e6 / 3], n),
+                          'rpt_side_cd': rng.choice(['B', 'S', 'D'], n)})
+    return trace.set_index(['cusip_id', 'trd_exctn_dt']).sort_index(level = 'cusip_id')
+
+
+def test_aggregate_daily():
+    trace = pd.DataFrame({'cusip_id': ['A', 'A', 'A', 'B'],
+                          'trd_exctn_dt': pd.to_datetime(['2013-03-01'] * 4),
+                          'rptd_pr': [100.0, 102.0, 101.0, 99.0],
+                          'entrd_vol_qt': [10000.0, 30000.0, 20000.0, 50000.0],
+                          'rpt_side_cd': ['S', 'S', 'B', 'B']}).set_index(['cusip_id', 'trd_exctn_dt'])
+    PricesAll, VolumesAll, prc_BID_ASK = trace_clean.aggregate_daily(trace)
+
+    assert list(VolumesAll['qvolume']) == [60000.0, 50000.0]
+    assert list(VolumesAll['dvolume']) == [60800.0, 49500.0]
+    # B has no sell side trades and so no bid/ask pair
+    assert list(prc_BID_ASK.index.get_level_values('cusip_id')) == ['A']
+    for expected, result in zip(legacy_aggregate(trace), (PricesAll, VolumesAll, prc_BID_ASK)):
+        assert_frame_equal(expected, result, check_exact=True)
+
+
+def test_aggregate_daily_matches_legacy_bits():
+    trace = random_trades(40000, 8000)
+    for expected, result in zip(legacy_aggregate(trace), trace_clean.aggregate_daily(trace)):
+        assert_frame_equal(expected, result, check_exact=True)
+
+
+def test_pairwise_sums_match_numpy():
+    rng = np.random.default_rng(1)
+    sizes = np.array([0, 1, 7, 8, 9, 128, 129, 300, 1000, 5000])
+    values = rng.random(sizes.sum()) * 1e3
+    starts = np.cumsum(sizes) - sizes
+    expected = [np.sum(values[start:start + size]) for start, size in zip(starts, sizes)]
+    assert list(trace_clean.pairwise_sums(values, starts, sizes)) == expected
+
+
+def test_aggregate_trades_counts_and_one_sided_days():
+    trace = pd.DataFrame({'cusip_id': ['A', 'A', 'A', 'B', 'B'],
+                          'trd_exctn_dt': pd.to_datetime(['2013-03-01'] * 5),
+                          'rptd_pr': [100.0, 102.0, 101.0, 99.0, 98.0],
+                          'entrd_vol_qt': [10000.0, 30000.0, 20000.0, 50000.0, 10000.0],
+                          'rpt_side_cd': ['S', 'D', 'B', 'B', 'B']}).set_index(['cusip_id', 'trd_exctn_dt'])
+    daily = trace_clean.aggregate_trades(trace)
+
+    assert list(daily['n_trades']) == [3, 2]
+    assert list(daily['n_bid']) == [1, 0]
+    assert list(daily['n_ask']) == [1, 2]
+    assert np.isnan(daily['prc_bid'].iloc[1])
+
+    # a chunk with no sell side trades at all has an empty Illiq
+    _, _, prc_BID_ASK = trace_clean.aggregate_daily(trace.loc[['B']])
+    assert prc_BID_ASK.empty
+
+
+def test_clean_chunk_does_not_modify_input():
+    rows = [trade(i, rptd_pr=100.0 + i % 7, trd_exctn_tm=f'10:{i % 60:02d}:00', rpt_side_cd='BS'[i % 2])
+            for i in range(150)]
+    trace = pd.DataFrame(rows)
+    before = trace.copy()
+    PricesAll, VolumesAll, prc_BID_ASK, stats = trace_clean.clean_chunk(trace)
+
+    assert_frame_equal(trace, before)
+    assert stats == {'Obs.Pre': 150, 'Obs.PostBBW': 150, 'Obs.PostDickNielsen': 150}
+    assert len(PricesAll) == 1
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+
+import trace_checkpoint
+import trace_plan
+
+
+class FailingConnection:
+    '''
+    Stand-in that fails on every query, to prove cached counts never hit WRDS.
+    '''
+    def raw_sql(self, sql, params=None):
+        raise RuntimeError('no connection')
+
+
+class CountConnection:
+    def __init__(self, counts):
+        self.counts = counts
+
+    def raw_sql(self, sql, params=None):
+        return self.counts[self.counts['cusip_id'].isin(params['cusip_id'])]
+
+
+COUNTS = pd.DataFrame({'cusip_id': ['BIG', 'BIG', 'BIG', 'A', 'B', 'C', 'C'],
+                       'year':     [2010, 2011, 2012, 2011, 2011, 2010, 2012],
+                       'n':        [700, 500, 40, 300, 600, 200, 150]})
+
+
+def test_plan_chunks_packs_to_the_row_budget():
+    plan = trace_plan.plan_chunks(COUNTS, ['A', 'B', 'C', 'BIG', 'NONE'], max_rows=1000, max_cusips=2)
+
+    # BIG is split by year, its last 40 rows stay with 2011
+    big = [(start, end, rows) for cusips, start, end, rows in plan if cusips == ['BIG']]
+    assert big == [(None, pd.Timestamp('2010-12-31'), 700), (pd.Timestamp('2011-01-01'), None, 540)]
+
+    small = sorted((cusips, rows) for cusips, _, _, rows in plan if cusips != ['BIG'])
+    # NONE has no rows, so it is folded into its neighbour in CUSIP order
+    assert small == [(['A'], 300), (['B', 'C', 'NONE'], 950)]
+    assert [rows for *_, rows in plan] == sorted([rows for *_, rows in plan], reverse=True)
+
+
+def test_plan_chunks_only_counts_the_window():
+    plan = trace_plan.plan_chunks(COUNTS, ['BIG', 'C'], start_date='2011-03-01', end_date='2012-06-30', max_rows=1000)
+    assert plan == [(['BIG', 'C'], '2011-03-01', '2012-06-30', 690)]
+
+
+def test_split_years_folds_a_small_first_run_forward():
+    years = pd.Series({2010: 50, 2011: 2000, 2012: 900})
+    assert trace_plan.split_years(years, max_rows=1000) == [(2010, 2011, 2050), (2012, 2012, 900)]
+
+    counts = pd.DataFrame({'cusip_id': 'BIG', 'year': years.index, 'n': years.values})
+    plan = trace_plan.plan_chunks(counts, ['BIG'], max_rows=1000)
+    assert plan == [(['BIG'], None, pd.Timestamp('2011-12-31'), 2050), (['BIG'], pd.Timestamp('2012-01-01'), None, 900)]
+
+
+def test_plan_chunks_folds_small_bins():
+    counts = pd.DataFrame({'cusip_id': ['A', 'B', 'T1', 'T2'],
+                           'year':     [2011] * 4,
+                           'n':        [990, 985, 40, 20]})
+    plan = trace_plan.plan_chunks(counts, ['A', 'B', 'T1', 'T2'], max_rows=1000, max_cusips=2)
+    # T1 and T2 alone would be a unit of 60 rows, skipped by the cleaning
+    assert [(cusips, rows) for cusips, _, _, rows in plan] == [(['B', 'T1', 'T2'], 1045), (['A'], 990)]
+
+    # a neighbour with room for the CUSIPs is preferred over the smaller one
+    bins = trace_plan.fold_small_bins([[['A'], 990], [['T'], 40], [['U', 'V'], 950]], max_cusips=2)
+    assert bins == [[['A', 'T'], 1030], [['U', 'V'], 950]]
+
+
+def test_plan_chunks_keeps_the_chunk_keys_when_the_counts_change():
+    rng = np.random.default_rng(7)
+    cusips = [f'{i:05d}AB1' for i in range(100)]
+    counts = pd.DataFrame({'cusip_id': cusips, 'year': 2011, 'n': rng.integers(50, 400, 100)})
+
+    def chunk_keys(counts, cusips):
+        plan = trace_plan.plan_chunks(counts, cusips, max_rows=2000, max_cusips=50)
+        return {trace_checkpoint.chunk_key(*unit[:3]) for unit in plan}
+
+    keys = chunk_keys(counts, cusips)
+    # a refresh that adds 2% of trades to every bond
+    assert chunk_keys(counts.assign(n=(counts['n'] * 1.02).round().astype('int64')), cusips) == keys
+    # a new bond only changes the chunk it falls into
+    added = pd.concat([counts, pd.DataFrame({'cusip_id': ['00050AB2'], 'year': [2011], 'n': [100]})])
+    assert len(keys - chunk_keys(added, cusips + ['00050AB2'])) == 1
+
+
+def test_load_row_counts_caches_statistics(tmp_path):
+    path = tmp_path / 'counts.csv'
+    first = trace_plan.load_row_counts(CountConnection(COUNTS), ['A', 'BIG', 'NONE'], path=path)
+    cached = trace_plan.load_row_counts(FailingConnection(), ['BIG', 'NONE'], path=path)
+
+    assert first['n'].sum() == 1540
+    # CUSIPs without trades are recorded, so they are not counted again
+    assert cached.sort_values(['cusip_id', 'year']).reset_index(drop=True).equals(
+        first[first['cusip_id'] != 'A'].sort_values(['cusip_id', 'year']).reset_index(drop=True))
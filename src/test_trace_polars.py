@@ -0,0 +1,61 @@
+import pandas as pd
+import polars as pl
+from pandas.testing import assert_frame_equal
+
+import load_trace
+import trace_clean
+import trace_polars
+import trace_synth
+from test_load_trace import CUSIPS, TRACE, SqliteConnection
+from test_trace_clean import random_trades, trade
+
+
+def assert_same_outputs(expected, result):
+    for expected_frame, frame in zip(expected[:3], result[:3]):
+        assert_frame_equal(expected_frame, frame, check_exact=True)
+    assert expected[3] == result[3]
+
+
+def test_polars_backend_matches_pandas_exactly():
+    trace, _ = trace_synth.synthetic_trace(30000, n_cusips=30, seed=5)
+    assert_same_outputs(trace_clean.clean_chunk(trace), trace_polars.clean_chunk(trace))
+
+    window = {'start_date': '2011-06-01', 'end_date': '2013-06-30'}
+    assert_same_outputs(trace_clean.clean_chunk(trace, **window), trace_polars.clean_chunk(trace, **window))
+
+
+def test_polars_aggregation_matches_pandas_exactly():
+    trace = random_trades(40000, 8000)
+    expected = trace_clean.aggregate_trades(trace)
+    result = trace_polars.aggregate_trades(pl.from_pandas(trace.reset_index()).lazy())
+    assert_frame_equal(expected, result, check_exact=True, check_index_type=False)
+
+
+def test_polars_backend_matches_missing_keys():
+    pre, post = {'trd_exctn_dt': '2010-03-01'}, {'trd_exctn_dt': '2013-03-01'}
+    rows = [# a cancellation, a correction and a reversal of trades without a contra party or time
+            trade(1, cntra_mp_id=None, **post),
+            trade(1, cntra_mp_id=None, trc_st='X', **post),
+            trade(2, rptd_pr=101.0, **post),
+            trade(3, trd_exctn_tm=None, **pre),
+            trade(4, trd_exctn_tm=None, trc_st='C', orig_msg_seq_nb='3', **pre),
+            trade(5, trd_exctn_tm=None, rptd_pr=99.0, **pre),
+            trade(6, trd_exctn_tm=None, rptd_pr=98.0, trc_st='W', orig_msg_seq_nb='5', **pre),
+            trade(7, cntra_mp_id=None, rptd_pr=97.0, **pre),
+            trade(8, cntra_mp_id=None, rptd_pr=97.0, asof_cd='R', **pre),
+            trade(9, rptd_pr=100.125, rpt_side_cd='S', **pre)]
+    trace = pd.DataFrame(rows)
+
+    expected = trace_clean.clean_chunk(trace, min_obs=0)
+    assert expected[3]['Obs.PostDickNielsen'] == 4
+    assert_same_outputs(expected, trace_polars.clean_chunk(trace, min_obs=0))
+
+
+def test_run_chunks_polars_backend(tmp_path):
+    cusip_chunks = list(load_trace.divide_chunks(CUSIPS, 3))
+    db = SqliteConnection(TRACE)
+    expected = load_trace.run_chunks(cusip_chunks, connect=lambda: db)
+    result = load_trace.run_chunks(cusip_chunks, connect=lambda: db, backend='polars', checkpoint_dir=tmp_path)
+    for expected_list, result_list in zip(expected[:3], result[:3]):
+        assert_frame_equal(pd.concat(expected_list), pd.concat(result_list), check_exact=True)
+    assert_frame_equal(expected[3], result[3])
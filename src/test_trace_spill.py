@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+import load_trace
+import trace_clean
+import trace_polars
+import trace_spill
+import trace_synth
+from test_load_trace import CUSIPS, FakeConnection
+
+
+def test_date_bounds_never_split_a_date():
+    dates = pd.to_datetime(['2010-01-04'] * 50 + ['2010-01-05'] * 10 + ['2010-01-06'] * 20 + ['2010-01-07'] * 20)
+    bounds = trace_spill.date_bounds(dates, 4)
+    # the first date holds half the trades, so there is one range less
+    assert list(bounds) == list(np.array(['2010-01-05', '2010-01-07'], dtype='datetime64[D]'))
+    assert list(trace_spill.date_bounds(dates[:60], 4)) == [np.datetime64('2010-01-05')]
+    assert len(trace_spill.date_bounds(dates, 1)) == 0
+    assert trace_spill.n_partitions(10**6, memory_budget_mb=0) == 1
+    assert trace_spill.n_partitions(10**6, memory_budget_mb=100) == 4
+
+
+def test_spilled_aggregation_matches_in_memory(tmp_path, monkeypatch):
+    monkeypatch.setattr(trace_spill, 'SPILL_DIR', tmp_path)
+    trace, _ = trace_synth.synthetic_trace(20000, n_cusips=20, seed=4)
+    expected = trace_clean.clean_chunk(trace)
+
+    for cleaner in (trace_clean, trace_polars):
+        # about 6 MB of aggregation in 1 MB partitions
+        result = cleaner.clean_chunk(trace, memory_budget_mb=1)
+        for expected_frame, frame in zip(expected[:3], result[:3]):
+            assert_frame_equal(expected_frame, frame, check_exact=True)
+        assert expected[3] == result[3]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_run_chunks_with_memory_budget(tmp_path, monkeypatch):
+    monkeypatch.setattr(trace_spill, 'SPILL_DIR', tmp_path)
+    cusip_chunks = list(load_trace.divide_chunks(CUSIPS, 3))
+    expected = load_trace.run_chunks(cusip_chunks, connect=FakeConnection)
+    result = load_trace.run_chunks(cusip_chunks, connect=FakeConnection, memory_budget_mb=0.01)
+    for expected_list, result_list in zip(expected[:3], result[:3]):
+        assert_frame_equal(pd.concat(expected_list), pd.concat(result_list), check_exact=True)
+    assert_frame_equal(expected[3], result[3])
@@ -0,0 +1,45 @@
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+import trace_store
+
+
+def make_illiq():
+    return pd.DataFrame({'cusip_id': ['B', 'A', 'A', 'B', 'A'],
+                         'trd_exctn_dt': pd.to_datetime(['2011-01-03', '2011-01-03', '2010-12-31',
+                                                         '2010-06-01', '2012-02-01']),
+                         'prc_bid': [101.0, 100.5, 100.0, 99.0, 98.0],
+                         'prc_ask': [100.0, 100.0, 99.5, 98.5, 97.0]}).set_index(['cusip_id', 'trd_exctn_dt'])
+
+
+def test_round_trip_is_sorted_and_partitioned_by_year(tmp_path):
+    illiq = make_illiq()
+    trace_store.write_dataset(illiq, 'Illiq', store_dir=tmp_path)
+
+    assert sorted(p.name for p in (tmp_path / 'Illiq').iterdir()) == ['year=2010', 'year=2011', 'year=2012']
+    df = trace_store.read_dataset('Illiq', store_dir=tmp_path)
+    assert_frame_equal(df, illiq.sort_index().reset_index())
+
+
+def test_read_pushes_down_columns_and_dates(tmp_path):
+    trace_store.write_dataset(make_illiq(), 'Illiq', store_dir=tmp_path)
+    df = trace_store.read_dataset('Illiq', columns=['prc_bid'], start_date='2010-12-31', end_date='2011-01-03',
+                                  store_dir=tmp_path)
+
+    assert list(df.columns) == ['cusip_id', 'trd_exctn_dt', 'prc_bid']
+    assert list(df['cusip_id']) == ['A', 'A', 'B']
+    assert list(df['prc_bid']) == [100.0, 100.5, 101.0]
+
+
+def test_cusip_partitions_stack_to_the_dataset(tmp_path):
+    illiq = make_illiq()
+    trace_store.write_dataset(illiq, 'Illiq', store_dir=tmp_path)
+
+    counts = trace_store.cusip_counts('Illiq', store_dir=tmp_path)
+    assert counts.to_dict() == {'A': 3, 'B': 2}
+    assert trace_store.cusip_ranges(counts, partition_rows=1) == [('A', 'A'), ('B', 'B')]
+    assert trace_store.cusip_ranges(counts, partition_rows=10) == [('A', 'B')]
+
+    parts = list(trace_store.iter_cusip_partitions('Illiq', partition_rows=1, store_dir=tmp_path))
+    assert [list(part['cusip_id'].unique()) for part in parts] == [['A'], ['B']]
+    assert_frame_equal(pd.concat(parts, ignore_index=True), trace_store.read_dataset('Illiq', store_dir=tmp_path))
@@ -0,0 +1,40 @@
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+import load_trace
+import trace_clean
+import trace_query
+import trace_synth
+import wrds_local
+
+
+def test_cleaning_recovers_the_ground_truth():
+    trace, survives = trace_synth.synthetic_trace(20000, n_cusips=30, seed=3)
+    assert list(trace.columns) == trace_query.TRACE_COLUMNS
+    assert {'T', 'R', 'X', 'C', 'Y', 'W'} <= set(trace['trc_st'])
+    assert {'R', 'D', 'X'} <= set(trace['asof_cd'].dropna())
+
+    filtered, _ = trace_clean.filter_rows(trace)
+    pre, post = trace_clean.split_pre_post(filtered)
+    cleaned = trace_clean.combine_pre_post(trace_clean.clean_pre_2012(pre), trace_clean.clean_post_2012(post))
+    expected = trace_synth.expected_trades(trace, survives)
+
+    def ordered(trades):
+        trades = trades.reset_index().astype({'rpt_side_cd': object})
+        return trades.sort_values(list(trades.columns), ignore_index=True)
+    assert_frame_equal(ordered(cleaned), ordered(expected))
+
+    # the same seed gives the same data
+    again, _ = trace_synth.synthetic_trace(20000, n_cusips=30, seed=3)
+    assert_frame_equal(trace, again)
+
+
+def test_seeded_local_backend_runs_the_pull(tmp_path):
+    trace_synth.write_local(5000, tmp_path, n_cusips=20)
+    db = wrds_local.LocalConnection(tmp_path)
+
+    fisd = load_trace.load_fisd(db)
+    assert sorted(fisd['complete_cusip']) == list(trace_synth.cusip_ids(0, 20))
+    PricesAll, _, _, stats = load_trace.process_chunk(db, list(fisd['complete_cusip']))
+    assert stats['Obs.PostDickNielsen'] > 0
+    assert set(PricesAll.index.get_level_values('cusip_id')) <= set(fisd['complete_cusip'])
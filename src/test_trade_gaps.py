@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+from pandas.tseries.holiday import USFederalHolidayCalendar
+
+import trade_gaps
+
+
+def reference_trades_info(df, start_date, end_date):
+    '''
+    The merge-based get_trades_info of calc_spread_bias.py and
+    calc_daily_return_cs.py before trade_gaps.py.
+    '''
+    holiday_date_list = USFederalHolidayCalendar().holidays(start_date, end_date).date.tolist()
+    df = df.rename(columns={'trd_exctn_dt': 'date'})
+    df['date_lag'] = df.groupby('cusip_id')['date'].shift(1)
+    dfDC = df.dropna()
+    dfDC['n'] = np.busday_count(dfDC['date_lag'].values.astype('M8[D]'),
+                                dfDC['date'].values.astype('M8[D]'),
+                                holidays=holiday_date_list)
+    df = df.merge(dfDC[['cusip_id', 'date', 'n']], on=['cusip_id', 'date'], how='left')
+    df = df.dropna()
+    df['month_year'] = pd.to_datetime(df['date']).dt.to_period('M')
+    df['trade_counts'] = df.groupby(['cusip_id', 'month_year'])['date'].transform('count')
+    return df
+
+
+def make_panel(n_bonds=40, seed=0):
+    rng = np.random.default_rng(seed)
+    days = pd.bdate_range('2010-11-01', '2011-03-31')
+    frames = []
+    for i in range(n_bonds):
+        dates = np.sort(rng.choice(days, rng.integers(1, 60), replace=False))
+        frames.append(pd.DataFrame({'cusip_id': f'{i:06d}AB1', 'trd_exctn_dt': dates,
+                                    'prclean': rng.normal(100, 5, len(dates))}))
+    panel = pd.concat(frames, ignore_index=True)
+    # missing prices drop a row but still count as the previous trade
+    panel.loc[rng.random(len(panel)) < 0.05, 'prclean'] = np.nan
+    return panel
+
+
+def test_trades_info_matches_merge_version():
+    panel = make_panel()
+    expected = reference_trades_info(panel.copy(), '2010-01-01', '2011-12-31')
+    result = trade_gaps.get_trades_info(panel, '2010-01-01', '2011-12-31')
+    assert_frame_equal(expected, result, check_dtype=False)
+    assert result['n'].dtype == 'int64'
+
+    # Thanksgiving is not a business day
+    bond = pd.DataFrame({'cusip_id': 'X', 'date': pd.to_datetime(['2010-11-24', '2010-11-26', '2010-11-29'])})
+    assert list(trade_gaps.get_trades_info(bond, '2010-01-01', '2011-12-31')['n']) == [1, 1]
+    filtered = trade_gaps.filter_trades(result, min_trades=5, max_gap=5)
+    assert (filtered['trade_counts'] >= 5).all() and (filtered['n'] <= 5).all()
+    assert len(filtered) == int(((result['trade_counts'] >= 5) & (result['n'] <= 5)).sum())
+
+
+def test_trades_info_follows_row_order_within_bond():
+    panel = make_panel(n_bonds=10, seed=1)
+    # bonds interleaved, each still in date order
+    shuffled = panel.sort_values('trd_exctn_dt', kind='stable')
+    expected = reference_trades_info(shuffled.copy(), '2010-01-01', '2011-12-31')
+    result = trade_gaps.get_trades_info(shuffled, '2010-01-01', '2011-12-31')
+    assert_frame_equal(expected, result, check_dtype=False)
+
+    empty = trade_gaps.get_trades_info(panel.iloc[:0], '2010-01-01', '2011-12-31')
+    assert empty.empty and list(empty.columns) == list(result.columns)
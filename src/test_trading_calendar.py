@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+from pandas.tseries.holiday import USFederalHolidayCalendar
+
+import trading_calendar
+
+
+def test_counts_match_busday_count():
+    holidays = USFederalHolidayCalendar().holidays('2000-01-01', '2030-12-31').values.astype('M8[D]')
+    calendar = trading_calendar.BusinessCalendar(holidays, start='2000-01-01', end='2030-12-31')
+    rng = np.random.default_rng(0)
+    # dates on both sides of the table, in either order
+    begin = np.datetime64('1995-01-01') + rng.integers(0, 14000, 10000)
+    end = begin + rng.integers(-30, 400, 10000)
+    assert (calendar.count(begin, end) == np.busday_count(begin, end, holidays=holidays)).all()
+    assert (calendar.is_trading_day(begin) == np.is_busday(begin, holidays=holidays)).all()
+
+
+def test_sifma_holidays():
+    federal = trading_calendar.get_calendar('federal', '2020-01-01', '2023-12-31')
+    sifma = trading_calendar.get_calendar('sifma', '2020-01-01', '2023-12-31')
+    assert trading_calendar.get_calendar('sifma', '2020-01-01', '2023-12-31') is sifma
+
+    # Good Friday is a bond market holiday, not a federal one
+    good_friday = pd.to_datetime(['2021-04-02', '2023-04-07'])
+    assert not sifma.is_trading_day(good_friday).any()
+    assert federal.is_trading_day(good_friday).all()
+    # New Year's Day 2022 fell on a Saturday: the bond market stayed open on Friday
+    assert sifma.is_trading_day(['2021-12-31']).all()
+    assert not federal.is_trading_day(['2021-12-31']).any()
+
+    days = sifma.trading_days('2023-04-03', '2023-04-10')
+    assert list(days.strftime('%a')) == ['Mon', 'Tue', 'Wed', 'Thu', 'Mon']
+    assert list(sifma.count(['2023-04-06'], ['2023-04-10'])) == [1]
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+from scipy.stats.mstats import winsorize as scipy_winsorize
+
+import winsorize
+
+
+def test_rank_selector_matches_scipy():
+    rng = np.random.default_rng(0)
+    values = np.round(rng.standard_cauchy(20_000), 2)
+    # a mass of ties and both signs, like the bias of bonds quoted at one price
+    values[:5_000] = 0.0
+    values[5_000:5_100] = -0.0
+    chunks = np.array_split(values, 9)
+
+    # few candidates force the selection through every level of the keys
+    selector = winsorize.RankSelector(max_candidates=10)
+    for chunk in chunks:
+        selector.add(chunk)
+    winsorizer = winsorize.Winsorizer([0.005, 0.005]).fit_selector(selector, lambda: iter(chunks))
+
+    expected = np.asarray(scipy_winsorize(values.copy(), limits=[0.005, 0.005]))
+    np.testing.assert_array_equal(winsorizer.transform(values), expected)
+    assert selector.select(0, lambda: iter(chunks)) == values.min()
+    assert selector.select(len(values) - 1, lambda: iter(chunks)) == values.max()
+
+
+def test_winsorize_matches_scipy():
+    rng = np.random.default_rng(1)
+    for limits in ([0.005, 0.005], [0.05, 0.2], [0, 0.1], [0.1, None], [0.6, 0.6]):
+        for missing in (0, 0.001, 0.3):
+            values = np.round(rng.normal(size=2_000), 1)
+            values[rng.random(len(values)) < missing] = np.nan
+            expected = np.asarray(scipy_winsorize(values.copy(), limits=limits), dtype='float64')
+            np.testing.assert_array_equal(winsorize.winsorize(values, limits), expected)
+
+
+def test_fitted_bounds_are_reapplied():
+    values = np.arange(1000.0)
+    winsorizer = winsorize.Winsorizer([0.01, 0.02]).fit(values)
+    assert (winsorizer.lower, winsorizer.upper) == (10.0, 979.0)
+    np.testing.assert_array_equal(winsorizer.transform([-5.0, 500.0, 2000.0, np.nan]), [10.0, 500.0, 979.0, np.nan])
+    # the missing values of the fitted column are ranked last and fall in the top cut, like in scipy
+    with_missing = np.r_[values, np.nan]
+    np.testing.assert_array_equal(winsorize.winsorize(with_missing, [0.01, 0.02])[-1], 980.0)
+
+
+def test_winsorize_by_date_matches_scipy_per_date():
+    rng = np.random.default_rng(2)
+    dates = pd.Timestamp('2010-01-04') + pd.to_timedelta(rng.integers(0, 30, 20_000), 'D')
+    values = np.round(rng.normal(size=len(dates)), 1)
+    values[rng.random(len(values)) < 0.002] = np.nan
+    expected = pd.Series(values).groupby(dates).transform(
+        lambda s: np.asarray(scipy_winsorize(s.to_numpy().copy(), limits=[0.05, 0.05]), dtype='float64'))
+
+    for workers in (1, 4):
+        winsorized = winsorize.winsorize_by_date(values, dates, [0.05, 0.05], workers=workers)
+        np.testing.assert_array_equal(winsorized, expected.to_numpy())
+
+    # dates fitted in blocks give the same bounds, and dates never fitted are not clipped
+    first = dates < pd.Timestamp('2010-01-20')
+    winsorizer = winsorize.DateWinsorizer([0.05, 0.05])
+    winsorizer.fit(values[first], dates[first]).fit(values[~first], dates[~first])
+    np.testing.assert_array_equal(winsorizer.transform(values, dates), expected.to_numpy())
+    assert winsorizer.transform([1e9], [pd.Timestamp('2011-01-03')])[0] == 1e9
@@ -0,0 +1,69 @@
+import json
+import os
+import time
+
+import pandas as pd
+from pandas.testing import assert_frame_equal
+import pytest
+
+import wrds_cache
+
+
+class CountingConnection:
+    '''
+    Stand-in for wrds.Connection that returns a frame per query and counts the queries.
+    '''
+    def __init__(self):
+        self.queries = 0
+
+    def raw_sql(self, sql, params=None):
+        self.queries += 1
+        n = len(params['cusip_id']) if params else 3
+        return pd.DataFrame({'cusip_id': [f'{i:06d}AA{i}' for i in range(n)],
+                             'trd_exctn_dt': [pd.Timestamp('2012-03-01').date()] * n,
+                             'rptd_pr': [100.0 + i for i in range(n)],
+                             'asof_cd': [None] * n})
+
+
+def test_cache_serves_repeated_queries(tmp_path):
+    db = CountingConnection()
+    cached = wrds_cache.CachedConnection(db, cache_dir=tmp_path)
+    params = {'cusip_id': ('A', 'B')}
+
+    first = cached.raw_sql('SELECT *\n  FROM trace.trace_enhanced\n WHERE cusip_id IN %(cusip_id)s', params)
+    again = cached.raw_sql('SELECT * FROM trace.trace_enhanced WHERE cusip_id IN %(cusip_id)s', params)
+    assert db.queries == 1
+    assert_frame_equal(first, again)
+
+    cached.raw_sql('SELECT * FROM trace.trace_enhanced WHERE cusip_id IN %(cusip_id)s', {'cusip_id': ('A',)})
+    assert db.queries == 2
+
+    # offline mode serves the cache and fails on anything else
+    offline = wrds_cache.CachedConnection(cache_dir=tmp_path, offline=True)
+    assert_frame_equal(offline.raw_sql('SELECT * FROM trace.trace_enhanced WHERE cusip_id IN %(cusip_id)s', params),
+                       first)
+    with pytest.raises(wrds_cache.CacheMissError):
+        offline.raw_sql('SELECT * FROM fisd.fisd_ratings')
+
+
+def test_cache_expires_and_evicts(tmp_path):
+    db = CountingConnection()
+    cached = wrds_cache.CachedConnection(db, cache_dir=tmp_path, ttl_days=1)
+    cached.raw_sql('SELECT 1')
+    data, meta = cached._paths(wrds_cache.cache_key('SELECT 1'))
+
+    # a result pulled two days ago is pulled again
+    entry = json.loads(meta.read_text())
+    entry['pulled'] = time.time() - 2 * 86400
+    meta.write_text(json.dumps(entry))
+    cached.raw_sql('SELECT 1')
+    assert db.queries == 2
+
+    # with room for two results the least recently used one is evicted
+    size = data.stat().st_size + meta.stat().st_size
+    cached.max_bytes = 2.5 * size
+    cached.raw_sql('SELECT 2')
+    os.utime(data, (0, 0))
+    cached.raw_sql('SELECT 3')
+    remaining = {path.stem for path in tmp_path.glob('*.parquet')}
+    assert remaining == {wrds_cache.cache_key('SELECT 2'), wrds_cache.cache_key('SELECT 3')}
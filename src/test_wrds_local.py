@@ -0,0 +1,38 @@
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+import load_trace
+import trace_clean
+import trace_query
+import wrds_local
+from test_load_trace import CUSIPS, TRACE
+
+
+def save_tables(local_dir):
+    wrds_local.save_table(TRACE, 'trace', 'trace_enhanced', local_dir)
+    issue = pd.DataFrame({'complete_cusip': CUSIPS[:3], 'issue_id': [1, 2, 3], 'issuer_id': [10, 10, 20],
+                          'offering_date': [pd.Timestamp('2005-01-03').date()] * 3})
+    wrds_local.save_table(issue, 'fisd', 'fisd_mergedissue', local_dir)
+
+
+def test_local_connection_answers_trace_queries(tmp_path):
+    save_tables(tmp_path)
+    db = wrds_local.LocalConnection(tmp_path)
+
+    sql, params = trace_query.build_trace_query(CUSIPS[:4], '2011-12-15', '2012-03-15', pushdown=False)
+    pulled = db.raw_sql(sql, params=params)
+    in_window = TRACE[TRACE['cusip_id'].isin(CUSIPS[:4])
+                      & (TRACE['trd_exctn_dt'] >= pd.Timestamp('2011-12-15').date())
+                      & (TRACE['trd_exctn_dt'] <= pd.Timestamp('2012-03-15').date())]
+    assert len(pulled) == len(in_window)
+    # dates come back as datetime.date, like from WRDS
+    assert pulled['trd_exctn_dt'].map(type).eq(type(in_window['trd_exctn_dt'].iloc[0])).all()
+
+    local = load_trace.process_chunk(db, CUSIPS, pushdown=True)
+    expected = trace_clean.clean_chunk(TRACE)
+    for local_frame, expected_frame in zip(local[:3], expected[:3]):
+        assert_frame_equal(local_frame, expected_frame)
+
+    issue = db.raw_sql("""SELECT complete_cusip, issue_id, offering_date
+                          FROM fisd.fisd_mergedissue""")
+    assert list(issue['complete_cusip']) == CUSIPS[:3]
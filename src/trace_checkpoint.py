@@ -0,0 +1,148 @@
+'''
+Overview
+-------------
+Per-chunk checkpoints for load_trace.py.
+Every finished chunk is written to its own partition directory:
+
+    <checkpoint_dir>/<key>/Prices.pkl
+                          /Volumes.pkl
+                          /Illiq.pkl
+                          /chunk.json    (CleaningExport row, CUSIPs, date range, watermark)
+
+The key is a hash of the sorted CUSIP set and the date range of the pull,
+and chunk.json is written last, so a partition only counts as finished
+once all of its outputs are on disk. A rerun skips finished chunks and the
+final export is a concat of the partitions.
+
+The watermark is the latest trd_rpt_dt pulled for the chunk. An
+incremental refresh (load_trace.update_chunk) pulls the bond-days with
+newer reports and upserts their daily rows into the partition.
+'''
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import pandas as pd
+
+import config
+
+DATA_DIR = Path(config.DATA_DIR)
+CHECKPOINT_DIR = DATA_DIR / "pulled" / "trace_chunks"
+
+OUTPUT_NAMES = ['Prices', 'Volumes', 'Illiq']
+
+
+def _date_str(date):
+    return None if date is None else pd.Timestamp(date).strftime('%Y-%m-%d')
+
+
+def chunk_key(cusips, start_date=None, end_date=None):
+    '''
+    This function returns the partition key of a chunk: a short hash of
+    the sorted CUSIP set and the date range (None means unbounded).
+    '''
+    payload = json.dumps({'cusips': sorted(set(cusips)),
+                          'start_date': _date_str(start_date),
+                          'end_date': _date_str(end_date)})
+    return hashlib.sha1(payload.encode()).hexdigest()[:16]
+
+
+def chunk_path(cusips, start_date=None, end_date=None, checkpoint_dir=CHECKPOINT_DIR):
+    return Path(checkpoint_dir) / chunk_key(cusips, start_date, end_date)
+
+
+def is_chunk_done(cusips, start_date=None, end_date=None, checkpoint_dir=CHECKPOINT_DIR):
+    '''
+    This function checks whether a finished partition exists for the chunk.
+    '''
+    return (chunk_path(cusips, start_date, end_date, checkpoint_dir) / 'chunk.json').exists()
+
+
+def save_chunk(result, cusips, start_date=None, end_date=None, checkpoint_dir=CHECKPOINT_DIR,
+               watermark=None):
+    '''
+    This function persists the output of trace_clean.clean_chunk
+    (prices, volumes, illiq, stats) for one chunk, with the latest report
+    date pulled for it.
+    Frames that are None (chunks with too few observations) are not written.
+    '''
+    *frames, stats = result
+    path = chunk_path(cusips, start_date, end_date, checkpoint_dir)
+    path.mkdir(parents=True, exist_ok=True)
+
+    for name, frame in zip(OUTPUT_NAMES, frames):
+        if frame is not None:
+            frame.to_pickle(path / f'{name}.pkl')
+
+    manifest = {'cusips': sorted(set(cusips)),
+                'start_date': _date_str(start_date),
+                'end_date': _date_str(end_date),
+                'outputs': [name for name, frame in zip(OUTPUT_NAMES, frames) if frame is not None],
+                'stats': stats,
+                'watermark': _date_str(watermark)}
+    # write to a temporary file first so a crash never leaves a half-written manifest
+    tmp = path / f'chunk.json.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, path / 'chunk.json')
+
+
+def load_chunk(cusips, start_date=None, end_date=None, checkpoint_dir=CHECKPOINT_DIR):
+    '''
+    This function reads a finished partition back in the same
+    (prices, volumes, illiq, stats) form that save_chunk received.
+    '''
+    path = chunk_path(cusips, start_date, end_date, checkpoint_dir)
+    with open(path / 'chunk.json') as f:
+        manifest = json.load(f)
+
+    frames = [pd.read_pickle(path / f'{name}.pkl') if name in manifest['outputs'] else None
+              for name in OUTPUT_NAMES]
+    return (*frames, manifest['stats'])
+
+
+def load_manifest(cusips, start_date=None, end_date=None, checkpoint_dir=CHECKPOINT_DIR):
+    '''
+    This function returns the chunk.json of a finished partition as a dict
+    (with the watermark as a Timestamp, None if it was saved without one),
+    or None when the chunk has no finished partition.
+    '''
+    path = chunk_path(cusips, start_date, end_date, checkpoint_dir) / 'chunk.json'
+    if not path.exists():
+        return None
+    with open(path) as f:
+        manifest = json.load(f)
+    watermark = manifest.get('watermark')
+    manifest['watermark'] = None if watermark is None else pd.Timestamp(watermark)
+    return manifest
+
+
+def upsert_chunk(result, days, cusips, start_date=None, end_date=None, checkpoint_dir=CHECKPOINT_DIR,
+                 watermark=None):
+    '''
+    This function replaces the rows of the bond-days in `days` (a
+    (cusip_id, trd_exctn_dt) MultiIndex) in a finished partition with the
+    frames in result, the clean_chunk output for exactly those bond-days.
+    Bond-days missing from result are deleted. The cleaning statistics
+    of the partition are kept. Upserting the same result twice gives the
+    same partition, so an interrupted refresh can simply be run again.
+    Output: the updated (prices, volumes, illiq, stats)
+    '''
+    *old_frames, stats = load_chunk(cusips, start_date, end_date, checkpoint_dir)
+    *new_frames, _ = result
+
+    frames = []
+    for old, new in zip(old_frames, new_frames):
+        parts = [frame for frame in (old, new) if frame is not None]
+        if not parts:
+            frames.append(None)
+            continue
+        if old is not None:
+            parts[0] = old[~old.index.isin(days)]
+        frames.append(pd.concat(parts).sort_index())
+
+    result = (*frames, stats)
+    save_chunk(result, cusips, start_date, end_date, checkpoint_dir, watermark=watermark)
+    return result
@@ -0,0 +1,837 @@
+'''
+Overview
+-------------
+Dick-Nielsen cleaning of TRACE Enhanced and aggregation to daily data.
+Every function takes and returns DataFrames and has no I/O side effects,
+so the cleaning can run on in-memory data, in worker processes or under a
+profiler. load_trace.py is the driver that pulls the raw rows from WRDS.
+
+The steps follow the SAS code of Dick-Nielsen (2009, 2014):
+1. prepare_trace / filter_volume / split_pre_post
+2. clean_post_2012: cancellations, corrections and reversals after 2012-02-06
+3. clean_pre_2012: BNS filters, cancellations (C), corrections (W) and reversals
+4. aggregate_daily: daily prices, volumes and bid/ask prices
+clean_chunk chains all of them for one chunk of pulled rows. Given a
+trace_profile.StageProfile, the chained functions time every step.
+The one exception to the no-I/O rule is a chunk over its memory budget,
+whose cleaned trades are aggregated through temporary files (trace_spill.py).
+'''
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+import numpy as np
+
+import trace_join
+import trace_profile
+import trace_spill
+
+CLEANING_COLUMNS = ['Obs.Pre',
+                    'Obs.PostBBW',
+                    'Obs.PostDickNielsen']
+
+# Chunks with this many observations or fewer are not cleaned
+MIN_OBS = 100
+
+# Trades with volume below this are removed
+MIN_VOLUME = 10000
+
+# TRACE Enhanced changed its reporting format on this date
+POST_2012_DATE = "2012-02-06"
+
+# Keys shared by a post 2012 trade report and its cancellation,
+# correction or reversal, in addition to the message sequence number
+POST_2012_KEYS = ['cusip_id',        # 1
+                  'trd_exctn_dt',    # 2
+                  'trd_exctn_tm',    # 3
+                  'rptd_pr',         # 4
+                  'entrd_vol_qt',    # 5
+                  'rpt_side_cd',     # 6
+                  'cntra_mp_id']     # 7
+
+# A chain of W corrections shares the execution time stamp of its records
+W_CHAIN_KEYS = ['cusip_id', 'trd_exctn_dt', 'trd_exctn_tm']
+
+# Pre 2012 reversals are numbered within these keys, in the order of
+# REVERSAL_ORDER_KEYS, and matched to records by number
+REVERSAL_GROUP_KEYS = ['cusip_id',
+                       'bond_sym_id',
+                       'trd_exctn_dt',
+                       'entrd_vol_qt',
+                       'rptd_pr',
+                       'rpt_side_cd',
+                       'cntra_mp_id']
+REVERSAL_ORDER_KEYS = ['trd_exctn_tm',
+                       'trd_rpt_dt',
+                       'trd_rpt_tm']
+# Identify a record when joining the reversal matches back
+REVERSAL_RECORD_KEYS = ['cusip_id',
+                        'trd_exctn_dt',
+                        'trd_exctn_tm',
+                        'entrd_vol_qt',
+                        'rptd_pr',
+                        'rpt_side_cd',
+                        'cntra_mp_id',
+                        'msg_seq_nb',
+                        'trd_rpt_dt',
+                        'trd_rpt_tm']
+# Columns of the cleaned trades used by the daily aggregation
+TRADE_COLUMNS = ['cusip_id',
+                 'trd_exctn_dt',
+                 'rptd_pr',
+                 'entrd_vol_qt',
+                 'rpt_side_cd']
+
+
+# Typed ingestion schema. Flags, codes and identifiers become categoricals,
+# the execution and report times integer seconds after midnight.
+# Prices and volumes stay float64: the daily prices are rounded to 4
+# decimals and float32 would change them.
+CATEGORY_COLUMNS = ['cusip_id',
+                    'bond_sym_id',
+                    'trc_st',
+                    'asof_cd',
+                    'rpt_side_cd',
+                    'cntra_mp_id']
+# The BNS indicators are compared as strings, so a missing value is the category 'None'
+INDICATOR_COLUMNS = ['days_to_sttl_ct',
+                     'wis_fl',
+                     'lckd_in_ind',
+                     'sale_cndtn_cd']
+TIME_COLUMNS = ['trd_exctn_tm', 'trd_rpt_tm']
+FLOAT_DTYPES = {'entrd_vol_qt': 'float64',
+                'rptd_pr':      'float64',
+                'yld_pt':       'float32'}
+
+
+def parse_seconds(times):
+    '''
+    This function converts 'HH:MM:SS' strings (or datetime.time values)
+    to integer seconds after midnight, as a nullable Int32 column.
+    Each distinct time stamp is parsed only once.
+    '''
+    codes, uniques = pd.factorize(times)
+    seconds = pd.to_timedelta(pd.Series(uniques, dtype=object).astype(str)).dt.total_seconds().to_numpy()
+    values = pd.array(np.append(seconds, np.nan)[codes], dtype='float64')
+    return pd.Series(values, index=times.index).astype('Int32')
+
+
+def compact_trace(trace):
+    '''
+    This function converts the raw trace_enhanced rows to the typed
+    ingestion schema in place. Columns already converted are left alone,
+    so it can be called again on its own output.
+    '''
+    for col in CATEGORY_COLUMNS:
+        if col in trace and not isinstance(trace[col].dtype, pd.CategoricalDtype):
+            trace[col] = trace[col].astype('category')
+
+    for col in INDICATOR_COLUMNS:
+        if col in trace and not isinstance(trace[col].dtype, pd.CategoricalDtype):
+            trace[col] = trace[col].astype('str').astype('category')
+
+    for col in TIME_COLUMNS:
+        if col in trace and trace[col].dtype == object:
+            trace[col] = parse_seconds(trace[col])
+
+    for col, dtype in FLOAT_DTYPES.items():
+        if col in trace:
+            trace[col] = trace[col].astype(dtype)
+
+    return trace
+
+
+def bytes_per_trade(trace):
+    '''
+    This function returns the memory use of a trace frame in bytes per row,
+    counting the contents of object columns.
+    '''
+    return trace.memory_usage(deep=True, index=False).sum() / max(len(trace), 1)
+
+
+def prepare_trace(trace):
+    '''
+    This function converts the dates to datetime and the other columns to
+    the typed ingestion schema of compact_trace. The settlement, when-issued,
+    locked-in and sale condition indicators become categoricals of their
+    string values.
+    '''
+    trace = trace.copy()
+
+    # Convert dates to datetime
+    trace['trd_exctn_dt']         = pd.to_datetime(trace['trd_exctn_dt'], format = '%Y-%m-%d')
+    trace['trd_rpt_dt']           = pd.to_datetime(trace['trd_rpt_dt'],   format = '%Y-%m-%d')
+
+    #* ************************************ */
+    #* Variable Handling                    */
+    #* ************************************ */
+    # Settlement, when-issued, locked-in and sale condition indicators,
+    # codes and identifiers to categoricals, times to seconds
+    return compact_trace(trace)
+
+
+def filter_volume(trace, min_volume=MIN_VOLUME):
+    '''
+    This function removes trades with volume below min_volume.
+    '''
+    # Remove trades with volume < $10,000
+    trace = trace[ (trace['entrd_vol_qt']) >= min_volume  ]
+
+    return trace
+
+
+def filter_dates(trace, start_date=None, end_date=None):
+    '''
+    This function keeps the trades executed between start_date and
+    end_date (inclusive, None means unbounded).
+    '''
+    if start_date is not None:
+        trace = trace[trace['trd_exctn_dt'] >= pd.Timestamp(start_date)]
+    if end_date is not None:
+        trace = trace[trace['trd_exctn_dt'] <= pd.Timestamp(end_date)]
+    return trace
+
+
+def split_pre_post(trace):
+    '''
+    This function splits the trades on the report date into the
+    pre and post 2012-02-06 reporting formats.
+    Output: pre, post
+    '''
+
+    #* ************************************ */
+    #* 1.0 Parsing out Post 2012/02/06 Data */
+    #* ************************************ */
+    post= trace[(trace['cusip_id'] != '') & (trace['trd_rpt_dt'] >=POST_2012_DATE)]
+    pre = trace[(trace['cusip_id'] != '') & (trace['trd_rpt_dt'] < POST_2012_DATE)]
+
+    return pre, post
+
+
+def clean_post_2012(post, remove_reversals=False, profile=trace_profile.NO_PROFILE):
+    '''
+    This function removes cancellations and corrections (C/X) from trades
+    reported on or after 2012-02-06, and with remove_reversals also the
+    trades reversed by a Y record.
+    remove_reversals defaults to False: the original merge-based version
+    filtered on the C/X match column after the Y merge, so reversals never
+    removed any trade, and the default keeps those outputs unchanged.
+    '''
+    #* ************************************** */
+    #* 1.1 Remove Cancellation and Correction */
+    #* ************************************** */
+
+    # * Match Cancellation and Correction using following 7 keys:
+    # * Cusip_id, Execution Date and Time, Quantity, Price, Buy/Sell Indicator, Contra Party
+    # * C and X records show the same MSG_SEQ_NB as the original record;
+
+    post_tr = post[(post['trc_st'] == 'T') | (post['trc_st'] == 'R')]
+    post_xc = post[(post['trc_st'] == 'X') | (post['trc_st'] == 'C')]
+    post_y  = post[(post['trc_st'] == 'Y')]
+
+    # Remove the matched "Trade Report" observations;
+    clean_post1 = profile.run('post_cx_removal', trace_join.anti_join, post_tr, post_xc,
+                              POST_2012_KEYS + ['msg_seq_nb'])
+
+    #* ******************** */
+    #* 1.2 Remove Reversals */
+    #* ******************** */
+
+    # * Match Reversal using the same 7 keys:
+    # * Cusip_id, Execution Date and Time, Quantity, Price, Buy/Sell Indicator, Contra Party
+    # * R records show ORIG_MSG_SEQ_NB matching orignal record MSG_SEQ_NB;
+    if remove_reversals:
+        clean_post1 = profile.run('post_y_reversals', trace_join.anti_join, clean_post1, post_y,
+                                  left_on  = POST_2012_KEYS + ['msg_seq_nb'],
+                                  right_on = POST_2012_KEYS + ['orig_msg_seq_nb'])
+
+    # Matching only looks at the row values, so deduplicating after the
+    # anti-joins keeps the same rows as deduplicating post_tr first
+    clean_post2 = profile.run('post_dedup', clean_post1.drop_duplicates)
+
+    return clean_post2
+
+
+def bns_mask(pre):
+    '''
+    This function returns the boolean mask of the van Binsbergen, Nozawa
+    and Schwert filters. It only looks at each row's own values.
+    '''
+    #* ************************************ */
+    #*  van Binsbergen, Nozawa, and Schwert */
+    #*  We restrict the bond transactions in */
+    #*  our sample by removing those that are */
+    #*  whenissued, have special conditions, are  */
+    #*  locked in, and have days-to-settlement  */
+    #*  of more than two */
+    #*  days in the pre-2012 database */
+    #* ************************************ */
+
+    # Remove trades with > 2-days to settlement #
+    # Keep all with days_to_sttl_ct equal to None, 000, 001 or 002
+    mask = pre['days_to_sttl_ct'].isin(['002', '000', '001', 'None']).to_numpy()
+
+    # Remove when-issued indicator #
+    mask &= (pre['wis_fl'] != 'Y').to_numpy()
+
+    # Remove locked-in indicator #
+    mask &= (pre['lckd_in_ind'] != 'Y').to_numpy()
+
+    # Remove trades with special conditions #
+    mask &= pre['sale_cndtn_cd'].isin(['None', '@']).to_numpy()
+
+    return mask
+
+
+def filter_pre_2012(pre):
+    '''
+    This function applies the van Binsbergen, Nozawa and Schwert filters
+    to trades reported before 2012-02-06.
+    '''
+    return pre[bns_mask(pre)]
+
+
+def remove_pre_cancellations(pre):
+    '''
+    This function removes the T records cancelled by a C record.
+    Output: clean_pre1 (the remaining T records), pre_w (the W records)
+    '''
+    #* ********************************* */
+    #* 2.1 Remove Cancellation Cases (C) */
+    #* ********************************* */
+    pre_c = pre[pre['trc_st'] == 'C']
+    pre_w = pre[pre['trc_st'] == 'W']
+    pre_t = pre[pre['trc_st'] == 'T']
+
+    # Match Cancellation by the 7 keys:
+    # Cusip_ID, Execution Date and Time, Quantity, Price, Buy/Sell Indicator, Contra Party
+    # C records show ORIG_MSG_SEQ_NB matching orignal record MSG_SEQ_NB;
+    merged = pd.merge(pre_t.drop_duplicates(), pre_c[[
+                      'cusip_id',
+                      'trd_exctn_dt',
+                      'trd_exctn_tm',
+                      'rptd_pr',
+                      'entrd_vol_qt',
+                      'trd_rpt_dt',
+                      'orig_msg_seq_nb',
+                      'trc_st']],
+                       left_on=[        'cusip_id',
+                                        'trd_exctn_dt',
+                                        'trd_exctn_tm',
+                                        'rptd_pr',
+                                        'entrd_vol_qt',
+                                        'trd_rpt_dt',
+                                        'msg_seq_nb'], # msg
+                                      right_on=['cusip_id',
+                                        'trd_exctn_dt',
+                                        'trd_exctn_tm',
+                                        'rptd_pr',
+                                        'entrd_vol_qt',
+                                        'trd_rpt_dt',
+                                        'orig_msg_seq_nb']  ,  # orig_msg
+                    how = "left")
+
+
+    merged = merged.drop_duplicates()
+
+    # Filter out C cases
+    _del_c     = merged[merged['trc_st_y'] == 'C']
+    clean_pre1 = merged[merged['trc_st_y'] != 'C']
+
+    # Clean-up clean_pre1#
+    clean_pre1 = clean_pre1.drop(['orig_msg_seq_nb_y', 'trc_st_y'], axis = 1)
+    clean_pre1 = clean_pre1.rename(columns={'trc_st_x':'trc_st',
+                                            'orig_msg_seq_nb_x':'orig_msg_seq_nb'})
+
+    return clean_pre1, pre_w
+
+
+def chain_roots(msg_node, orig_node, n_nodes, max_depth=64):
+    '''
+    This function follows the edges msg_node -> orig_node (node ids in
+    [0, n_nodes), one edge per W record) by pointer jumping.
+    Output: root (the node each record's chain ends in), is_terminal (the
+    records no other record points at, whose chain resolved)
+    '''
+    parent = np.arange(n_nodes)
+    parent[msg_node] = orig_node
+    for _ in range(max_depth):
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            break
+        parent = grandparent
+
+    is_orig = np.zeros(n_nodes, dtype=bool)
+    is_orig[orig_node] = True
+    root = parent[msg_node]
+    resolved = parent[root] == root
+    return root, ~is_orig[msg_node] & resolved
+
+
+def resolve_w_chains(pre_w, max_depth=64):
+    '''
+    This function resolves chains of W corrections. Within a
+    (cusip_id, trd_exctn_dt, trd_exctn_tm) every W record is an edge
+    msg_seq_nb -> orig_msg_seq_nb. A W can correct an older W, which then
+    corrects the original T. Each chain is followed from its terminal W
+    (one that no other W corrects) back to its root, the msg_seq_nb of the
+    record the chain started from. Pointer jumping resolves all chains at
+    once in at most log2(chain length) vectorized steps.
+    Chains longer than 2**max_depth or running into a cycle are dropped.
+    Output: w_clean, the terminal W records with orig_msg_seq_nb set to the
+    root of their chain
+    '''
+    # node ids shared by msg_seq_nb and orig_msg_seq_nb within the same time stamp
+    msg_node, orig_node, n_nodes = trace_join.encode_keys(pre_w, pre_w,
+                                                          left_on  = W_CHAIN_KEYS + ['msg_seq_nb'],
+                                                          right_on = W_CHAIN_KEYS + ['orig_msg_seq_nb'])
+    root, is_terminal = chain_roots(msg_node, orig_node, n_nodes, max_depth)
+
+    node_msg = np.empty(n_nodes, dtype=object)
+    node_msg[orig_node] = pre_w['orig_msg_seq_nb'].to_numpy()
+
+    w_clean = pre_w[is_terminal].assign(orig_msg_seq_nb = node_msg[root[is_terminal]])
+    w_clean = w_clean.drop_duplicates(subset = ['orig_msg_seq_nb',
+                                                'cusip_id',
+                                                'trd_exctn_dt',
+                                                'trd_exctn_tm',
+                                                'msg_seq_nb'])
+    return w_clean.sort_values(by = W_CHAIN_KEYS, kind = 'stable')
+
+
+def match_w_corrections(clean_pre1, pre_w):
+    '''
+    This function matches resolved W chains to the T records they correct,
+    by cusip_id, execution date and the msg_seq_nb of the chain root.
+    Output: del_t (boolean mask of the clean_pre1 rows to delete),
+    rep_w (the W records replacing them)
+    '''
+    w_clean = resolve_w_chains(pre_w)
+
+    del_t = trace_join.isin_keys(clean_pre1, w_clean,
+                                 left_on  = ['cusip_id', 'trd_exctn_dt', 'msg_seq_nb'],
+                                 right_on = ['cusip_id', 'trd_exctn_dt', 'orig_msg_seq_nb'])
+
+    # * Filter out W records with valid matching T;
+    rep_w = w_clean[trace_join.isin_keys(w_clean, clean_pre1[del_t],
+                                         left_on  = ['cusip_id', 'trd_exctn_dt', 'orig_msg_seq_nb'],
+                                         right_on = ['cusip_id', 'trd_exctn_dt', 'msg_seq_nb'])]
+    rep_w = rep_w.drop_duplicates(subset = ['cusip_id',
+                                            'trd_exctn_dt',
+                                            'msg_seq_nb',
+                                            'orig_msg_seq_nb',
+                                            'rptd_pr',
+                                            'entrd_vol_qt'])
+    return del_t, rep_w
+
+
+def apply_pre_corrections(clean_pre1, pre_w):
+    '''
+    This function replaces the T records corrected by a chain of W
+    records with the last W of the chain.
+    '''
+    #* ******************************* */
+    #* 2.2 Remove Correction Cases (W) */
+    #* ******************************* */
+    clean_pre1 = clean_pre1.drop_duplicates()
+    del_t, rep_w = match_w_corrections(clean_pre1, pre_w)
+
+    # * Delete matched T records and replace them with the corresponding W records;
+    clean_pre3 = pd.concat([clean_pre1[~del_t], rep_w], axis = 0)
+
+    return clean_pre3
+
+
+def _sort_codes(values):
+    '''
+    Ordinal codes of a column, with missing values last as in sort_values.
+    '''
+    codes, uniques = pd.factorize(values, sort=True)
+    return np.where(codes < 0, len(uniques), codes)
+
+
+def _group_ranks(group, order):
+    '''
+    Occurrence rank (0, 1, ...) of every row within its group, in the
+    order given by the list of ordinal code arrays `order`.
+    One stable lexsort, then ranks from the group boundaries.
+    '''
+    idx = np.lexsort(order[::-1] + [group])
+    sorted_group = group[idx]
+    positions = np.arange(len(idx))
+    is_start = np.ones(len(idx), dtype=bool)
+    is_start[1:] = sorted_group[1:] != sorted_group[:-1]
+    group_start = np.maximum.accumulate(np.where(is_start, positions, 0))
+
+    ranks = np.empty(len(idx), dtype='int64')
+    ranks[idx] = positions - group_start
+    return ranks
+
+
+def _reversal_ranks(df, order_keys, with_exec_time):
+    '''
+    Occurrence ranks within REVERSAL_GROUP_KEYS, and with exec time also
+    within REVERSAL_GROUP_KEYS + trd_exctn_tm. Like groupby().cumcount(),
+    rows with a missing group key get no rank (-1).
+    '''
+    group, _, _ = trace_join.encode_keys(df, df.iloc[:0], REVERSAL_GROUP_KEYS)
+    order = [_sort_codes(df[key]) for key in order_keys]
+    has_na = df[REVERSAL_GROUP_KEYS].isna().any(axis=1).to_numpy()
+
+    ranks6 = np.where(has_na, -1, _group_ranks(group, order))
+    if not with_exec_time:
+        return ranks6, None
+
+    # trd_exctn_tm is the first order key, so its codes split the same
+    # sorted runs into the 7-key groups
+    group7 = group * (order[0].max(initial=0) + 1) + order[0]
+    has_na7 = has_na | df['trd_exctn_tm'].isna().to_numpy()
+    ranks7 = np.where(has_na7, -1, _group_ranks(group7, order[1:]))
+    return ranks6, ranks7
+
+
+def _rank_match(clean_pre4, rev, match_keys, pre_ranks, rev_ranks):
+    pre_codes, rev_codes, _ = trace_join.encode_keys(clean_pre4, rev, match_keys)
+    matched = trace_join.isin_keys(pd.DataFrame({'key': pre_codes, 'seq': pre_ranks}),
+                                   pd.DataFrame({'key': rev_codes, 'seq': rev_ranks}),
+                                   ['key', 'seq'])
+    # records without a rank are never matched
+    return matched & (pre_ranks >= 0)
+
+
+def reversal_keep_mask(clean_pre4, rev, with_exec_time=False):
+    '''
+    This function matches the reversals in rev (asof_cd = 'R') to the
+    records in clean_pre4 they reverse.
+    Records and reversals are numbered within CUSIP, bond symbol, execution
+    date, volume, price, buy/sell and contra party, ordered by execution
+    time, report date and time. The n-th reversal then removes the n-th
+    record (Option B: 6 keys, without execution time). With with_exec_time
+    the 7-key variant (Option A, execution time added to the keys) is
+    computed from the same sort.
+    Records with a missing key are never matched. A record is kept if it,
+    or a record with the same REVERSAL_RECORD_KEYS, is unmatched.
+    Output: boolean keep mask aligned to clean_pre4, or (keep6, keep7)
+    '''
+    pre_ranks6, pre_ranks7 = _reversal_ranks(clean_pre4, REVERSAL_ORDER_KEYS + ['msg_seq_nb'], with_exec_time)
+    rev_ranks6, rev_ranks7 = _reversal_ranks(rev, REVERSAL_ORDER_KEYS, with_exec_time)
+
+    match_keys = [key for key in REVERSAL_GROUP_KEYS if key != 'bond_sym_id']
+    matched6 = _rank_match(clean_pre4, rev, match_keys, pre_ranks6, rev_ranks6)
+    keep6 = trace_join.isin_keys(clean_pre4, clean_pre4[~matched6], REVERSAL_RECORD_KEYS)
+    if not with_exec_time:
+        return keep6
+
+    matched7 = _rank_match(clean_pre4, rev, match_keys + ['trd_exctn_tm'], pre_ranks7, rev_ranks7)
+    keep7 = trace_join.isin_keys(clean_pre4, clean_pre4[~matched7], REVERSAL_RECORD_KEYS)
+    return keep6, keep7
+
+
+def remove_pre_reversals(clean_pre3):
+    '''
+    This function removes the reversals (asof_cd = 'R') together with the
+    records they reverse, matched on 6 keys, and the delayed records.
+    '''
+    #* ***************** */
+    #* 2.3 Reversal Case */
+    #* ***************** */
+    _rev = clean_pre3[clean_pre3['asof_cd'] == 'R']
+
+    # * Remove records that are R (reversal) D (Delayed dissemination) and
+    # X (delayed reversal);
+    _clean_pre4 = clean_pre3[~clean_pre3['asof_cd'].isin(['R', 'X', 'D'])]
+
+    # As 6 key matching has a higher record of finding reversal match,
+    # use the 6 keys results;
+    _clean_pre5 = _clean_pre4[reversal_keep_mask(_clean_pre4, _rev)].drop_duplicates()
+
+    return _clean_pre5
+
+
+def clean_pre_2012(pre, profile=trace_profile.NO_PROFILE):
+    '''
+    This function cleans trades reported before 2012-02-06:
+    BNS filters, cancellations, corrections and reversals.
+    '''
+    pre = profile.run('pre_bns_filter', filter_pre_2012, pre)
+    clean_pre1, pre_w = profile.run('pre_c_removal', remove_pre_cancellations, pre)
+    clean_pre3 = profile.run('pre_w_corrections', apply_pre_corrections, clean_pre1, pre_w)
+    return profile.run('pre_reversals', remove_pre_reversals, clean_pre3)
+
+
+def combine_pre_post(_clean_pre5, clean_post2):
+    '''
+    This function stacks the cleaned pre and post 2012 trades, keeping
+    only the columns used for the daily aggregation.
+    '''
+    # * Combine the pre and post data together */;
+    clean_post2 = clean_post2[TRADE_COLUMNS]
+    _clean_pre5 = _clean_pre5[TRADE_COLUMNS]
+
+    trace_post = pd.concat([_clean_pre5, clean_post2], ignore_index=True)
+    # the daily outputs are indexed by plain CUSIP strings
+    trace_post['cusip_id'] = trace_post['cusip_id'].astype(object)
+
+    trace = trace_post.set_index(['cusip_id','trd_exctn_dt']).sort_index(level = 'cusip_id')
+
+    return trace
+
+
+def pairwise_sums(values, starts, sizes):
+    '''
+    This function sums values within consecutive groups given by their
+    starts and sizes with the pairwise summation of numpy's sum, so each
+    group total has the bits of np.sum over that group. The loops run over
+    the position within a group, across all groups at once.
+    Output: array of len(sizes) group sums
+    '''
+    out = np.zeros(len(sizes))
+    # fewer than 8 values are added up in order
+    small = sizes < 8
+    s, n = starts[small], sizes[small]
+    res = np.zeros(len(s))
+    for k in range(7):
+        on = n > k
+        res[on] += values[s[on] + k]
+    out[small] = res
+
+    # up to 128 values go to 8 running sums, then the rest in order
+    mid = (sizes >= 8) & (sizes <= 128)
+    s, n = starts[mid], sizes[mid]
+    lanes = np.arange(8)
+    r = values[s[:, None] + lanes]
+    blocks = n - n % 8
+    for i in range(8, 128, 8):
+        on = blocks > i
+        r[on] += values[s[on, None] + i + lanes]
+    res = ((r[:, 0] + r[:, 1]) + (r[:, 2] + r[:, 3])) + ((r[:, 4] + r[:, 5]) + (r[:, 6] + r[:, 7]))
+    for k in range(7):
+        on = n % 8 > k
+        res[on] += values[s[on] + blocks[on] + k]
+    out[mid] = res
+
+    # larger groups are split in two at a multiple of 8
+    big = sizes > 128
+    if big.any():
+        s, n = starts[big], sizes[big]
+        half = n // 2
+        half -= half % 8
+        out[big] = pairwise_sums(values, s, half) + pairwise_sums(values, s + half, n - half)
+    return out
+
+
+def vw_prices(price, volume, codes, n_groups):
+    '''
+    This function computes the volume-weighted price of each group of
+    trades the way the original aggregation did: the value weights
+    volume / nansum(volume) within the group, then nansum(price x weight).
+    codes (0 .. n_groups - 1) give the group of each trade; trades of a
+    group keep their relative order.
+    Output: array of n_groups prices, NaN for groups without trades
+    '''
+    order = np.argsort(codes, kind='stable')
+    price, volume = price[order], volume[order]
+    sizes = np.bincount(codes, minlength=n_groups)
+    starts = np.cumsum(sizes) - sizes
+
+    total = pairwise_sums(np.where(np.isnan(volume), 0, volume), starts, sizes)
+    weighted = price * (volume / np.repeat(total, sizes))
+    vw = pairwise_sums(np.where(np.isnan(weighted), 0, weighted), starts, sizes)
+    vw[sizes == 0] = np.nan
+    return vw
+
+
+def aggregate_trades(trace):
+    '''
+    This function aggregates cleaned trades indexed by (cusip_id, trd_exctn_dt)
+    to one row per bond-day in a single grouped pass.
+    Volume-weighted prices over all trades, the sell side (bid) and the buy
+    side (ask) come from vw_prices and have the same bits as the original
+    per bond-day value weights.
+    Output: DataFrame with prc_ew, prc_vw, qvolume, dvolume, prc_bid, prc_ask,
+    n_trades, n_bid and n_ask. prc_bid/prc_ask are NaN on days without
+    trades on that side.
+    '''
+    price  = trace['rptd_pr'].to_numpy(dtype='float64')
+    volume = trace['entrd_vol_qt'].to_numpy(dtype='float64')
+    side   = trace['rpt_side_cd'].to_numpy()
+    is_bid = side == 'S'
+    is_ask = side == 'B'
+
+    grouped = pd.DataFrame({'prc_sum':  price,
+                            'prc_n':    ~np.isnan(price),
+                            'qvolume':  volume,
+                            # units x clean prc
+                            'dvolume':  np.round(volume * price / 100, 0),
+                            'n_trades': 1,
+                            'n_bid':    is_bid.astype('int64'),
+                            'n_ask':    is_ask.astype('int64')},
+                           index = trace.index).groupby(level = ['cusip_id','trd_exctn_dt'])
+    sums = grouped.sum()
+    codes = grouped.ngroup().to_numpy()
+    for col, rows in (('prc_vw', slice(None)), ('prc_bid', is_bid), ('prc_ask', is_ask)):
+        sums[col] = vw_prices(price[rows], volume[rows], codes[rows], len(sums))
+    return daily_from_sums(sums)
+
+
+def daily_from_sums(sums):
+    '''
+    This function derives the daily prices and volumes of aggregate_trades
+    from the bond-day sums and volume-weighted prices.
+    '''
+    daily = pd.DataFrame(index = sums.index)
+    daily['prc_ew']   = (sums['prc_sum'] / sums['prc_n']).round(4)
+    daily['prc_vw']   = sums['prc_vw'].round(4)
+    daily['qvolume']  = sums['qvolume']
+    daily['dvolume']  = sums['dvolume'].round(0)
+    daily['prc_bid']  = sums['prc_bid'].where(sums['n_bid'] > 0).round(4)
+    daily['prc_ask']  = sums['prc_ask'].where(sums['n_ask'] > 0).round(4)
+    daily['n_trades'] = sums['n_trades']
+    daily['n_bid']    = sums['n_bid']
+    daily['n_ask']    = sums['n_ask']
+    return daily
+
+
+def split_daily(daily):
+    '''
+    This function splits the output of aggregate_trades into the
+    Prices, Volumes and Illiq exports. Illiq only keeps the days with
+    trades on both sides.
+    Output: PricesAll, VolumesAll, prc_BID_ASK
+    '''
+    PricesAll   = daily[['prc_ew','prc_vw']]
+    VolumesAll  = daily[['qvolume','dvolume']]
+    prc_BID_ASK = daily.loc[(daily['n_bid'] > 0) & (daily['n_ask'] > 0), ['prc_bid','prc_ask']]
+    return PricesAll, VolumesAll, prc_BID_ASK
+
+
+def aggregate_daily(trace):
+    '''
+    This function aggregates cleaned trades indexed by (cusip_id, trd_exctn_dt)
+    to daily prices, volumes and bid/ask prices.
+    Output: PricesAll, VolumesAll, prc_BID_ASK
+    '''
+    return split_daily(aggregate_trades(trace))
+
+
+def filter_bns_rows(trace):
+    '''
+    This function applies the BNS filters to the trades reported before
+    2012-02-06 and keeps all later trades.
+    '''
+    is_pre = (trace['trd_rpt_dt'] < POST_2012_DATE).to_numpy()
+    return trace[~is_pre | bns_mask(trace)]
+
+
+def filter_rows(trace, start_date=None, end_date=None, profile=trace_profile.NO_PROFILE):
+    '''
+    This function prepares raw trace_enhanced rows and applies the filters
+    that only look at each row: the date window, the volume filter and, for
+    trades reported before 2012-02-06, the BNS filters. It can run on any
+    batch of rows of a chunk, in any order.
+    Output: trace, n_post_bbw (the number of rows after the volume filter)
+    '''
+    trace = profile.run('prepare', prepare_trace, trace)
+    trace = profile.run('date_filter', filter_dates, trace, start_date, end_date)
+    trace = profile.run('volume_filter', filter_volume, trace)
+    n_post_bbw = len(trace)
+
+    trace = profile.run('bns_filter', filter_bns_rows, trace)
+    return trace, n_post_bbw
+
+
+def concat_trace(frames):
+    '''
+    This function stacks batches of prepared rows. Categorical columns are
+    combined with union_categoricals so they stay categorical.
+    '''
+    columns = frames[0].columns
+    categories = [col for col in columns if isinstance(frames[0][col].dtype, pd.CategoricalDtype)]
+    trace = pd.concat([frame.drop(columns=categories) for frame in frames], ignore_index=True)
+    for col in categories:
+        trace[col] = union_categoricals([frame[col] for frame in frames], sort_categories=True)
+    return trace[columns]
+
+
+def aggregate_spilled(spill, profile=trace_profile.NO_PROFILE):
+    '''
+    This function aggregates the cleaned trades of a trace_spill.TradeSpill
+    written under 'pre' and 'post' one date partition at a time. No bond-day
+    spans two partitions and the trades of one keep the order of
+    combine_pre_post, so the output equals that of aggregate_trades.
+    '''
+    dailies = []
+    for part in profile.iterate('spill_read', spill.partitions()):
+        trace = profile.run('combine', combine_pre_post, part['pre'], part['post'])
+        dailies.append(profile.run('daily_aggregation', aggregate_trades, trace))
+    if not dailies:
+        trace = combine_pre_post(spill.empty['pre'], spill.empty['post'])
+        return aggregate_trades(trace)
+    return pd.concat(dailies).sort_index()
+
+
+def clean_filtered(trace, n_pre, n_post_bbw, min_obs=MIN_OBS, profile=trace_profile.NO_PROFILE,
+                   memory_budget_mb=None):
+    '''
+    This function runs the Dick-Nielsen cleaning and the daily aggregation
+    on rows that already went through filter_rows. n_pre and n_post_bbw are
+    the row counts before and after the filters, for the statistics.
+    When the aggregation of n_post_bbw trades would take more than
+    memory_budget_mb, the cleaned pre and post 2012 trades are spilled to
+    date partitions on disk as soon as each is done and aggregated
+    partition by partition (trace_spill, aggregate_spilled).
+    Output: PricesAll, VolumesAll, prc_BID_ASK and a dict of cleaning statistics.
+    The three frames are None when the chunk had min_obs observations or fewer.
+    '''
+    stats = dict.fromkeys(CLEANING_COLUMNS)
+    stats['Obs.Pre'] = int(n_pre)
+
+    #### Basically try-catch --> ensure >100 obs in the pulled data, handles
+    #### edge cases where there is not any data
+    if n_pre <= min_obs:
+        stats['Obs.PostBBW'] = int(n_pre)
+        stats['Obs.PostDickNielsen'] = int(n_pre)
+        return None, None, None, stats
+
+    stats['Obs.PostBBW'] = int(n_post_bbw)
+
+    n_partitions = trace_spill.n_partitions(n_post_bbw, memory_budget_mb)
+    pre, post = profile.run('split_pre_post', split_pre_post, trace)
+    if n_partitions > 1:
+        bounds = trace_spill.date_bounds(trace['trd_exctn_dt'], n_partitions)
+        del trace
+        with trace_spill.TradeSpill(bounds) as spill:
+            profile.run('spill', spill.write, clean_post_2012(post, profile=profile)[TRADE_COLUMNS], 'post')
+            del post
+            profile.run('spill', spill.write, clean_pre_2012(pre, profile=profile)[TRADE_COLUMNS], 'pre')
+            del pre
+            stats['Obs.PostDickNielsen'] = int(spill.rows)
+            daily = aggregate_spilled(spill, profile=profile)
+    else:
+        clean_post2 = clean_post_2012(post, profile=profile)
+        _clean_pre5 = clean_pre_2012(pre, profile=profile)
+
+        trace = profile.run('combine', combine_pre_post, _clean_pre5, clean_post2)
+        stats['Obs.PostDickNielsen'] = int(len(trace))
+
+        daily = profile.run('daily_aggregation', aggregate_trades, trace)
+    PricesAll, VolumesAll, prc_BID_ASK = split_daily(daily)
+    return PricesAll, VolumesAll, prc_BID_ASK, stats
+
+
+def clean_chunk(trace, start_date=None, end_date=None, min_obs=MIN_OBS, profile=trace_profile.NO_PROFILE,
+                memory_budget_mb=None):
+    '''
+    This function runs the Dick-Nielsen cleaning and the daily aggregation
+    on the raw trace_enhanced rows of one chunk, keeping the trades executed
+    between start_date and end_date (memory_budget_mb: see clean_filtered).
+    Every matching step keys on cusip_id and trd_exctn_dt, so the daily
+    output of a bond-day only depends on the records of that bond-day.
+    Output: PricesAll, VolumesAll, prc_BID_ASK and a dict of cleaning statistics.
+    The three frames are None when the chunk has min_obs observations or fewer.
+    '''
+    n_pre = len(trace)
+    if n_pre <= min_obs:
+        return clean_filtered(trace, n_pre, n_pre, min_obs)
+
+    trace, n_post_bbw = filter_rows(trace, start_date, end_date, profile=profile)
+    return clean_filtered(trace, n_pre, n_post_bbw, min_obs, profile=profile, memory_budget_mb=memory_budget_mb)
@@ -0,0 +1,62 @@
+'''
+Overview
+-------------
+Key encoding and membership joins used by trace_clean.py.
+
+The Dick-Nielsen matching steps only ask whether a record has a partner
+on a set of key columns. Instead of a wide pd.merge followed by a null
+filter, the key columns of both sides are factorized together once into
+dense integer codes. The membership test is then a single array lookup.
+Missing values match each other, as they do in pd.merge.
+'''
+
+import numpy as np
+import pandas as pd
+
+_INT64_MAX = np.iinfo('int64').max
+
+
+def encode_keys(left, right, left_on, right_on=None):
+    '''
+    This function encodes the key columns of two frames into one int64 code
+    per row. Two rows share a code exactly when all their keys are equal.
+    Output: left_codes, right_codes, n_codes (codes lie in [0, n_codes))
+    '''
+    right_on = left_on if right_on is None else right_on
+    n_left = len(left)
+
+    codes, n_codes = np.zeros(n_left + len(right), dtype='int64'), 1
+    for left_col, right_col in zip(left_on, right_on):
+        values = pd.concat([left[left_col], right[right_col]], ignore_index=True)
+        col_codes, uniques = pd.factorize(values, use_na_sentinel=False)
+        n_uniques = max(len(uniques), 1)
+        # compress the running code before it could overflow int64
+        if n_codes > _INT64_MAX // n_uniques:
+            codes, uniques_so_far = pd.factorize(codes)
+            n_codes = len(uniques_so_far)
+        codes = codes * n_uniques + col_codes
+        n_codes = n_codes * n_uniques
+
+    codes, uniques = pd.factorize(codes)
+    return codes[:n_left], codes[n_left:], len(uniques)
+
+
+def isin_keys(left, right, left_on, right_on=None):
+    '''
+    This function returns a boolean mask over the rows of left that have
+    at least one row in right with equal keys.
+    '''
+    left_codes, right_codes, n_codes = encode_keys(left, right, left_on, right_on)
+    present = np.zeros(n_codes, dtype=bool)
+    present[right_codes] = True
+    return present[left_codes]
+
+
+def anti_join(left, right, left_on, right_on=None):
+    '''
+    This function keeps the rows of left without a match in right,
+    in their original order. It returns the same rows as a left merge
+    followed by a filter on a null right-hand column, without building
+    the merged frame.
+    '''
+    return left[~isin_keys(left, right, left_on, right_on)]
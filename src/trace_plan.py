@@ -0,0 +1,236 @@
+'''
+Overview
+-------------
+Row-count-aware chunk planner for load_trace.py.
+
+Equal-sized CUSIP chunks (load_trace.divide_chunks) hold very different
+amounts of work, as the number of trades per bond varies by orders of
+magnitude. The planner sizes chunks by their rows instead:
+1. Rows per CUSIP and execution year come from a GROUP BY count on WRDS
+   (trace_query.build_row_counts_query), cached in a statistics file so
+   later runs only count the CUSIPs they have not seen
+2. CUSIPs with more than TRACE_CHUNK_ROWS rows are split by execution
+   date into runs of whole years of at most TRACE_CHUNK_ROWS rows each
+3. The other CUSIPs are packed in CUSIP order into chunks of at most
+   TRACE_CHUNK_ROWS rows and TRACE_CHUNK_CUSIPS CUSIPs, cut at points
+   picked by a hash of the CUSIPs (pack_in_order)
+
+The cleaning only matches records within a bond-day, so splitting a bond
+by date does not change its cleaned rows. Chunks with MIN_OBS rows or
+fewer are skipped as a whole (trace_clean.clean_filtered), so the planner
+folds year runs and packed chunks that small into a neighbour.
+
+Checkpoints are keyed by the CUSIPs of a chunk (trace_checkpoint.chunk_key),
+so the plan has to survive a refresh of the counts. Packing by size
+(first-fit decreasing) reshuffles almost every chunk when the counts move
+by a few percent; with cut points that depend on the CUSIPs alone, only the
+chunks whose rows cross TRACE_CHUNK_ROWS, or that gain a new CUSIP, change.
+The price is emptier chunks: about half of TRACE_CHUNK_ROWS on average.
+'''
+
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import config
+import trace_clean
+import trace_query
+
+DATA_DIR = Path(config.DATA_DIR)
+ROW_COUNTS_PATH = DATA_DIR / "pulled" / "trace_row_counts.csv"
+
+TRACE_CHUNK_ROWS = config.TRACE_CHUNK_ROWS
+TRACE_CHUNK_CUSIPS = config.TRACE_CHUNK_CUSIPS
+
+# CUSIPs per count query
+COUNT_BATCH = 5000
+
+
+def fetch_row_counts(db, cusips, batch_size=COUNT_BATCH):
+    '''
+    This function counts the trace_enhanced rows of every CUSIP per
+    execution year on `db`. CUSIPs without any trades get a single row
+    with a missing year and n = 0, so the statistics file records them too.
+    Output: DataFrame with cusip_id, year and n
+    '''
+    frames = []
+    for i in range(0, len(cusips), batch_size):
+        sql, params = trace_query.build_row_counts_query(cusips[i:i + batch_size])
+        frames.append(db.raw_sql(sql, params=params))
+    counts = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['cusip_id', 'year', 'n'])
+
+    missing = sorted(set(cusips) - set(counts['cusip_id']))
+    counts = pd.concat([counts, pd.DataFrame({'cusip_id': missing, 'year': None, 'n': 0})], ignore_index=True)
+    return counts.astype({'cusip_id': object, 'year': 'Int64', 'n': 'int64'})
+
+
+def load_row_counts(db, cusips, path=ROW_COUNTS_PATH, refresh=False):
+    '''
+    This function returns the row counts of `cusips` from the statistics
+    file at `path`, counting the CUSIPs the file does not cover on `db` and
+    adding them to the file. With refresh every CUSIP is counted again.
+    The counts are estimates: trades reported since the file was written
+    are only picked up by a refresh.
+    Output: DataFrame with cusip_id, year and n
+    '''
+    path = Path(path)
+    if path.exists() and not refresh:
+        counts = pd.read_csv(path, dtype={'cusip_id': object, 'year': 'Int64', 'n': 'int64'})
+    else:
+        counts = pd.DataFrame({'cusip_id': pd.Series(dtype=object),
+                               'year': pd.Series(dtype='Int64'),
+                               'n': pd.Series(dtype='int64')})
+
+    todo = sorted(set(cusips) - set(counts['cusip_id']))
+    if todo:
+        print(f'counting the rows of {len(todo)} CUSIPs')
+        counts = pd.concat([counts[~counts['cusip_id'].isin(todo)], fetch_row_counts(db, todo)],
+                           ignore_index=True)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        counts.sort_values(['cusip_id', 'year']).to_csv(path, index=False)
+
+    return counts[counts['cusip_id'].isin(cusips)].reset_index(drop=True)
+
+
+def split_years(years, max_rows=TRACE_CHUNK_ROWS, min_obs=trace_clean.MIN_OBS):
+    '''
+    This function splits the yearly row counts of one CUSIP (a Series
+    indexed by year, sorted) into runs of consecutive years of at most
+    max_rows rows; a single year above max_rows is a run of its own.
+    Runs with min_obs rows or fewer are merged into the run before them,
+    or the one after them for the first run, so no part of a bond is
+    skipped for having too few observations.
+    Output: list of (first year, last year, rows)
+    '''
+    runs = []
+    for year, n in years.items():
+        if runs and runs[-1][2] + n <= max_rows:
+            first, _, rows = runs[-1]
+            runs[-1] = (first, year, rows + n)
+        else:
+            runs.append((year, year, n))
+
+    merged = []
+    for run in runs:
+        if merged and run[2] <= min_obs:
+            first, _, rows = merged[-1]
+            merged[-1] = (first, run[1], rows + run[2])
+        else:
+            merged.append(run)
+    if len(merged) > 1 and merged[0][2] <= min_obs:
+        first, _, rows = merged.pop(0)
+        merged[0] = (first, merged[0][1], rows + merged[0][2])
+    return merged
+
+
+def cut_level(cusip):
+    '''
+    This function returns the cut level of a CUSIP: the number of trailing
+    zero bits of a hash of the CUSIP. About half of the CUSIPs have level 0,
+    a quarter level 1 and so on, whatever the row counts.
+    '''
+    digest = int(hashlib.sha1(cusip.encode()).hexdigest()[:8], 16)
+    return 32 if digest == 0 else (digest & -digest).bit_length() - 1
+
+
+def pack_in_order(rows, max_rows=TRACE_CHUNK_ROWS, max_cusips=TRACE_CHUNK_CUSIPS):
+    '''
+    This function packs the CUSIPs of `rows` (a Series of rows indexed by
+    cusip_id) into bins of consecutive CUSIPs of at most max_rows rows and
+    max_cusips CUSIPs. A run of CUSIPs that does not fit is cut after every
+    CUSIP of the highest cut_level found in it, and the pieces are joined
+    again from the left as long as they fit; a piece that does not fit on
+    its own is cut at the next level down. A change in the counts only
+    moves the cuts inside runs whose rows cross max_rows, and a new CUSIP
+    only changes the run it falls into.
+    Output: list of [cusips, rows] in CUSIP order
+    '''
+    rows = rows.sort_index()
+    cusips = list(rows.index)
+    levels = np.array([cut_level(cusip) for cusip in cusips], dtype='int64')
+    cumulative = np.concatenate([[0], np.cumsum(rows.to_numpy(dtype='int64'))])
+
+    def fits(a, b):
+        return cumulative[b] - cumulative[a] <= max_rows and b - a <= max_cusips
+
+    bins = []
+
+    def pack(a, b, level):
+        if b - a == 1 or fits(a, b):
+            bins.append([cusips[a:b], int(cumulative[b] - cumulative[a])])
+            return
+        # a run of two CUSIPs or more always has a cut at level 0
+        cuts = []
+        while not cuts:
+            level -= 1
+            cuts = list(np.flatnonzero(levels[a:b - 1] >= level) + a + 1)
+        start = a
+        for piece_start, piece_end in zip([a] + cuts, cuts + [b]):
+            if start < piece_start and not fits(start, piece_end):
+                pack(start, piece_start, level)
+                start = piece_start
+        pack(start, b, level)
+
+    if cusips:
+        pack(0, len(cusips), 33)
+    return bins
+
+
+def fold_small_bins(bins, max_cusips=TRACE_CHUNK_CUSIPS, min_obs=trace_clean.MIN_OBS):
+    '''
+    This function merges every bin of pack_in_order with min_obs rows or
+    fewer into a neighbouring bin, preferring one with room for its CUSIPs
+    and then the smaller one, so no CUSIPs are skipped for having too few
+    observations. The merged bin can go over max_rows by at most min_obs
+    rows. A single bin is left as it is.
+    Output: list of [cusips, rows] in CUSIP order
+    '''
+    bins = [[list(cusips), rows] for cusips, rows in bins]
+    while len(bins) > 1:
+        small = [i for i, (_, rows) in enumerate(bins) if rows <= min_obs]
+        if not small:
+            break
+        i = small[0]
+        neighbours = [j for j in (i - 1, i + 1) if 0 <= j < len(bins)]
+        j = min(neighbours, key=lambda j: (len(bins[i][0]) + len(bins[j][0]) > max_cusips, bins[j][1]))
+        first, last = min(i, j), max(i, j)
+        bins[first:last + 1] = [[bins[first][0] + bins[last][0], bins[first][1] + bins[last][1]]]
+    return bins
+
+
+def plan_chunks(counts, cusips, start_date=None, end_date=None,
+                max_rows=TRACE_CHUNK_ROWS, max_cusips=TRACE_CHUNK_CUSIPS):
+    '''
+    This function plans the work units of a pull from the row counts of
+    load_row_counts. Only the years between start_date and end_date are
+    counted. A CUSIP above max_rows gets one unit per run of split_years,
+    with date bounds that meet at the turn of a year and together cover
+    [start_date, end_date]. The other CUSIPs, including those without
+    counts, are packed in CUSIP order into units of at most max_rows rows
+    and max_cusips CUSIPs (pack_in_order), with bins of MIN_OBS rows or
+    fewer folded into a neighbour (fold_small_bins). Units are returned
+    largest first, which keeps a worker pool busy until the end.
+    Output: list of (cusips, start_date, end_date, estimated rows)
+    '''
+    counts = counts.dropna(subset=['year'])
+    if start_date is not None:
+        counts = counts[counts['year'] >= pd.Timestamp(start_date).year]
+    if end_date is not None:
+        counts = counts[counts['year'] <= pd.Timestamp(end_date).year]
+    years = counts.groupby(['cusip_id', 'year'])['n'].sum()
+    totals = years.groupby(level='cusip_id').sum().reindex(list(dict.fromkeys(cusips)), fill_value=0)
+
+    units = []
+    for cusip in totals.index[totals > max_rows]:
+        runs = split_years(years.loc[cusip].sort_index(), max_rows)
+        for i, (first, last, rows) in enumerate(runs):
+            unit_start = start_date if i == 0 else pd.Timestamp(year=int(first), month=1, day=1)
+            unit_end = end_date if i == len(runs) - 1 else pd.Timestamp(year=int(last), month=12, day=31)
+            units.append(([cusip], unit_start, unit_end, int(rows)))
+
+    bins = fold_small_bins(pack_in_order(totals[totals <= max_rows], max_rows, max_cusips), max_cusips)
+    units += [(b_cusips, start_date, end_date, int(rows)) for b_cusips, rows in bins]
+
+    return sorted(units, key=lambda unit: -unit[3])
@@ -0,0 +1,446 @@
+'''
+Overview
+-------------
+Polars backend of the Dick-Nielsen cleaning and the daily aggregation.
+
+It has the same entry points as trace_clean.py (filter_rows, concat_trace,
+clean_filtered, clean_chunk) and returns the same pandas outputs, so
+load_trace.py can switch between the two with --backend / TRACE_BACKEND.
+The cleaning is one lazy query over the filtered rows:
+1. the post 2012 C/X matching and the pre 2012 C matching are anti-joins,
+   the W and reversal matching semi-joins
+2. the reversal numbering is a cumulative count over the 7 group keys
+3. the daily aggregation is one grouped pass, run on the streaming engine
+Polars runs every step multi-threaded (POLARS_MAX_THREADS threads).
+Only the W chains are resolved outside the query, by the pointer jumping
+of trace_clean.chain_roots on the (few) W records.
+
+The output matches the pandas path exactly, which takes some care:
+- joins never match missing keys, where pd.merge and trace_join do, so
+  every join key is split into a null flag and a filled value
+- Expr.round rounds half away from zero, numpy (and pandas) to even, so
+  the rounding is done with _rint
+- filters and joins keep the row order, so drop_duplicates keeps the
+  same rows, and the float sums are added up in the row order of the
+  pandas path with its compensated summation (kahan_sums)
+'''
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+import trace_clean
+import trace_profile
+import trace_spill
+
+# Categoricals of different frames can only be joined and stacked under a global string cache
+pl.enable_string_cache()
+
+# Typed schema of the filtered rows, the counterpart of trace_clean.compact_trace
+DATE_COLUMNS = ['trd_exctn_dt', 'trd_rpt_dt']
+FLOAT_DTYPES = {'entrd_vol_qt': pl.Float64,
+                'rptd_pr':      pl.Float64,
+                'yld_pt':       pl.Float32}
+
+
+def _seconds(col, dtype):
+    '''
+    Seconds after midnight of a 'HH:MM:SS' string or time column.
+    '''
+    if dtype == pl.Utf8:
+        col = col.str.strptime(pl.Time, '%H:%M:%S', strict=False)
+    return (col.cast(pl.Int64) // 1_000_000_000).cast(pl.Int32)
+
+
+def prepare_trace(trace):
+    '''
+    This function converts raw trace_enhanced rows (a pandas DataFrame) to
+    a polars DataFrame with dates, times as integer seconds after midnight,
+    floats and strings. The BNS indicators are strings with 'None' for a
+    missing value, as in trace_clean.prepare_trace.
+    '''
+    trace = pl.from_pandas(trace)
+    columns = []
+    for name, dtype in trace.schema.items():
+        col = pl.col(name)
+        if name in DATE_COLUMNS:
+            col = col.str.strptime(pl.Date, '%Y-%m-%d') if dtype == pl.Utf8 else col.cast(pl.Date)
+        elif name in trace_clean.TIME_COLUMNS:
+            col = _seconds(col, dtype)
+        elif name in FLOAT_DTYPES:
+            col = col.cast(FLOAT_DTYPES[name])
+        elif name in trace_clean.INDICATOR_COLUMNS:
+            col = col.cast(pl.Utf8).fill_null('None').cast(pl.Categorical)
+        elif name in trace_clean.CATEGORY_COLUMNS:
+            col = col.cast(pl.Utf8).cast(pl.Categorical)
+        else:
+            col = col.cast(pl.Utf8)
+        columns.append(col)
+    return trace.select(columns)
+
+
+def filter_expr(start_date=None, end_date=None, min_volume=trace_clean.MIN_VOLUME):
+    '''
+    This function returns the date window and volume filters as one predicate.
+    '''
+    predicate = pl.col('entrd_vol_qt') >= min_volume
+    if start_date is not None:
+        predicate &= pl.col('trd_exctn_dt') >= pd.Timestamp(start_date).date()
+    if end_date is not None:
+        predicate &= pl.col('trd_exctn_dt') <= pd.Timestamp(end_date).date()
+    return predicate
+
+
+def bns_expr():
+    '''
+    This function returns the van Binsbergen, Nozawa and Schwert filters
+    (trace_clean.bns_mask) as a predicate.
+    '''
+    return (pl.col('days_to_sttl_ct').is_in(['002', '000', '001', 'None'])
+            & (pl.col('wis_fl') != 'Y')
+            & (pl.col('lckd_in_ind') != 'Y')
+            & pl.col('sale_cndtn_cd').is_in(['None', '@']))
+
+
+def filter_rows(trace, start_date=None, end_date=None, profile=trace_profile.NO_PROFILE):
+    '''
+    This function prepares raw trace_enhanced rows and applies the row-local
+    filters of trace_clean.filter_rows in one pass.
+    Output: trace (polars DataFrame), n_post_bbw (the number of rows after the volume filter)
+    '''
+    trace = profile.run('prepare', prepare_trace, trace)
+    is_pre = pl.col('trd_rpt_dt') < pd.Timestamp(trace_clean.POST_2012_DATE).date()
+    filtered, n_post_bbw = profile.run('filter', pl.collect_all, [
+        trace.lazy().filter(filter_expr(start_date, end_date)).filter(~is_pre | bns_expr()),
+        trace.lazy().filter(filter_expr(start_date, end_date)).select(pl.count())])
+    return filtered, n_post_bbw.item()
+
+
+def concat_trace(frames):
+    '''
+    This function stacks batches of filtered rows.
+    '''
+    return pl.concat(frames, how='vertical')
+
+
+#* ************************************** */
+#* Joins                                  */
+#* ************************************** */
+def _key_exprs(keys, schema, prefix):
+    '''
+    Join key expressions under which missing values match each other:
+    a null flag and the value with nulls filled in, per key.
+    '''
+    exprs = []
+    for i, key in enumerate(keys):
+        col = pl.col(key)
+        filled = col.fill_null('') if schema[key] == pl.Utf8 else col.to_physical().fill_null(0)
+        exprs += [col.is_null().alias(f'{prefix}{i}_null'), filled.alias(f'{prefix}{i}')]
+    return exprs
+
+
+def filter_join(left, right, left_on, right_on=None, how='semi'):
+    '''
+    This function keeps the rows of the LazyFrame left with (how='semi') or
+    without (how='anti') a match in right on the key columns, missing
+    values matching each other as in trace_join.isin_keys.
+    '''
+    right_on = left_on if right_on is None else right_on
+    left_keys = _key_exprs(left_on, left.schema, '_key')
+    right_keys = _key_exprs(right_on, right.schema, '_key')
+    names = [expr.meta.output_name() for expr in left_keys]
+    return (left.with_columns(left_keys)
+                .join(right.select(right_keys), on=names, how=how)
+                .drop(names))
+
+
+def _unique(frame, subset=None):
+    '''
+    drop_duplicates: the first of the rows with equal data columns, or
+    equal subset columns. Filters, semi- and anti-joins keep the row order,
+    so every frame is in the order of its pandas counterpart.
+    '''
+    subset = subset or [col for col in frame.columns if not col.startswith('_')]
+    return frame.unique(subset=subset, keep='first', maintain_order=True)
+
+
+#* ************************************** */
+#* Post 2012                              */
+#* ************************************** */
+def clean_post_2012(post, remove_reversals=False):
+    '''
+    This function is trace_clean.clean_post_2012 on a LazyFrame.
+    '''
+    trc_st = pl.col('trc_st')
+    post_tr = post.filter((trc_st == 'T') | (trc_st == 'R'))
+    post_xc = post.filter((trc_st == 'X') | (trc_st == 'C'))
+
+    clean_post1 = filter_join(post_tr, post_xc, trace_clean.POST_2012_KEYS + ['msg_seq_nb'], how='anti')
+    if remove_reversals:
+        clean_post1 = filter_join(clean_post1, post.filter(trc_st == 'Y'),
+                                  left_on  = trace_clean.POST_2012_KEYS + ['msg_seq_nb'],
+                                  right_on = trace_clean.POST_2012_KEYS + ['orig_msg_seq_nb'],
+                                  how='anti')
+    return _unique(clean_post1)
+
+
+#* ************************************** */
+#* Pre 2012                               */
+#* ************************************** */
+C_KEYS = ['cusip_id', 'trd_exctn_dt', 'trd_exctn_tm', 'rptd_pr', 'entrd_vol_qt', 'trd_rpt_dt']
+
+
+def remove_pre_cancellations(pre):
+    '''
+    This function is trace_clean.remove_pre_cancellations on a LazyFrame:
+    the distinct T records without a C record pointing at them.
+    Output: clean_pre1, pre_w
+    '''
+    trc_st = pl.col('trc_st')
+    clean_pre1 = filter_join(_unique(pre.filter(trc_st == 'T')), pre.filter(trc_st == 'C'),
+                             left_on  = C_KEYS + ['msg_seq_nb'],
+                             right_on = C_KEYS + ['orig_msg_seq_nb'],
+                             how='anti')
+    return clean_pre1, pre.filter(trc_st == 'W')
+
+
+def resolve_w_chains(pre_w, max_depth=64):
+    '''
+    This function is trace_clean.resolve_w_chains on a (collected) polars
+    DataFrame. Nodes are numbered by the first row of the stacked
+    msg_seq_nb and orig_msg_seq_nb with the same time stamp and number.
+    '''
+    n = len(pre_w)
+    keys = trace_clean.W_CHAIN_KEYS
+    nodes = (pl.concat([pre_w.select(keys + [pl.col('msg_seq_nb').alias('_seq')]),
+                        pre_w.select(keys + [pl.col('orig_msg_seq_nb').alias('_seq')])])
+               .with_row_count('_node')
+               .with_columns(pl.col('_node').min().over(keys + ['_seq'])))
+    node = nodes['_node'].to_numpy().astype('int64')
+    root, is_terminal = trace_clean.chain_roots(node[:n], node[n:], 2 * n, max_depth)
+
+    w_clean = (pre_w.filter(pl.Series(is_terminal))
+                    .with_columns(nodes['_seq'].take(root[is_terminal]).alias('orig_msg_seq_nb')))
+    w_clean = _unique(w_clean, ['orig_msg_seq_nb', 'cusip_id', 'trd_exctn_dt', 'trd_exctn_tm', 'msg_seq_nb'])
+    return w_clean.sort(keys + ['_row'], nulls_last=True)
+
+
+def apply_pre_corrections(clean_pre1, w_clean):
+    '''
+    This function is trace_clean.apply_pre_corrections with the W chains
+    already resolved: the T records corrected by a chain are replaced by
+    the last W of the chain.
+    '''
+    clean_pre1 = _unique(clean_pre1).cache()
+    t_keys, w_keys = ['cusip_id', 'trd_exctn_dt', 'msg_seq_nb'], ['cusip_id', 'trd_exctn_dt', 'orig_msg_seq_nb']
+
+    rep_w = filter_join(w_clean, clean_pre1, left_on=w_keys, right_on=t_keys)
+    rep_w = rep_w.unique(subset=['cusip_id', 'trd_exctn_dt', 'msg_seq_nb', 'orig_msg_seq_nb',
+                                 'rptd_pr', 'entrd_vol_qt'], keep='first', maintain_order=True)
+    return pl.concat([filter_join(clean_pre1, w_clean, left_on=t_keys, right_on=w_keys, how='anti'),
+                      rep_w.select(clean_pre1.columns)])
+
+
+def _reversal_ranks(frame, order_keys):
+    '''
+    Occurrence rank within REVERSAL_GROUP_KEYS in the order of order_keys
+    (missing values last), -1 for rows with a missing group key.
+    '''
+    group = trace_clean.REVERSAL_GROUP_KEYS
+    has_na = pl.any_horizontal([pl.col(key).is_null() for key in group])
+    return (frame.sort(order_keys + ['_row'], nulls_last=True)
+                 .with_columns(pl.when(has_na).then(-1)
+                                 .otherwise(pl.col('_row').cumcount().over(group).cast(pl.Int64))
+                                 .alias('_rank')))
+
+
+def remove_pre_reversals(clean_pre3):
+    '''
+    This function is trace_clean.remove_pre_reversals on a LazyFrame:
+    the n-th reversal of a group removes its n-th record (6 keys).
+    '''
+    asof_cd = pl.col('asof_cd')
+    clean_pre3 = clean_pre3.cache()
+    rev = clean_pre3.filter(asof_cd == 'R')
+    clean_pre4 = clean_pre3.filter(~asof_cd.is_in(['R', 'X', 'D']).fill_null(False)).cache()
+
+    match_keys = [key for key in trace_clean.REVERSAL_GROUP_KEYS if key != 'bond_sym_id']
+    rev_ranked = _reversal_ranks(rev, trace_clean.REVERSAL_ORDER_KEYS).filter(pl.col('_rank') >= 0)
+    # only records sharing the 6 keys of a reversal can be matched, and the
+    # 7-key groups they are numbered in lie entirely among them
+    candidates = clean_pre4.join(rev_ranked.select(match_keys).unique(), on=match_keys, how='semi')
+    pre_ranked = _reversal_ranks(candidates, trace_clean.REVERSAL_ORDER_KEYS + ['msg_seq_nb'])
+    matched = pre_ranked.join(rev_ranked.select(match_keys + ['_rank']), on=match_keys + ['_rank'], how='semi')
+    unmatched = clean_pre4.join(matched.select('_row'), on='_row', how='anti')
+
+    keep = filter_join(clean_pre4, unmatched, trace_clean.REVERSAL_RECORD_KEYS)
+    return _unique(keep)
+
+
+#* ************************************** */
+#* Daily aggregation                      */
+#* ************************************** */
+SUM_COLUMNS = ['prc_sum', 'qvolume', 'dvolume']
+TRADE_COLUMNS = ['rptd_pr', 'entrd_vol_qt', 'is_bid', 'is_ask']
+COUNT_COLUMNS = ['prc_n', 'n_trades', 'n_bid', 'n_ask']
+
+
+def _rint(x):
+    '''
+    Round half to even to an integer, like numpy.
+    '''
+    floor = x.floor()
+    frac = x - floor
+    return (pl.when(frac > 0.5).then(floor + 1)
+              .when(frac < 0.5).then(floor)
+              .otherwise(floor + (floor % 2).abs()))
+
+
+def kahan_sums(values, sizes):
+    '''
+    This function sums the rows of values (2-d float array, sorted by group)
+    within consecutive groups of the given sizes, skipping NaN, with the
+    compensated summation in row order of pandas' groupby sum. The loop
+    runs over the position within a group, across all groups at once.
+    Output: array of shape (len(sizes), values.shape[1])
+    '''
+    starts = np.cumsum(sizes) - sizes
+    by_size = np.argsort(-sizes, kind='stable')
+    desc_sizes = sizes[by_size]
+    sumx = np.zeros((len(sizes), values.shape[1]))
+    comp = np.zeros_like(sumx)
+    for k in range(int(desc_sizes[0]) if len(sizes) else 0):
+        groups = by_size[:np.searchsorted(-desc_sizes, -k, side='left')]
+        val = values[starts[groups] + k]
+        old_sum, old_comp = sumx[groups], comp[groups]
+        y = val - old_comp
+        t = old_sum + y
+        new_comp = t - old_sum - y
+        new_comp[np.isnan(new_comp)] = 0
+        is_na = np.isnan(val)
+        sumx[groups] = np.where(is_na, old_sum, t)
+        comp[groups] = np.where(is_na, old_comp, new_comp)
+    return sumx
+
+
+def aggregate_trades(trace):
+    '''
+    This function is trace_clean.aggregate_trades on a LazyFrame of cleaned
+    trades, in the row order of the pandas path: one grouped pass computes
+    the counts per bond-day and gathers the per-trade terms, in their order
+    within the bond-day. The float sums are then added up by kahan_sums and
+    the volume-weighted prices by trace_clean.vw_prices, as summing them in
+    another order changes the last bit, and with it the rounding of a price
+    now and then.
+    Output: pandas DataFrame indexed by (cusip_id, trd_exctn_dt)
+    '''
+    keys = ['cusip_id', 'trd_exctn_dt']
+    price, volume = pl.col('rptd_pr'), pl.col('entrd_vol_qt')
+
+    grouped = trace.select(
+        *keys,
+        *TRADE_COLUMNS[:2],
+        prc_sum  = price,
+        qvolume  = volume,
+        # units x clean prc
+        dvolume  = _rint(volume * price / 100),
+        is_bid   = (pl.col('rpt_side_cd') == 'S').fill_null(False),
+        is_ask   = (pl.col('rpt_side_cd') == 'B').fill_null(False),
+    ).group_by(keys).agg(
+        pl.col(SUM_COLUMNS + TRADE_COLUMNS),
+        prc_n    = pl.col('prc_sum').is_not_null().sum().cast(pl.Int64),
+        n_trades = pl.count().cast(pl.Int64),
+        n_bid    = pl.col('is_bid').sum().cast(pl.Int64),
+        n_ask    = pl.col('is_ask').sum().cast(pl.Int64),
+    ).sort(pl.col('cusip_id').cast(pl.Utf8), 'trd_exctn_dt').collect(streaming=True)
+
+    n_trades = grouped['n_trades'].to_numpy()
+    terms = grouped.select(SUM_COLUMNS).explode(SUM_COLUMNS).to_numpy()
+    sums = pd.DataFrame(kahan_sums(terms, n_trades), columns=SUM_COLUMNS)
+    sums[COUNT_COLUMNS] = grouped.select(COUNT_COLUMNS).to_pandas()
+
+    trades = grouped.select(TRADE_COLUMNS).explode(TRADE_COLUMNS)
+    prc, vol = (trades[col].cast(pl.Float64).to_numpy() for col in TRADE_COLUMNS[:2])
+    is_bid, is_ask = (trades[col].to_numpy() for col in TRADE_COLUMNS[2:])
+    codes = np.repeat(np.arange(len(grouped)), n_trades)
+    for col, rows in (('prc_vw', slice(None)), ('prc_bid', is_bid), ('prc_ask', is_ask)):
+        sums[col] = trace_clean.vw_prices(prc[rows], vol[rows], codes[rows], len(grouped))
+
+    sums.index = pd.MultiIndex.from_arrays([grouped['cusip_id'].cast(pl.Utf8).to_numpy().astype(object),
+                                           grouped['trd_exctn_dt'].cast(pl.Datetime('ns')).to_pandas()],
+                                          names=keys)
+    return trace_clean.daily_from_sums(sums)
+
+
+#* ************************************** */
+#* Chunk                                  */
+#* ************************************** */
+def aggregate_spilled(spill, profile=trace_profile.NO_PROFILE):
+    '''
+    This function is trace_clean.aggregate_spilled for the cleaned trades
+    of a trace_spill.TradeSpill written under 'trades'.
+    '''
+    dailies = [profile.run('daily_aggregation', aggregate_trades, part['trades'].lazy())
+               for part in profile.iterate('spill_read', spill.partitions())]
+    if not dailies:
+        return aggregate_trades(spill.empty['trades'].lazy())
+    return pd.concat(dailies).sort_index()
+
+
+def clean_filtered(trace, n_pre, n_post_bbw, min_obs=trace_clean.MIN_OBS, profile=trace_profile.NO_PROFILE,
+                   memory_budget_mb=None):
+    '''
+    This function is trace_clean.clean_filtered on the polars DataFrame of
+    filter_rows, with the same pandas outputs and statistics. Over
+    memory_budget_mb the cleaned trades are aggregated by date partition
+    through trace_spill.
+    '''
+    stats = dict.fromkeys(trace_clean.CLEANING_COLUMNS)
+    stats['Obs.Pre'] = int(n_pre)
+    if n_pre <= min_obs:
+        stats['Obs.PostBBW'] = int(n_pre)
+        stats['Obs.PostDickNielsen'] = int(n_pre)
+        return None, None, None, stats
+    stats['Obs.PostBBW'] = int(n_post_bbw)
+
+    n_partitions = trace_spill.n_partitions(n_post_bbw, memory_budget_mb)
+    if n_partitions > 1:
+        bounds = trace_spill.date_bounds(trace['trd_exctn_dt'], n_partitions)
+    trace = trace.lazy().with_row_count('_row')
+    is_pre = pl.col('trd_rpt_dt') < pd.Timestamp(trace_clean.POST_2012_DATE).date()
+    has_cusip = (pl.col('cusip_id') != '').fill_null(True)
+    # frames used by several branches of the query are cached, so they are computed once
+    pre, post = trace.filter(has_cusip & is_pre).cache(), trace.filter(has_cusip & ~is_pre).cache()
+
+    clean_pre1, pre_w = remove_pre_cancellations(pre)
+    w_clean = profile.run('w_chains', resolve_w_chains, pre_w.collect())
+    clean_pre5 = remove_pre_reversals(apply_pre_corrections(clean_pre1, w_clean.lazy()))
+
+    columns = trace_clean.TRADE_COLUMNS
+    combined = pl.concat([clean_pre5.select(columns), clean_post_2012(post).select(columns)])
+    combined = profile.run('lazy_clean', combined.collect)
+    stats['Obs.PostDickNielsen'] = len(combined)
+
+    if n_partitions > 1:
+        with trace_spill.TradeSpill(bounds) as spill:
+            profile.run('spill', spill.write, combined, 'trades')
+            del combined
+            daily = aggregate_spilled(spill, profile=profile)
+    else:
+        daily = profile.run('daily_aggregation', aggregate_trades, combined.lazy())
+    PricesAll, VolumesAll, prc_BID_ASK = trace_clean.split_daily(daily)
+    return PricesAll, VolumesAll, prc_BID_ASK, stats
+
+
+def clean_chunk(trace, start_date=None, end_date=None, min_obs=trace_clean.MIN_OBS,
+                profile=trace_profile.NO_PROFILE, memory_budget_mb=None):
+    '''
+    This function is trace_clean.clean_chunk on the polars backend: raw
+    trace_enhanced rows (a pandas DataFrame) in, the same outputs out.
+    '''
+    n_pre = len(trace)
+    if n_pre <= min_obs:
+        return clean_filtered(trace, n_pre, n_pre, min_obs)
+
+    trace, n_post_bbw = filter_rows(trace, start_date, end_date, profile=profile)
+    return clean_filtered(trace, n_pre, n_post_bbw, min_obs, profile=profile, memory_budget_mb=memory_budget_mb)
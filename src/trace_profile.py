@@ -0,0 +1,222 @@
+'''
+Overview
+-------------
+Per-stage instrumentation of the TRACE pipeline.
+
+A StageProfile is created for every chunk (load_trace.process_chunk) and
+handed down to the cleaning functions in trace_clean.py, which run each
+stage through it. For every stage it records:
+1. the number of calls (the row filters run once per fetched batch)
+2. the wall time in seconds
+3. the rows going in and coming out
+4. the peak memory: the traced Python allocations during the stage
+   (tracemalloc, only with track_memory as it slows the cleaning down)
+   and the resident set size of the process so far
+
+tracemalloc only keeps one peak for the whole process, so the traced peak
+of a stage is only right while no other thread allocates. The prefetch
+pipeline of load_trace.run_pipeline fetches and cleans on several threads
+at once; it traces a single peak of the whole run instead (ProcessPeak),
+and the run report says which of the two it holds.
+
+The records travel with the cleaning statistics of the chunk (and so
+through the checkpoints), and write_report collects them into a JSON run
+report with a summary of the slowest stages.
+'''
+
+import datetime as dt
+import json
+import time
+import tracemalloc
+from pathlib import Path
+
+import pandas as pd
+import polars as pl
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import config
+
+DATA_DIR = Path(config.DATA_DIR)
+REPORT_PATH = DATA_DIR / "pulled" / "trace_run_report.json"
+
+STAGE_COLUMNS = ['stage', 'calls', 'seconds', 'rows_in', 'rows_out', 'peak_mb', 'max_rss_mb']
+
+
+def _rows(*objs):
+    '''
+    This function counts the rows of the frames among objs (and in tuples
+    of them), None if there are none.
+    '''
+    counts = [len(obj) for obj in objs if isinstance(obj, (pd.DataFrame, pd.Series, pl.DataFrame))]
+    counts += [_rows(*obj) for obj in objs if isinstance(obj, tuple)]
+    counts = [n for n in counts if n is not None]
+    return sum(counts) if counts else None
+
+
+def _max_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StageProfile:
+    '''
+    Records the stages of one chunk. Stages with the same name are summed.
+    '''
+    def __init__(self, track_memory=False):
+        self.track_memory = track_memory
+        if track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.stages = {}
+
+    def _record(self, name, seconds, rows_in, rows_out, peak_mb):
+        stage = self.stages.setdefault(name, {'stage': name, 'calls': 0, 'seconds': 0.0,
+                                              'rows_in': None, 'rows_out': None,
+                                              'peak_mb': None, 'max_rss_mb': None})
+        stage['calls'] += 1
+        stage['seconds'] += seconds
+        for key, value in (('rows_in', rows_in), ('rows_out', rows_out)):
+            if value is not None:
+                stage[key] = (stage[key] or 0) + value
+        if peak_mb is not None:
+            stage['peak_mb'] = max(stage['peak_mb'] or 0, peak_mb)
+        stage['max_rss_mb'] = _max_rss_mb()
+
+    def run(self, name, fn, *args, **kwargs):
+        '''
+        This function calls fn(*args, **kwargs) as stage `name`. The rows
+        going in are those of the frames passed in (including the frame of a
+        bound method), the rows coming out those of the frames returned.
+        '''
+        if self.track_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2**20 if self.track_memory else None
+        rows_in = _rows(getattr(fn, '__self__', None), *args, *kwargs.values())
+        self._record(name, seconds, rows_in, _rows(result), peak_mb)
+        return result
+
+    def iterate(self, name, iterable):
+        '''
+        This function yields the items of iterable, recording the time spent
+        producing each of them (e.g. fetching a batch) as stage `name`.
+        '''
+        iterator = iter(iterable)
+        while True:
+            if self.track_memory:
+                tracemalloc.reset_peak()
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            seconds = time.perf_counter() - start
+            peak_mb = tracemalloc.get_traced_memory()[1] / 2**20 if self.track_memory else None
+            self._record(name, seconds, None, _rows(item), peak_mb)
+            yield item
+
+    def records(self):
+        return [dict(stage) for stage in self.stages.values()]
+
+
+class NoProfile(StageProfile):
+    '''
+    Stand-in used when a chunk is not profiled; runs every stage as is.
+    '''
+    def run(self, name, fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+    def iterate(self, name, iterable):
+        return iterable
+
+
+NO_PROFILE = NoProfile()
+
+
+class ProcessPeak:
+    '''
+    Context manager that traces the peak memory of the whole process over
+    the block, in peak_mb after it exits (None without track_memory).
+    '''
+    def __init__(self, track_memory=False):
+        self.track_memory = track_memory
+        self.peak_mb = None
+
+    def __enter__(self):
+        if self.track_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.track_memory:
+            self.peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+        return False
+
+
+def summarize(stages):
+    '''
+    This function sums the stage records of all chunks (a DataFrame with
+    STAGE_COLUMNS) per stage, slowest first, with each stage's share of
+    the total time.
+    '''
+    if stages.empty:
+        return pd.DataFrame(columns=STAGE_COLUMNS + ['share'])
+    summary = stages.groupby('stage', sort=False).agg(calls=('calls', 'sum'),
+                                                      seconds=('seconds', 'sum'),
+                                                      rows_in=('rows_in', 'sum'),
+                                                      rows_out=('rows_out', 'sum'),
+                                                      peak_mb=('peak_mb', 'max'),
+                                                      max_rss_mb=('max_rss_mb', 'max'))
+    summary['share'] = summary['seconds'] / summary['seconds'].sum()
+    return summary.sort_values('seconds', ascending=False).reset_index()
+
+
+def write_report(chunks, stats, path=REPORT_PATH, top=5, memory_scope=None, peak_mb=None):
+    '''
+    This function writes the run report of load_trace.run_chunks: the
+    date window, cleaning statistics and stage records of every chunk
+    (chunks are (cusips, start_date, end_date)), and the summary of
+    summarize. It prints the `top` slowest stages. memory_scope records
+    what the traced memory covers: 'stage' for the peak_mb of every stage,
+    'process' for a single peak_mb of the whole run (the stages then have
+    none), None if it was not traced.
+    Output: the summary DataFrame
+    '''
+    rows = []
+    for i, stage_stats in enumerate(stats):
+        for stage in stage_stats.get('stages', []):
+            rows.append({'chunk': i, **stage})
+    stages = pd.DataFrame(rows, columns=['chunk'] + STAGE_COLUMNS)
+    summary = summarize(stages)
+
+    report = {'created': dt.datetime.now().isoformat(timespec='seconds'),
+              'memory_scope': memory_scope,
+              'peak_mb': peak_mb,
+              'chunks': [{'chunk': i,
+                          'n_cusips': len(cusips),
+                          'start_date': None if start is None else str(pd.Timestamp(start).date()),
+                          'end_date': None if end is None else str(pd.Timestamp(end).date()),
+                          **chunk_stats}
+                         for i, ((cusips, start, end), chunk_stats) in enumerate(zip(chunks, stats))],
+              'summary': summary.astype(object).where(summary.notna(), None).to_dict('records')}
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    print(f'slowest stages over {len(stats)} chunks:')
+    for stage in summary.head(top).itertuples():
+        print(f'  {stage.stage:<20} {stage.seconds:10.1f}s {stage.share:6.1%}  {stage.calls} calls')
+    if memory_scope == 'process':
+        print(f'peak traced memory of the run: {peak_mb:.1f} MB (not traced per stage)')
+    return summary
@@ -0,0 +1,200 @@
+'''
+Overview
+-------------
+SQL builders for the WRDS pulls in load_trace.py.
+
+With pushdown the filters that trace_clean.py and load_trace.load_fisd
+apply after the pull are also written into the WHERE clause, so WRDS only
+sends the rows that would survive them:
+1. TRACE: the date window, entrd_vol_qt >= MIN_VOLUME and, for trades
+   reported before 2012-02-06, the van Binsbergen, Nozawa and Schwert
+   settlement, when-issued, locked-in and sale condition filters
+2. FISD: the BBW bond filters on the issue and issuer tables
+The client-side filters stay in place, so a pull without pushdown is the
+reference the pushed-down pull can be checked against.
+
+Every condition keeps the pandas treatment of missing values
+(None != 'Y' is True), and all values are bound as parameters
+(%(name)s, the psycopg2 style that wrds.Connection.raw_sql accepts).
+'''
+
+import pandas as pd
+
+import trace_clean
+
+TRACE_COLUMNS = ['cusip_id',
+                 'bond_sym_id',
+                 'trd_exctn_dt',
+                 'trd_exctn_tm',
+                 'days_to_sttl_ct',
+                 'lckd_in_ind',
+                 'wis_fl',
+                 'sale_cndtn_cd',
+                 'msg_seq_nb',
+                 'trc_st',
+                 'trd_rpt_dt',
+                 'trd_rpt_tm',
+                 'entrd_vol_qt',
+                 'rptd_pr',
+                 'yld_pt',
+                 'asof_cd',
+                 'orig_msg_seq_nb',
+                 'rpt_side_cd',
+                 'cntra_mp_id']
+
+FISD_ISSUER_COLUMNS = ['issuer_id', 'country_domicile']
+
+FISD_ISSUE_COLUMNS = ['complete_cusip', 'issue_id',
+                      'issuer_id', 'foreign_currency',
+                      'coupon_type', 'coupon', 'convertible',
+                      'asset_backed', 'rule_144a',
+                      'bond_type', 'private_placement',
+                      'interest_frequency', 'dated_date',
+                      'day_count_basis', 'offering_date',
+                      'offering_amt', 'maturity', 'principal_amt']
+
+# Agency, muni, government and other non-corporate bond types removed by BBW
+EXCLUDED_BOND_TYPES = ('TXMU', 'CCOV', 'CPAS', 'MBS', 'FGOV', 'USTC', 'USBD', 'USNT', 'USSP',
+                       'USSI', 'FGS', 'USBL', 'ABS', 'O30Y', 'O10Y', 'O3Y', 'O5Y', 'O4W',
+                       'CCUR', 'O13W', 'O52W', 'O26W', 'ADEB', 'AMTN', 'ASPZ', 'EMTN',
+                       'ADNT', 'ARNT')
+
+# Floating-rate, bi-monthly and unclassified coupon frequencies
+EXCLUDED_INTEREST_FREQUENCIES = ('-1', '13', '14', '15', '16')
+
+
+def _date_param(date):
+    return pd.Timestamp(date).strftime('%Y-%m-%d')
+
+
+def build_query(table, columns, conditions):
+    where = '\n  AND '.join(conditions)
+    sql = f"SELECT {', '.join(columns)}\nFROM {table}"
+    return sql + f'\nWHERE {where}' if conditions else sql
+
+
+def _window_conditions(cusips, start_date=None, end_date=None):
+    conditions = ['cusip_id IN %(cusip_id)s']
+    params = {'cusip_id': tuple(cusips)}
+
+    if start_date is not None:
+        conditions.append('trd_exctn_dt >= %(start_date)s')
+        params['start_date'] = _date_param(start_date)
+    if end_date is not None:
+        conditions.append('trd_exctn_dt <= %(end_date)s')
+        params['end_date'] = _date_param(end_date)
+    return conditions, params
+
+
+def build_trace_query(cusips, start_date=None, end_date=None, pushdown=True, exctn_dates=None):
+    '''
+    This function builds the trace_enhanced query for one chunk of CUSIPs.
+    start_date and end_date bound the execution date (inclusive, None means
+    unbounded) and are applied whether or not pushdown is on. exctn_dates
+    restricts the pull to a set of execution dates.
+    Output: sql, params
+    '''
+    conditions, params = _window_conditions(cusips, start_date, end_date)
+
+    if exctn_dates is not None:
+        conditions.append('trd_exctn_dt IN %(exctn_dates)s')
+        params['exctn_dates'] = tuple(_date_param(date) for date in exctn_dates)
+
+    if pushdown:
+        # Remove trades with volume < $10,000
+        conditions.append('entrd_vol_qt >= %(min_volume)s')
+        params['min_volume'] = trace_clean.MIN_VOLUME
+
+        # van Binsbergen, Nozawa and Schwert filters, pre 2012 reports only
+        conditions.append('(trd_rpt_dt >= %(post_2012_date)s'
+                          ' OR ((days_to_sttl_ct IS NULL OR days_to_sttl_ct IN %(days_to_sttl_ct)s)'
+                          " AND (wis_fl IS NULL OR wis_fl <> 'Y')"
+                          " AND (lckd_in_ind IS NULL OR lckd_in_ind <> 'Y')"
+                          " AND (sale_cndtn_cd IS NULL OR sale_cndtn_cd = '@')))")
+        params['post_2012_date'] = trace_clean.POST_2012_DATE
+        params['days_to_sttl_ct'] = ('000', '001', '002')
+
+    return build_query('trace.trace_enhanced', TRACE_COLUMNS, conditions), params
+
+
+def build_count_query(cusips, start_date=None, end_date=None):
+    '''
+    This function builds the query counting the trace_enhanced rows of a
+    chunk before the pushed-down filters (n) and after the volume filter
+    alone (n_post_bbw), the Obs.Pre and Obs.PostBBW of the original pull.
+    Output: sql, params
+    '''
+    conditions, params = _window_conditions(cusips, start_date, end_date)
+    params['min_volume'] = trace_clean.MIN_VOLUME
+    columns = ['COUNT(*) AS n',
+               'COUNT(CASE WHEN entrd_vol_qt >= %(min_volume)s THEN 1 END) AS n_post_bbw']
+    return build_query('trace.trace_enhanced', columns, conditions), params
+
+
+def build_row_counts_query(cusips, start_date=None, end_date=None):
+    '''
+    This function builds the query counting the trace_enhanced rows of every
+    CUSIP per execution year, the statistics trace_plan.py sizes chunks with.
+    Output: sql, params
+    '''
+    conditions, params = _window_conditions(cusips, start_date, end_date)
+    sql = build_query('trace.trace_enhanced',
+                      ['cusip_id', 'EXTRACT(YEAR FROM trd_exctn_dt) AS year', 'COUNT(*) AS n'],
+                      conditions)
+    return sql + '\nGROUP BY cusip_id, EXTRACT(YEAR FROM trd_exctn_dt)', params
+
+
+def build_affected_days_query(cusips, since, start_date=None, end_date=None):
+    '''
+    This function builds the query for the bond-days of a chunk that have
+    records reported on or after `since`, with the latest report date of each.
+    Output: sql, params
+    '''
+    conditions, params = _window_conditions(cusips, start_date, end_date)
+    conditions.append('trd_rpt_dt >= %(since)s')
+    params['since'] = _date_param(since)
+
+    sql = build_query('trace.trace_enhanced',
+                      ['cusip_id', 'trd_exctn_dt', 'MAX(trd_rpt_dt) AS trd_rpt_dt'],
+                      conditions)
+    return sql + '\nGROUP BY cusip_id, trd_exctn_dt', params
+
+
+def build_fisd_queries(pushdown=True):
+    '''
+    This function builds the queries for the Mergent FISD issuer and issue tables.
+    Output: (issuer_sql, issuer_params), (issue_sql, issue_params)
+    '''
+    issuer_conditions, issuer_params = [], {}
+    issue_conditions, issue_params = [], {}
+
+    if pushdown:
+        #1: Discard all non-US Bonds (i) in BBW
+        issuer_conditions.append("country_domicile = 'USA'")
+
+        issue_conditions += [
+            #2.1: US FX
+            "foreign_currency = 'N'",
+            #3: Must have a fixed coupon
+            "coupon_type <> 'V'",
+            #4-6: Discard convertible, asset-backed and Rule 144A bonds
+            "convertible = 'N'",
+            "asset_backed = 'N'",
+            "rule_144a = 'N'",
+            #7: Remove Agency bonds, Muni Bonds, Government Bonds
+            '(bond_type IS NULL OR bond_type NOT IN %(excluded_bond_types)s)',
+            #8: No Private Placement
+            "private_placement = 'N'",
+            #9: Remove floating-rate, bi-monthly and unclassified coupons
+            'interest_frequency NOT IN %(excluded_interest_frequencies)s',
+            #10: Remove bonds lacking information for accrued interest
+            'dated_date IS NOT NULL',
+            'day_count_basis IS NOT NULL',
+            'offering_date IS NOT NULL',
+            'coupon IS NOT NULL']
+        issue_params['excluded_bond_types'] = EXCLUDED_BOND_TYPES
+        issue_params['excluded_interest_frequencies'] = EXCLUDED_INTEREST_FREQUENCIES
+
+    issuer = build_query('fisd.fisd_mergedissuer', FISD_ISSUER_COLUMNS, issuer_conditions), issuer_params
+    issue = build_query('fisd.fisd_mergedissue', FISD_ISSUE_COLUMNS, issue_conditions), issue_params
+    return issuer, issue
@@ -0,0 +1,138 @@
+'''
+Overview
+-------------
+Out-of-core daily aggregation for chunks whose cleaned trades do not fit
+in memory next to the aggregation.
+
+When the aggregation of a chunk would take more than the memory budget
+(TRACE_MEMORY_BUDGET_MB, estimated by aggregation_mb), clean_filtered
+spills the cleaned trades to a temporary directory instead of stacking
+them, partitioned by execution date:
+
+    <spill_dir>/<tmp>/part-0000/pre-0000.parquet
+                               /post-0001.parquet
+                      /part-0001/...
+
+The partitions are date ranges holding about the same number of rows
+(date_bounds), so a bond-day never spans two of them, and each is read
+back and aggregated on its own. Within a partition the pieces are read in
+the order they are stacked in memory, so the daily output is identical.
+The directory is removed when the TradeSpill is closed.
+'''
+
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+import config
+
+SPILL_DIR = Path(config.TRACE_SPILL_DIR)
+TRACE_MEMORY_BUDGET_MB = config.TRACE_MEMORY_BUDGET_MB
+
+# Peak memory of combine_pre_post and aggregate_trades per cleaned trade
+# (tracemalloc on trace_synth data)
+AGGREGATION_BYTES_PER_TRADE = 320
+
+
+def aggregation_mb(n_trades):
+    '''
+    This function estimates the peak memory in MB of the daily aggregation
+    of n_trades trades.
+    '''
+    return n_trades * AGGREGATION_BYTES_PER_TRADE / 2**20
+
+
+def n_partitions(n_trades, memory_budget_mb=TRACE_MEMORY_BUDGET_MB):
+    '''
+    This function returns the number of date partitions the aggregation of
+    n_trades trades is split into so each fits in memory_budget_mb: 1 (no
+    spilling) when it fits as a whole or without a budget.
+    '''
+    if not memory_budget_mb or memory_budget_mb <= 0:
+        return 1
+    return max(1, int(np.ceil(aggregation_mb(n_trades) / memory_budget_mb)))
+
+
+def _days(dates):
+    return np.asarray(pd.to_datetime(np.asarray(dates)), dtype='datetime64[D]')
+
+
+def date_bounds(dates, n):
+    '''
+    This function splits the execution dates of a chunk into at most n
+    ranges with about the same number of trades each.
+    Output: the first date of every range but the first (datetime64[D] array)
+    '''
+    days, counts = np.unique(_days(dates), return_counts=True)
+    if n <= 1 or len(days) == 0:
+        return np.array([], dtype='datetime64[D]')
+    # a range starts at every date whose earlier trades pass another 1/n of the total
+    before = np.cumsum(counts) - counts
+    part = np.minimum(before * n // counts.sum(), n - 1)
+    return days[1:][np.diff(part) > 0]
+
+
+class TradeSpill:
+    '''
+    Cleaned trades (pandas or polars DataFrames) written to date partitions
+    on disk. Use it as a context manager, so the files are always removed.
+    '''
+    def __init__(self, bounds, spill_dir=None):
+        self.bounds = bounds
+        spill_dir = SPILL_DIR if spill_dir is None else spill_dir
+        Path(spill_dir).mkdir(parents=True, exist_ok=True)
+        self.path = Path(tempfile.mkdtemp(prefix='trace_spill_', dir=spill_dir))
+        self.empty = {}
+        self.rows = 0
+        self._pieces = 0
+
+    def write(self, frame, name):
+        '''
+        This function appends the trades in frame to their partitions under
+        `name` (e.g. 'pre' and 'post', the pieces combine_pre_post stacks).
+        '''
+        self.empty.setdefault(name, frame[:0])
+        self.rows += len(frame)
+        part = np.searchsorted(self.bounds, _days(frame['trd_exctn_dt']), side='right')
+        for p in np.unique(part):
+            mask = part == p
+            directory = self.path / f'part-{p:04d}'
+            directory.mkdir(exist_ok=True)
+            path = directory / f'{name}-{self._pieces:04d}.parquet'
+            if isinstance(frame, pl.DataFrame):
+                frame.filter(pl.Series(mask)).write_parquet(path)
+            else:
+                frame[mask].to_parquet(path, index=False)
+        self._pieces += 1
+
+    def partitions(self):
+        '''
+        This function yields the trades of every partition, in date order,
+        as a dict of the frames written under each name. Names without
+        trades in the partition get an empty frame.
+        '''
+        for directory in sorted(self.path.glob('part-*')):
+            part = {}
+            for name, empty in self.empty.items():
+                # the piece number in the file names keeps the order of the writes
+                paths = sorted(directory.glob(f'{name}-*.parquet'), key=lambda path: path.name.split('-')[-1])
+                if isinstance(empty, pl.DataFrame):
+                    frames = [pl.read_parquet(path) for path in paths]
+                    part[name] = pl.concat(frames) if frames else empty
+                else:
+                    frames = [pd.read_parquet(path) for path in paths]
+                    part[name] = pd.concat(frames, ignore_index=True) if frames else empty
+            yield part
+
+    def close(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
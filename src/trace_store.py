@@ -0,0 +1,163 @@
+'''
+Overview
+-------------
+Partitioned Parquet store for the daily TRACE outputs of load_trace.py.
+Each output is a dataset partitioned by trade year:
+
+    <store_dir>/Prices/year=2010/part-0.parquet
+                      /year=2011/part-0.parquet
+               /Volumes/...
+               /Illiq/...
+
+Rows are sorted by (cusip_id, trd_exctn_dt) inside every file and the
+columns are typed, so a reader only decodes the columns it asks for and
+skips the years (and row groups) outside its date range.
+iter_cusip_partitions reads a dataset a range of bonds at a time, for the
+stages that only need the rows of one bond together.
+'''
+
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import config
+
+DATA_DIR = Path(config.DATA_DIR)
+STORE_DIR = DATA_DIR / "pulled" / "trace_store"
+
+INDEX_COLUMNS = ['cusip_id', 'trd_exctn_dt']
+
+SCHEMAS = {
+    'Prices':  pa.schema([('cusip_id', pa.string()), ('trd_exctn_dt', pa.date32()),
+                          ('prc_ew', pa.float64()), ('prc_vw', pa.float64())]),
+    'Volumes': pa.schema([('cusip_id', pa.string()), ('trd_exctn_dt', pa.date32()),
+                          ('qvolume', pa.float64()), ('dvolume', pa.float64())]),
+    'Illiq':   pa.schema([('cusip_id', pa.string()), ('trd_exctn_dt', pa.date32()),
+                          ('prc_bid', pa.float64()), ('prc_ask', pa.float64())]),
+}
+
+ROW_GROUP_SIZE = 1_000_000
+
+# Rows read at a time by iter_cusip_partitions
+PARTITION_ROWS = 2_000_000
+
+
+def dataset_path(name, store_dir=STORE_DIR):
+    return Path(store_dir) / name
+
+
+def write_dataset(df, name, store_dir=STORE_DIR, row_group_size=ROW_GROUP_SIZE):
+    '''
+    This function writes one daily output (indexed by cusip_id and
+    trd_exctn_dt, as returned by load_trace.run_chunks) to the store,
+    replacing any earlier version of the dataset.
+    '''
+    schema = SCHEMAS[name]
+    df = df.reset_index() if df.index.names == INDEX_COLUMNS else df
+    df = df[schema.names].copy()
+    df['trd_exctn_dt'] = pd.to_datetime(df['trd_exctn_dt'])
+    df = df.sort_values(INDEX_COLUMNS, kind='stable')
+
+    path = dataset_path(name, store_dir)
+    if path.exists():
+        shutil.rmtree(path)
+
+    for year, year_df in df.groupby(df['trd_exctn_dt'].dt.year, sort=True):
+        table = pa.Table.from_pandas(year_df, schema=schema, preserve_index=False)
+        year_path = path / f'year={year}'
+        year_path.mkdir(parents=True, exist_ok=True)
+        pq.write_table(table, year_path / 'part-0.parquet', row_group_size=row_group_size)
+
+
+def read_dataset(name, columns=None, start_date=None, end_date=None, store_dir=STORE_DIR, cusip_range=None):
+    '''
+    This function reads a dataset from the store as a flat frame with
+    cusip_id, trd_exctn_dt and the requested value columns (all of them by
+    default), sorted by (cusip_id, trd_exctn_dt).
+    Only the requested columns are decoded. start_date and end_date
+    (inclusive, None means unbounded) prune whole year partitions and the
+    row groups outside the range before anything is read. cusip_range, a
+    (first, last) pair of CUSIPs, keeps the bonds in between (inclusive);
+    as the files are sorted by cusip_id, it prunes row groups as well.
+    '''
+    value_columns = [c for c in SCHEMAS[name].names if c not in INDEX_COLUMNS]
+    columns = value_columns if columns is None else list(columns)
+    unknown = set(columns) - set(value_columns)
+    if unknown:
+        raise ValueError(f'{name} has no column(s) {sorted(unknown)}')
+
+    dataset = ds.dataset(dataset_path(name, store_dir), format='parquet', partitioning='hive')
+
+    filter = None
+    if start_date is not None:
+        start_date = pd.Timestamp(start_date)
+        filter = (ds.field('year') >= start_date.year) & \
+                 (ds.field('trd_exctn_dt') >= pa.scalar(start_date.date(), pa.date32()))
+    if end_date is not None:
+        end_date = pd.Timestamp(end_date)
+        end_filter = (ds.field('year') <= end_date.year) & \
+                     (ds.field('trd_exctn_dt') <= pa.scalar(end_date.date(), pa.date32()))
+        filter = end_filter if filter is None else filter & end_filter
+    if cusip_range is not None:
+        first, last = cusip_range
+        cusip_filter = (ds.field('cusip_id') >= first) & (ds.field('cusip_id') <= last)
+        filter = cusip_filter if filter is None else filter & cusip_filter
+
+    table = dataset.to_table(columns=INDEX_COLUMNS + columns, filter=filter)
+    df = table.to_pandas(date_as_object=False)
+    df['trd_exctn_dt'] = df['trd_exctn_dt'].astype('datetime64[ns]')
+    return df.sort_values(INDEX_COLUMNS, kind='stable', ignore_index=True)
+
+
+def cusip_counts(name, store_dir=STORE_DIR):
+    '''
+    This function returns the rows of every bond in a dataset, indexed by
+    cusip_id in sorted order. Only the cusip_id column is read, one batch
+    at a time.
+    '''
+    dataset = ds.dataset(dataset_path(name, store_dir), format='parquet', partitioning='hive')
+    counts = {}
+    for batch in dataset.to_batches(columns=['cusip_id']):
+        batch_counts = pc.value_counts(batch.column('cusip_id'))
+        for cusip, n in zip(batch_counts.field('values').to_pylist(), batch_counts.field('counts').to_pylist()):
+            if cusip is not None:
+                counts[cusip] = counts.get(cusip, 0) + n
+    return pd.Series(counts, dtype='int64').sort_index()
+
+
+def cusip_ranges(counts, partition_rows=PARTITION_ROWS):
+    '''
+    This function splits the sorted bonds of cusip_counts into consecutive
+    ranges of about partition_rows rows each. A bond is never split, so a
+    bond with more rows makes a range on its own.
+    Output: list of (first, last) CUSIPs
+    '''
+    if len(counts) == 0:
+        return []
+    rows = counts.to_numpy()
+    # a range starts at every bond whose earlier rows pass another partition_rows
+    before = np.cumsum(rows) - rows
+    part = before // max(int(partition_rows), 1)
+    starts = np.flatnonzero(np.r_[True, np.diff(part) > 0])
+    ends = np.r_[starts[1:], len(rows)] - 1
+    cusips = counts.index
+    return [(cusips[s], cusips[e]) for s, e in zip(starts, ends)]
+
+
+def iter_cusip_partitions(name, columns=None, partition_rows=PARTITION_ROWS, start_date=None, end_date=None,
+                          store_dir=STORE_DIR):
+    '''
+    This function yields a dataset bond range by bond range, like
+    read_dataset, with about partition_rows rows at a time. Every bond is
+    read whole (all its years) in one partition and the partitions come in
+    cusip_id order, so stacking them gives read_dataset.
+    '''
+    for cusip_range in cusip_ranges(cusip_counts(name, store_dir), partition_rows):
+        yield read_dataset(name, columns=columns, start_date=start_date, end_date=end_date, store_dir=store_dir,
+                           cusip_range=cusip_range)
@@ -0,0 +1,243 @@
+'''
+Overview
+-------------
+Seeded synthetic TRACE Enhanced data with a known ground truth, for
+benchmarks at scale (bench_trace.py stages) and for seeding the local
+WRDS stand-in (wrds_local.py).
+
+synthetic_trace draws base trades and then adds, for a share of them, the
+records the Dick-Nielsen cleaning has to deal with:
+1. after 2012-02-06: X/C records cancelling a trade, Y records reversing
+   one, and exact duplicates
+2. before 2012-02-06: C records cancelling a trade, chains of one to three
+   W records correcting it, asof_cd R reversals (reported a few days later,
+   half of them at another execution time), asof_cd D/X records and exact
+   duplicates, plus trades failing the BNS settlement, when-issued,
+   locked-in and sale condition filters
+3. everywhere: trades below the $10,000 volume filter
+The frames have exactly the trace_enhanced columns of trace_query.py,
+with times as 'HH:MM:SS' strings like a raw pull. Next to every frame
+comes the ground truth: a mask of the records that survive the cleaning,
+one per surviving trade. Y records do not remove trades, as in
+trace_clean.clean_post_2012 by default.
+
+Trades per CUSIP follow a Pareto distribution, so a few bonds trade far
+more than the rest. iter_synthetic_trace yields the data in blocks of
+CUSIPs, so 100M trades never have to be in memory at once.
+
+    python src/trace_synth.py --trades 1000000 --local-dir data/wrds_local
+'''
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import trace_clean
+import trace_query
+import wrds_local
+
+START_DATE = '2010-01-04'
+END_DATE = '2014-12-31'
+
+# 'HH:MM:SS' of every second of the day
+TIME_STRINGS = np.array([f'{s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}' for s in range(86400)], dtype=object)
+
+POST_EVENTS = {'xc': .05, 'y': .05, 'dup': .02}
+PRE_EVENTS = {'c': .05, 'w': .07, 'rev': .06, 'dx': .02, 'dup': .02}
+
+# events whose base trade does not survive the cleaning
+REMOVING_EVENTS = ['xc', 'c', 'w', 'rev']
+
+
+def cusip_ids(first, n):
+    return np.array([f'{i:06d}SY{i % 10}' for i in range(first, first + n)], dtype=object)
+
+
+def _draw_events(rng, is_pre):
+    events = np.full(len(is_pre), '', dtype=object)
+    u = rng.random(len(is_pre))
+    for mask, probabilities in ((~is_pre, POST_EVENTS), (is_pre, PRE_EVENTS)):
+        edges = np.cumsum(list(probabilities.values()))
+        drawn = np.searchsorted(edges, u, side='right')
+        names = np.array(list(probabilities) + [''], dtype=object)
+        events[mask] = names[drawn[mask]]
+    return events
+
+
+def synthetic_trace(n_trades, n_cusips=100, seed=0, first_cusip=0, start_date=START_DATE, end_date=END_DATE):
+    '''
+    This function draws n_trades base trades of n_cusips CUSIPs (numbered
+    from first_cusip) executed between start_date and end_date, with the
+    cancellations, corrections, reversals and duplicates described above.
+    Output: trace (shuffled, trace_enhanced columns), survives (boolean
+    Series aligned to trace)
+    '''
+    rng = np.random.default_rng([seed, first_cusip])
+    cusips = cusip_ids(first_cusip, n_cusips)
+    weights = rng.pareto(1.2, n_cusips) + 0.01
+    days = pd.bdate_range(start_date, end_date)
+
+    n = n_trades
+    bond = rng.choice(n_cusips, n, p=weights / weights.sum())
+    day = rng.integers(0, len(days), n)
+    seconds = rng.integers(9 * 3600 + 1800, 16 * 3600, n)
+    is_pre = days[day] < pd.Timestamp(trace_clean.POST_2012_DATE)
+
+    base = pd.DataFrame({
+        'cusip_id':        cusips[bond],
+        'bond_sym_id':     np.array(['SY' + cusip[:6] for cusip in cusips], dtype=object)[bond],
+        'trd_exctn_dt':    days.to_numpy()[day],
+        'trd_exctn_tm':    TIME_STRINGS[seconds],
+        'days_to_sttl_ct': rng.choice(np.array(['000', '001', '002', '003', None], dtype=object), n,
+                                      p=[.1, .2, .6, .05, .05]),
+        'lckd_in_ind':     rng.choice(np.array(['Y', None], dtype=object), n, p=[.02, .98]),
+        'wis_fl':          rng.choice(np.array(['Y', 'N'], dtype=object), n, p=[.02, .98]),
+        'sale_cndtn_cd':   rng.choice(np.array(['@', None, 'C'], dtype=object), n, p=[.6, .37, .03]),
+        'msg_seq_nb':      np.arange(n).astype(str).astype(object),
+        'trc_st':          np.where(is_pre, 'T', rng.choice(['T', 'R'], n, p=[.9, .1])).astype(object),
+        'trd_rpt_dt':      days.to_numpy()[day],
+        'trd_rpt_tm':      TIME_STRINGS[seconds],
+        'entrd_vol_qt':    rng.choice([5000., 10000., 25000., 50000., 100000., 1000000.], n,
+                                      p=[.1, .3, .2, .15, .15, .1]),
+        'rptd_pr':         np.round(rng.normal(100, 5, n), 3),
+        'yld_pt':          np.round(rng.normal(5, 1, n), 3),
+        'asof_cd':         np.full(n, None, dtype=object),
+        'orig_msg_seq_nb': np.full(n, None, dtype=object),
+        'rpt_side_cd':     rng.choice(np.array(['B', 'S', 'D'], dtype=object), n),
+        'cntra_mp_id':     rng.choice(np.array(['C', 'D'], dtype=object), n)},
+        columns=trace_query.TRACE_COLUMNS)
+
+    events = _draw_events(rng, is_pre)
+    # a reversal is reported up to five days later, which has to stay before 2012-02-06
+    rev_day = np.minimum(day + rng.integers(1, 6, n), len(days) - 1)
+    late = (events == 'rev') & (days[rev_day] >= pd.Timestamp(trace_clean.POST_2012_DATE))
+    events[late] = ''
+
+    bns = trace_clean.bns_mask(base.assign(days_to_sttl_ct=base['days_to_sttl_ct'].fillna('None'),
+                                           sale_cndtn_cd=base['sale_cndtn_cd'].fillna('None')))
+    passes = (base['entrd_vol_qt'].to_numpy() >= trace_clean.MIN_VOLUME) & (~is_pre | bns)
+
+    next_msg = n
+    def new_msgs(k):
+        nonlocal next_msg
+        next_msg += k
+        return np.arange(next_msg - k, next_msg).astype(str).astype(object)
+
+    frames = [base]
+    survives = [passes & ~np.isin(events, REMOVING_EVENTS)]
+    def add(frame, survive=False):
+        frames.append(frame)
+        survives.append(np.full(len(frame), survive) if np.isscalar(survive) else survive)
+
+    # after 2012: X/C share the msg_seq_nb of the trade, Y points at it
+    xc = base[events == 'xc']
+    add(xc.assign(trc_st=rng.choice(np.array(['X', 'C'], dtype=object), len(xc))))
+    y = base[events == 'y']
+    add(y.assign(trc_st='Y', msg_seq_nb=new_msgs(len(y)), orig_msg_seq_nb=y['msg_seq_nb']))
+    add(base[events == 'dup'])
+
+    # before 2012: C cancels, W chains correct, asof R reverses
+    c = base[events == 'c']
+    add(c.assign(trc_st='C', msg_seq_nb=new_msgs(len(c)), orig_msg_seq_nb=c['msg_seq_nb']))
+
+    is_w = events == 'w'
+    chain = rng.integers(1, 4, n)
+    previous = base['msg_seq_nb']
+    for step in range(1, 4):
+        links = is_w & (chain >= step)
+        w = base[links].assign(trc_st='W', msg_seq_nb=new_msgs(links.sum()), orig_msg_seq_nb=previous[links],
+                               rptd_pr=np.round(base['rptd_pr'][links] + rng.normal(0, 1, links.sum()), 3))
+        # the last W of a chain replaces the trade
+        add(w, passes[links] & (chain[links] == step))
+        previous = previous.copy()
+        previous[links] = w['msg_seq_nb'].to_numpy()
+
+    is_rev = events == 'rev'
+    shift = np.where(rng.random(n) < .5, 0, rng.integers(1, 60, n))
+    rev = base[is_rev].assign(asof_cd='R', msg_seq_nb=new_msgs(is_rev.sum()),
+                              trd_exctn_tm=TIME_STRINGS[np.minimum(seconds + shift, 86399)[is_rev]],
+                              trd_rpt_dt=days.to_numpy()[rev_day[is_rev]])
+    add(rev)
+    dx = base[events == 'dx']
+    add(dx.assign(asof_cd=rng.choice(np.array(['D', 'X'], dtype=object), len(dx))))
+
+    # stacked column by column, pd.concat checks every value of the all-None columns
+    order = rng.permutation(sum(len(frame) for frame in frames))
+    trace = pd.DataFrame({col: np.concatenate([frame[col].to_numpy() for frame in frames])[order]
+                          for col in trace_query.TRACE_COLUMNS})
+    return trace, pd.Series(np.concatenate(survives)[order], name='survives')
+
+
+def iter_synthetic_trace(n_trades, chunk_trades=1_000_000, cusips_per_chunk=500, seed=0):
+    '''
+    This function yields (trace, survives) in chunks of about chunk_trades
+    base trades, each for its own block of cusips_per_chunk CUSIPs, so
+    every bond-day is complete within its chunk.
+    '''
+    for i, start in enumerate(range(0, n_trades, chunk_trades)):
+        yield synthetic_trace(min(chunk_trades, n_trades - start), n_cusips=cusips_per_chunk, seed=seed,
+                              first_cusip=i * cusips_per_chunk)
+
+
+def expected_trades(trace, survives):
+    '''
+    This function returns the ground truth in the form of
+    trace_clean.combine_pre_post: the surviving trades indexed by
+    (cusip_id, trd_exctn_dt).
+    '''
+    trades = trace.loc[survives.to_numpy(), ['cusip_id', 'trd_exctn_dt', 'rptd_pr', 'entrd_vol_qt', 'rpt_side_cd']]
+    trades = trades.assign(trd_exctn_dt=pd.to_datetime(trades['trd_exctn_dt']))
+    return trades.set_index(['cusip_id', 'trd_exctn_dt']).sort_index(level='cusip_id')
+
+
+def synthetic_fisd(cusips):
+    '''
+    This function builds Mergent FISD issue, issuer and rating tables for
+    `cusips` that pass the BBW bond filters of load_trace.load_fisd.
+    Output: issue, issuer, ratings
+    '''
+    n = len(cusips)
+    issue = pd.DataFrame({'complete_cusip': cusips, 'issue_id': np.arange(n) + 1,
+                          'issuer_id': np.arange(n) // 5 + 1, 'foreign_currency': 'N',
+                          'coupon_type': 'F', 'coupon': 5.0, 'convertible': 'N', 'asset_backed': 'N',
+                          'rule_144a': 'N', 'bond_type': 'CDEB', 'private_placement': 'N',
+                          'interest_frequency': '2', 'dated_date': pd.Timestamp('2005-01-03').date(),
+                          'day_count_basis': '30/360', 'offering_date': pd.Timestamp('2005-01-03').date(),
+                          'offering_amt': 500000.0, 'maturity': pd.Timestamp('2025-01-03').date(),
+                          'principal_amt': 1000.0})
+    issuer = pd.DataFrame({'issuer_id': np.unique(issue['issuer_id']), 'country_domicile': 'USA'})
+    ratings = pd.DataFrame({'issue_id': np.repeat(issue['issue_id'].to_numpy(), 2),
+                            'rating_type': np.tile(['SPR', 'MR'], n),
+                            'rating_date': pd.Timestamp('2005-01-03').date(),
+                            'rating': np.tile(['BBB', 'Baa2'], n)})
+    return issue, issuer, ratings
+
+
+def write_local(n_trades, local_dir=wrds_local.WRDS_LOCAL_DIR, n_cusips=500, seed=0):
+    '''
+    This function seeds the tables of the local WRDS stand-in with
+    synthetic TRACE and FISD data for n_cusips CUSIPs.
+    '''
+    trace, _ = synthetic_trace(n_trades, n_cusips=n_cusips, seed=seed)
+    trace = trace.assign(trd_exctn_dt=trace['trd_exctn_dt'].dt.date, trd_rpt_dt=trace['trd_rpt_dt'].dt.date)
+    issue, issuer, ratings = synthetic_fisd(cusip_ids(0, n_cusips))
+
+    wrds_local.save_table(trace, 'trace', 'trace_enhanced', local_dir)
+    wrds_local.save_table(issue, 'fisd', 'fisd_mergedissue', local_dir)
+    wrds_local.save_table(issuer, 'fisd', 'fisd_mergedissuer', local_dir)
+    wrds_local.save_table(ratings, 'fisd', 'fisd_ratings', local_dir)
+    print(f'{len(trace):,} TRACE records for {n_cusips} CUSIPs written to {local_dir}')
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Seed the local WRDS stand-in with synthetic data.')
+    parser.add_argument('--trades', type=int, default=1_000_000)
+    parser.add_argument('--cusips', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--local-dir', type=Path, default=wrds_local.WRDS_LOCAL_DIR)
+    args = parser.parse_args()
+
+    write_local(args.trades, args.local_dir, args.cusips, args.seed)
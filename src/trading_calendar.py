@@ -0,0 +1,144 @@
+'''
+Overview
+-------------
+Business-day calendar of the bond market, shared by the stages that count
+trading days (trade_gaps.py, and through it calc_spread_bias.py and
+calc_daily_return_cs.py).
+
+A BusinessCalendar holds a table with the business-day ordinal of every
+date from TABLE_START to TABLE_END, i.e. the business days since
+TABLE_START. The business days between two dates, np.busday_count(a, b),
+are then ordinal(b) - ordinal(a): one lookup per date and an integer
+subtraction. Dates outside the table fall back to np.busday_count.
+
+Two holiday sets are available, selected with TRADING_CALENDAR in .env:
+1. 'federal': the US federal holidays (USFederalHolidayCalendar)
+2. 'sifma': the holidays on which SIFMA recommends a full close of the
+   US bond market, i.e. the federal holidays plus Good Friday, with
+   Juneteenth from 2022 and no close on the Friday before a New Year's
+   Day that falls on a Saturday
+Holidays are taken between start_date and end_date, like the former
+per-call holiday lists. get_calendar builds each calendar once per process.
+'''
+
+import functools
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.holiday import (AbstractHolidayCalendar, GoodFriday, Holiday, USColumbusDay,
+                                    USFederalHolidayCalendar, USLaborDay, USMartinLutherKingJr,
+                                    USMemorialDay, USPresidentsDay, USThanksgivingDay, nearest_workday,
+                                    sunday_to_monday)
+
+import config
+
+START_DATE = config.START_DATE
+END_DATE = config.END_DATE
+TRADING_CALENDAR = config.TRADING_CALENDAR
+
+# Range of the ordinal table
+TABLE_START = '1970-01-01'
+TABLE_END = '2069-12-31'
+
+
+class SIFMAHolidayCalendar(AbstractHolidayCalendar):
+    '''
+    Full-day closes of the US bond market recommended by SIFMA.
+    '''
+    rules = [
+        Holiday("New Year's Day", month=1, day=1, observance=sunday_to_monday),
+        USMartinLutherKingJr,
+        USPresidentsDay,
+        GoodFriday,
+        USMemorialDay,
+        Holiday('Juneteenth National Independence Day', month=6, day=19, start_date='2022-06-19',
+                observance=nearest_workday),
+        Holiday('Independence Day', month=7, day=4, observance=nearest_workday),
+        USLaborDay,
+        USColumbusDay,
+        Holiday('Veterans Day', month=11, day=11, observance=nearest_workday),
+        USThanksgivingDay,
+        Holiday('Christmas Day', month=12, day=25, observance=nearest_workday),
+    ]
+
+
+HOLIDAY_CALENDARS = {'federal': USFederalHolidayCalendar,
+                     'sifma':   SIFMAHolidayCalendar}
+
+
+def _days(dates):
+    dates = np.asarray(dates)
+    if dates.dtype.kind != 'M':
+        dates = np.asarray(pd.to_datetime(dates))
+    return dates.astype('M8[D]', copy=False)
+
+
+class BusinessCalendar:
+    '''
+    Business-day ordinals of every date between start and end, on weekdays
+    other than `holidays`.
+    '''
+    def __init__(self, holidays, start=TABLE_START, end=TABLE_END):
+        self.holidays = _days(holidays)
+        self.start = np.datetime64(start, 'D')
+        days = np.arange(self.start, np.datetime64(end, 'D') + 1)
+        is_busday = np.is_busday(days, holidays=self.holidays)
+        # business days before each date, the ordinal of the next business day for a holiday
+        self.table = np.cumsum(is_busday) - is_busday
+
+    def ordinals(self, dates):
+        '''
+        This function returns the business-day ordinal of every date, the
+        number of business days from TABLE_START up to (excluding) the date.
+        The dates must not be missing.
+        '''
+        days = _days(dates)
+        offset = (days - self.start).astype('int64')
+        inside = (offset >= 0) & (offset < len(self.table))
+        if inside.all():
+            return self.table[offset]
+        ordinals = np.empty(len(days), dtype='int64')
+        ordinals[inside] = self.table[offset[inside]]
+        # np.busday_count only counts forward from the earlier date
+        before, after = ~inside & (offset < 0), ~inside & (offset >= 0)
+        ordinals[before] = -np.busday_count(days[before], self.start, holidays=self.holidays)
+        ordinals[after] = np.busday_count(self.start, days[after], holidays=self.holidays)
+        return ordinals
+
+    def count(self, begin, end):
+        '''
+        This function returns the business days from begin up to (excluding)
+        end, date by date, like np.busday_count(begin, end, holidays).
+        '''
+        begin, end = _days(begin), _days(end)
+        counts = self.ordinals(end) - self.ordinals(begin)
+        # np.busday_count counts the days after end up to begin, negated, when end is earlier
+        backward = end < begin
+        if backward.any():
+            one_day = np.timedelta64(1, 'D')
+            counts[backward] = self.ordinals(end[backward] + one_day) - self.ordinals(begin[backward] + one_day)
+        return counts
+
+    def is_trading_day(self, dates):
+        return np.is_busday(_days(dates), holidays=self.holidays)
+
+    def trading_days(self, start_date=START_DATE, end_date=END_DATE):
+        '''
+        This function returns the business days between start_date and end_date.
+        '''
+        days = np.arange(np.datetime64(pd.Timestamp(start_date), 'D'),
+                         np.datetime64(pd.Timestamp(end_date), 'D') + 1)
+        return pd.DatetimeIndex(days[np.is_busday(days, holidays=self.holidays)])
+
+
+@functools.lru_cache(maxsize=None)
+def get_calendar(name=TRADING_CALENDAR, start_date=START_DATE, end_date=END_DATE):
+    '''
+    This function returns the BusinessCalendar of the holiday set `name`
+    ('federal' or 'sifma') with the holidays between start_date and
+    end_date, built once per process.
+    '''
+    if name not in HOLIDAY_CALENDARS:
+        raise ValueError(f'unknown TRADING_CALENDAR {name!r}, expected one of {sorted(HOLIDAY_CALENDARS)}')
+    holidays = HOLIDAY_CALENDARS[name]().holidays(start_date, end_date)
+    return BusinessCalendar(holidays)
@@ -0,0 +1,400 @@
+'''
+Overview
+-------------
+Winsorization of the bid-ask bias (calc_spread_bias.py) and the credit
+spread (calc_daily_return_cs.py), with the output of
+scipy.stats.mstats.winsorize but without sorting the column.
+
+With limits (low, up) and n values, scipy sets the values below the order
+statistic of rank int(low * n) (0-based) to that value, and the values
+above the order statistic of rank n - int(up * n) - 1 to that one
+(winsor_ranks). Winsorizing is therefore a clip between two order
+statistics, which a Winsorizer finds with np.partition in linear time
+(fit) and records, so the same bounds can be applied again (transform).
+winsorize(values, limits) fits and applies them in one call and returns a
+plain float array. bench_trace.py winsorize --values 100000000 compares
+scipy, the Winsorizer and the streamed RankSelector.
+
+scipy ranks missing values after every other value and counts them in n.
+The Winsorizer follows it: when there are no more missing values than
+values cut at the top, the missing values are set to the upper bound,
+otherwise the top is not cut at all.
+
+RankSelector finds the order statistics exactly for a column that is
+too large for memory and is read chunk by chunk (Winsorizer.fit_selector).
+Every value is mapped to a 64-bit key with the order of the floats
+(order_keys), and the keys are counted by their top 16 bits while the
+chunks are added. The count of each bucket gives the bucket of a rank;
+the chunks are then read again and only the keys in that bucket are
+counted by their next 16 bits, until the bucket holds few enough values
+to be selected with np.partition. Memory stays at 65,536 counters plus
+MAX_CANDIDATES values, and it takes one or two more reads of the column.
+
+WINSORIZE_MODE in .env chooses how the scripts winsorize:
+1. 'pooled' (default): the bias and the credit spread over the whole panel
+2. 'cross_sectional': the bias, the spread, the credit spread and the
+   daily return across the bonds of every date (winsorize_panel)
+A DateWinsorizer fits the bounds of every date at once: the panel is
+sorted by value and then, stably, by date (a radix sort on the day
+numbers), so the order statistics of every date are read at the offsets
+winsor_ranks gives from the start of the date. With WINSORIZE_WORKERS
+above 1, the panel is first split into blocks of whole dates that are
+sorted and fitted in parallel threads. The bounds are kept in a
+table by date and applied to the rows by lookup. doit reruns both scripts
+when the mode changes, and bench_trace.py cross-section --values 10000000
+compares the DateWinsorizer with a groupby over the dates.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import config
+
+WINSORIZE_MODE = config.WINSORIZE_MODE
+WINSORIZE_WORKERS = config.WINSORIZE_WORKERS
+
+MODES = ('pooled', 'cross_sectional')
+
+# Bits of the key counted at every level
+KEY_BITS = 16
+# Values of a bucket gathered and selected directly
+MAX_CANDIDATES = 1_000_000
+# Share of the values winsorized at each end
+LIMITS = (0.005, 0.005)
+
+_SIGN = np.uint64(1) << np.uint64(63)
+
+
+def winsor_ranks(n, limits):
+    '''
+    This function returns the 0-based ranks of the lower and upper bounds
+    scipy.stats.mstats.winsorize(a, limits) clips n values at (with the
+    default inclusive=(True, True)), None for an end that is not cut.
+    n can also be an array of counts, one per group.
+    '''
+    low, up = limits
+    n = np.asarray(n, dtype='int64')
+    lower = (low * n).astype('int64') if low else None
+    upper = n - (n * up).astype('int64') - 1 if up else None
+    return lower, upper
+
+
+def order_keys(values):
+    '''
+    This function maps float64 values to uint64 keys in the same order:
+    the bits of a positive float with the sign bit set, and the inverted
+    bits of a negative one.
+    '''
+    bits = np.ascontiguousarray(values, dtype='float64').view('uint64')
+    # all ones for a negative float (arithmetic shift of the sign), only the sign bit otherwise
+    keys = (bits.view('int64') >> 63).view('uint64')
+    keys |= _SIGN
+    keys ^= bits
+    return keys
+
+
+def key_value(key):
+    '''
+    This function returns the float64 value of a key of order_keys.
+    '''
+    key = np.uint64(key)
+    bits = key ^ _SIGN if key & _SIGN else ~key
+    return float(np.array([bits], dtype='uint64').view('float64')[0])
+
+
+class RankSelector:
+    '''
+    Exact order statistics of the float64 values added chunk by chunk, in
+    memory that does not grow with their number. Missing values are counted
+    in n_missing and left out of the ranks.
+    '''
+    def __init__(self, max_candidates=MAX_CANDIDATES):
+        self.max_candidates = max_candidates
+        self.counts = np.zeros(1 << KEY_BITS, dtype='int64')
+        self.n = 0
+        self.n_missing = 0
+
+    def add(self, values):
+        '''
+        This function counts the values of one chunk.
+        '''
+        values = np.asarray(values, dtype='float64')
+        missing = np.isnan(values)
+        self.n_missing += int(missing.sum())
+        values = values[~missing]
+        self.n += len(values)
+        buckets = order_keys(values)
+        buckets >>= np.uint64(64 - KEY_BITS)
+        self.counts += np.bincount(buckets.view('int64'), minlength=len(self.counts))
+
+    def select(self, rank, chunks):
+        '''
+        This function returns the value of 0-based rank among the values
+        added. chunks is a function returning a new iterator over the same
+        chunks that were added, which is read again to narrow the bucket.
+        '''
+        if not 0 <= rank < self.n:
+            raise IndexError(f'rank {rank} out of range for {self.n} values')
+        counts, shift, prefix = self.counts, 64 - KEY_BITS, 0
+        while True:
+            # the bucket of the rank and its rank inside the bucket
+            cumulative = np.cumsum(counts)
+            bucket = int(np.searchsorted(cumulative, rank, side='right'))
+            rank -= int(cumulative[bucket] - counts[bucket])
+            prefix = (prefix << KEY_BITS) | bucket
+            if shift == 0:
+                return key_value(prefix)
+            if counts[bucket] <= self.max_candidates:
+                candidates = np.concatenate([np.empty(0, dtype='uint64'),
+                                             *self._bucket_keys(chunks, prefix, shift)])
+                return key_value(np.partition(candidates, rank)[rank])
+            shift -= KEY_BITS
+            counts = np.zeros(1 << KEY_BITS, dtype='int64')
+            mask = np.uint64((1 << KEY_BITS) - 1)
+            for keys in self._bucket_keys(chunks, prefix, shift + KEY_BITS):
+                counts += np.bincount(((keys >> np.uint64(shift)) & mask).astype('intp'), minlength=len(counts))
+
+    def _bucket_keys(self, chunks, prefix, shift):
+        # the keys of every chunk whose bits above shift are prefix
+        for values in chunks():
+            values = np.asarray(values, dtype='float64')
+            keys = order_keys(values[~np.isnan(values)])
+            yield keys[(keys >> np.uint64(shift)) == np.uint64(prefix)]
+
+
+class Winsorizer:
+    '''
+    Bounds of scipy.stats.mstats.winsorize(values, limits), fitted once and
+    applied to any values. lower and upper are the values clipped at (-inf
+    and inf for no cut), nan_value the value missing values are set to.
+    '''
+    def __init__(self, limits=LIMITS):
+        for limit in limits:
+            if limit is not None and not 0 <= limit < 1:
+                raise ValueError(f'winsorize limits must be at least 0 and below 1, got {limits}')
+        self.limits = tuple(limits)
+        self.lower, self.upper, self.nan_value = -np.inf, np.inf, np.nan
+
+    def fit(self, values):
+        '''
+        This function fits the bounds to an array of values in memory.
+        '''
+        values = np.asarray(values, dtype='float64').ravel()
+        missing = np.isnan(values)
+        n_missing = int(missing.sum())
+        present = values[~missing] if n_missing else values
+        ranks = [rank for rank in self._ranks(len(values)) if rank is not None and rank < len(present)]
+        # one partial sort puts both order statistics in place
+        selected = np.partition(present, ranks) if ranks else present
+        return self._fit(len(values), n_missing, lambda rank: float(selected[rank]))
+
+    def fit_selector(self, selector, chunks):
+        '''
+        This function fits the bounds to the values added to a RankSelector,
+        reading chunks (see RankSelector.select) again as needed.
+        '''
+        n = selector.n + selector.n_missing
+        return self._fit(n, selector.n_missing, lambda rank: selector.select(rank, chunks))
+
+    def _ranks(self, n):
+        return tuple(None if rank is None else int(rank) for rank in winsor_ranks(n, self.limits))
+
+    def _fit(self, n, n_missing, select):
+        lower_rank, upper_rank = self._ranks(n)
+        n_present = n - n_missing
+        self.lower, self.upper, self.nan_value = -np.inf, np.inf, np.nan
+        if lower_rank is not None:
+            # past the values present, scipy's bound is a missing value, which it gives every value
+            self.lower = select(lower_rank) if lower_rank < n_present else np.nan
+        if upper_rank is not None and upper_rank < n_present:
+            # scipy cuts the top after the bottom, so crossed bounds end at the lower one
+            crossed = lower_rank is not None and upper_rank < lower_rank
+            self.upper = self.lower if crossed else select(upper_rank)
+            if n_missing:
+                self.nan_value = self.upper
+        return self
+
+    def transform(self, values):
+        '''
+        This function returns the values clipped at the fitted bounds, as a
+        new float64 array.
+        '''
+        values = np.asarray(values, dtype='float64')
+        winsorized = np.clip(values, self.lower, self.upper)
+        if not np.isnan(self.nan_value):
+            winsorized[np.isnan(values)] = self.nan_value
+        return winsorized
+
+    def fit_transform(self, values):
+        return self.fit(values).transform(values)
+
+
+def winsorize(values, limits=LIMITS):
+    '''
+    This function returns the values winsorized like
+    scipy.stats.mstats.winsorize(values, limits), as a float64 array.
+    '''
+    return Winsorizer(limits).fit_transform(values)
+
+
+def _days(dates):
+    dates = np.asarray(dates)
+    if dates.dtype.kind != 'M':
+        dates = np.asarray(pd.to_datetime(dates))
+    return dates.astype('M8[D]', copy=False).ravel()
+
+
+def _day_codes(days, first):
+    # days since first, as uint16 when they fit so the stable sorts are radix sorts
+    codes = (days - first).astype('int64')
+    return codes.astype('uint16') if len(codes) and codes.max() < 2**16 else codes
+
+
+def date_blocks(codes, n_blocks):
+    '''
+    This function splits sorted day codes into at most n_blocks slices of
+    about the same number of rows, without splitting a date.
+    Output: list of (start, stop) row offsets
+    '''
+    if len(codes) == 0:
+        return []
+    n_blocks = max(n_blocks, 1)
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    # a block starts at every date whose earlier rows pass another 1/n_blocks of the rows
+    block = np.minimum(starts * n_blocks // len(codes), n_blocks - 1)
+    cuts = starts[np.r_[True, np.diff(block) > 0]]
+    return list(zip(cuts, np.r_[cuts[1:], len(codes)]))
+
+
+class DateWinsorizer:
+    '''
+    Bounds of scipy.stats.mstats.winsorize(values, limits) applied to the
+    values of every date separately (cross-sectional winsorization).
+    bounds is a DataFrame indexed by date with the lower, upper and
+    nan_value of each date, like the attributes of a Winsorizer.
+    '''
+    def __init__(self, limits=LIMITS, workers=WINSORIZE_WORKERS):
+        self.limits = Winsorizer(limits).limits
+        self.workers = workers
+        self.bounds = pd.DataFrame({'lower': [], 'upper': [], 'nan_value': []},
+                                   index=pd.DatetimeIndex([], name='date'))
+
+    def fit(self, values, dates):
+        '''
+        This function fits the bounds of the dates in `dates`, which must
+        come with every value of those dates. Dates fitted before are kept
+        unless they are fitted again, so a panel can be fitted in blocks of
+        dates.
+        '''
+        values = np.asarray(values, dtype='float64').ravel()
+        days = _days(dates)
+        if len(values) != len(days):
+            raise ValueError(f'{len(values)} values for {len(days)} dates')
+        # rows without a date have no cross-section
+        dated = ~np.isnat(days)
+        values, days = values[dated], days[dated]
+        if len(days) == 0:
+            return self
+
+        first = days.min()
+        codes = _day_codes(days, first)
+        blocks = [(0, len(codes))]
+        if self.workers > 1:
+            # blocks of whole dates for the threads; a single block needs no date order
+            order = np.argsort(codes, kind='stable')
+            values, codes = values[order], codes[order]
+            blocks = date_blocks(codes, self.workers)
+
+        fit_block = lambda block: self._fit_block(values[slice(*block)], codes[slice(*block)], first)
+        if len(blocks) > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                fitted = pd.concat(list(executor.map(fit_block, blocks)))
+        else:
+            fitted = pd.concat([fit_block(block) for block in blocks])
+        if len(self.bounds):
+            fitted = pd.concat([self.bounds[~self.bounds.index.isin(fitted.index)], fitted]).sort_index()
+        self.bounds = fitted
+        return self
+
+    def _fit_block(self, values, codes, first):
+        # sorted by date, then by value with the missing values last, as scipy ranks them
+        order = np.argsort(values)
+        order = order[np.argsort(codes[order], kind='stable')]
+        values, codes = values[order], codes[order]
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        n = np.diff(np.r_[starts, len(codes)])
+        n_missing = np.add.reduceat(np.isnan(values).astype('int64'), starts)
+        n_present = n - n_missing
+        lower_rank, upper_rank = winsor_ranks(n, self.limits)
+
+        lower = np.full(len(starts), -np.inf)
+        upper = np.full(len(starts), np.inf)
+        nan_value = np.full(len(starts), np.nan)
+        if lower_rank is not None:
+            # past the values present, scipy's bound is a missing value, which it gives every value
+            present = lower_rank < n_present
+            lower = np.where(present, values[starts + np.minimum(lower_rank, n - 1)], np.nan)
+        if upper_rank is not None:
+            present = upper_rank < n_present
+            upper = np.where(present, values[starts + np.clip(upper_rank, 0, n - 1)], np.inf)
+            if lower_rank is not None:
+                # scipy cuts the top after the bottom, so crossed bounds end at the lower one
+                upper = np.where(present & (upper_rank < lower_rank), lower, upper)
+            nan_value = np.where(present & (n_missing > 0), upper, np.nan)
+        days = first + codes[starts].astype('int64').astype('m8[D]')
+        return pd.DataFrame({'lower': lower, 'upper': upper, 'nan_value': nan_value},
+                            index=pd.DatetimeIndex(days, name='date'))
+
+    def transform(self, values, dates):
+        '''
+        This function returns the values clipped at the bounds of their
+        date, as a new float64 array. Dates without bounds are not clipped.
+        '''
+        values = np.asarray(values, dtype='float64')
+        days = _days(dates)
+        if len(self.bounds) == 0:
+            return values.copy()
+        # the bounds laid out by day from the first fitted date, the default for the others
+        fitted = self.bounds.index.values.astype('M8[D]')
+        offsets = (fitted - fitted[0]).astype('int64')
+        position = (days - fitted[0]).astype('int64')
+        inside = ~np.isnat(days) & (position >= 0) & (position <= offsets[-1])
+        position = np.where(inside, position, offsets[-1] + 1)
+
+        limits = []
+        for column, default in (('lower', -np.inf), ('upper', np.inf), ('nan_value', np.nan)):
+            table = np.full(offsets[-1] + 2, default)
+            table[offsets] = self.bounds[column].to_numpy()
+            limits.append(table[position])
+        lower, upper, nan_value = limits
+        winsorized = np.clip(values, lower, upper)
+        fill = np.isnan(values) & ~np.isnan(nan_value)
+        winsorized[fill] = nan_value[fill]
+        return winsorized
+
+    def fit_transform(self, values, dates):
+        return self.fit(values, dates).transform(values, dates)
+
+
+def winsorize_by_date(values, dates, limits=LIMITS, workers=WINSORIZE_WORKERS):
+    '''
+    This function returns the values winsorized like
+    scipy.stats.mstats.winsorize(values, limits) across the values of each
+    date, as a float64 array in the order of the rows.
+    '''
+    return DateWinsorizer(limits, workers).fit_transform(values, dates)
+
+
+def winsorize_panel(values, dates, mode=WINSORIZE_MODE, limits=LIMITS, workers=WINSORIZE_WORKERS):
+    '''
+    This function winsorizes a column of a (bond, date) panel over the
+    whole panel (mode 'pooled') or across the bonds of every date (mode
+    'cross_sectional').
+    '''
+    if mode not in MODES:
+        raise ValueError(f'unknown WINSORIZE_MODE {mode!r}, expected one of {list(MODES)}')
+    if mode == 'pooled':
+        return winsorize(values, limits)
+    return winsorize_by_date(values, dates, limits, workers)
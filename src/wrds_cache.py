@@ -0,0 +1,175 @@
+'''
+Overview
+-------------
+Local cache of WRDS query results.
+
+CachedConnection wraps a wrds.Connection and answers raw_sql from disk
+when the same query was run before:
+
+    <cache_dir>/<key>.parquet   (the result, a typed columnar file)
+               /<key>.json      (the SQL, the parameters and when it was pulled)
+
+The key is a hash of the SQL with its whitespace normalized and of the
+parameters. A result older than the TTL is pulled again. After every write
+the least recently used results are evicted until the cache fits in its
+size budget. In offline mode there is no WRDS connection at all and a
+query that is not cached raises CacheMissError, so CI can run the pulls
+from a cache filled beforehand without credentials.
+
+load_trace.py and load_rating.py open their connections through connect,
+which wraps them when WRDS_CACHE or WRDS_OFFLINE is set in .env and
+connects to the local stand-in of wrds_local.py with WRDS_BACKEND=local.
+'''
+
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import wrds
+
+import config
+import wrds_local
+
+DATA_DIR = Path(config.DATA_DIR)
+CACHE_DIR = DATA_DIR / "pulled" / "wrds_cache"
+
+WRDS_USERNAME = config.WRDS_USERNAME
+WRDS_BACKEND = config.WRDS_BACKEND
+WRDS_CACHE = config.WRDS_CACHE
+WRDS_OFFLINE = config.WRDS_OFFLINE
+WRDS_CACHE_TTL_DAYS = config.WRDS_CACHE_TTL_DAYS
+WRDS_CACHE_MAX_GB = config.WRDS_CACHE_MAX_GB
+
+
+class CacheMissError(RuntimeError):
+    '''
+    Raised in offline mode for a query that is not in the cache.
+    '''
+
+
+def cache_key(sql, params=None, **kwargs):
+    '''
+    This function returns the cache key of a query: a hash of the SQL with
+    all whitespace collapsed, the parameters and any raw_sql options.
+    '''
+    payload = json.dumps({'sql': ' '.join(sql.split()),
+                          'params': params,
+                          'kwargs': kwargs}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+
+class CachedConnection:
+    '''
+    Stand-in for wrds.Connection that caches the results of raw_sql.
+    db is the connection queried on a miss (None in offline mode).
+    '''
+    def __init__(self, db=None, cache_dir=CACHE_DIR, ttl_days=WRDS_CACHE_TTL_DAYS,
+                 max_gb=WRDS_CACHE_MAX_GB, offline=False):
+        if db is None and not offline:
+            raise ValueError('a CachedConnection without a connection has to be offline')
+        self.db = db
+        self.cache_dir = Path(cache_dir)
+        self.ttl = None if ttl_days is None else ttl_days * 86400
+        self.max_bytes = None if max_gb is None else max_gb * 2**30
+        self.offline = offline
+
+    def _paths(self, key):
+        return self.cache_dir / f'{key}.parquet', self.cache_dir / f'{key}.json'
+
+    def _lookup(self, key):
+        data, meta = self._paths(key)
+        if not (data.exists() and meta.exists()):
+            return None
+        with open(meta) as f:
+            pulled = json.load(f)['pulled']
+        # offline mode serves whatever is cached, however old
+        if self.ttl is not None and not self.offline and time.time() - pulled > self.ttl:
+            return None
+        df = pd.read_parquet(data)
+        # the modification time of the data file is the last use, for the LRU eviction
+        os.utime(data)
+        return df
+
+    def _store(self, key, df, sql, params):
+        data, meta = self._paths(key)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # write to temporary files first so a crash never leaves a half-written entry
+        tmp = self.cache_dir / f'{key}.{os.getpid()}.tmp'
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, data)
+        with open(tmp, 'w') as f:
+            json.dump({'sql': sql, 'params': params, 'pulled': time.time(), 'rows': len(df)},
+                      f, default=str)
+        os.replace(tmp, meta)
+
+    def evict(self):
+        '''
+        This function deletes the least recently used results until the
+        cache fits in max_gb.
+        '''
+        if self.max_bytes is None or not self.cache_dir.exists():
+            return
+        entries = []
+        for data in self.cache_dir.glob('*.parquet'):
+            try:
+                stat = data.stat()
+                size = stat.st_size + data.with_suffix('.json').stat().st_size
+            except FileNotFoundError:  # evicted by another worker
+                continue
+            entries.append((stat.st_mtime, size, data))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, data in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for path in (data, data.with_suffix('.json')):
+                path.unlink(missing_ok=True)
+            total -= size
+
+    def raw_sql(self, sql, params=None, **kwargs):
+        '''
+        This function returns the result of the query from the cache, or
+        runs it on WRDS and caches it. Results that pyarrow cannot store
+        (columns of mixed Python types) are returned without being cached.
+        '''
+        key = cache_key(sql, params, **kwargs)
+        df = self._lookup(key)
+        if df is not None:
+            return df
+        if self.offline:
+            raise CacheMissError(f'query not in the cache at {self.cache_dir} (offline mode):\n{sql}')
+
+        df = self.db.raw_sql(sql, params=params, **kwargs)
+        try:
+            self._store(key, df, sql, params)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+            print(f'not caching query {key}: {e}')
+            return df
+        self.evict()
+        return df
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+
+
+def connect(wrds_username=WRDS_USERNAME, cache=WRDS_CACHE, offline=WRDS_OFFLINE, backend=WRDS_BACKEND,
+            **kwargs):
+    '''
+    This function opens a connection to the backend, 'wrds' or the local
+    stand-in 'local' (wrds_local.LocalConnection), wrapped in a
+    CachedConnection with cache. In offline mode it does not connect at all.
+    '''
+    if backend not in ('wrds', 'local'):
+        raise ValueError(f"unknown WRDS_BACKEND {backend!r}, expected 'wrds' or 'local'")
+    if offline:
+        return CachedConnection(None, offline=True, **kwargs)
+    if backend == 'local':
+        db = wrds_local.LocalConnection()
+    else:
+        db = wrds.Connection(wrds_username=wrds_username)
+    return CachedConnection(db, **kwargs) if cache else db
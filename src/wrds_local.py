@@ -0,0 +1,112 @@
+'''
+Overview
+-------------
+Local stand-in for the WRDS database, so load_trace.py and load_rating.py
+can run (and be benchmarked or regression-tested) without a WRDS account.
+
+The tables live in WRDS_LOCAL_DIR as one Parquet file per table, named
+after the WRDS table:
+
+    <local_dir>/trace.trace_enhanced.parquet
+               /fisd.fisd_mergedissue.parquet
+               /fisd.fisd_mergedissuer.parquet
+               /fisd.fisd_ratings.parquet
+
+LocalConnection loads them into an in-memory SQLite database and answers
+raw_sql(sql, params=...) like wrds.Connection: the queries of
+trace_query.py and load_rating.py run unchanged, with the psycopg2
+parameter style and the PostgreSQL functions they use translated to
+SQLite. Date columns are stored as 'YYYY-MM-DD' text, so they compare
+like dates, and are returned as datetime.date objects, as from WRDS.
+Set WRDS_BACKEND=local in .env to use it (see wrds_cache.connect).
+'''
+
+import datetime as dt
+import re
+import sqlite3
+from pathlib import Path
+
+import pandas as pd
+
+import config
+
+WRDS_LOCAL_DIR = Path(config.WRDS_LOCAL_DIR)
+
+
+def table_path(schema, table, local_dir=WRDS_LOCAL_DIR):
+    return Path(local_dir) / f'{schema}.{table}.parquet'
+
+
+def save_table(df, schema, table, local_dir=WRDS_LOCAL_DIR):
+    '''
+    This function writes a table for LocalConnection, e.g. seeded data.
+    '''
+    path = table_path(schema, table, local_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    df.to_parquet(path, index=False)
+
+
+def translate_sql(sql, params=None):
+    '''
+    This function translates a query for wrds.Connection to SQLite: tuple
+    parameters are expanded for IN lists, %(name)s becomes :name and
+    EXTRACT(YEAR FROM col) becomes strftime.
+    Output: sql, params
+    '''
+    params = dict(params or {})
+    for name, value in list(params.items()):
+        if isinstance(value, (tuple, list)):
+            names = [f'{name}_{i}' for i in range(len(value))]
+            sql = sql.replace(f'%({name})s', '(' + ', '.join(':' + n for n in names) + ')')
+            params.update(zip(names, value))
+            del params[name]
+    sql = re.sub(r'EXTRACT\(YEAR FROM (\w+)\)', r"CAST(strftime('%Y', \1) AS INTEGER)", sql)
+    return re.sub(r'%\((\w+)\)s', r':\1', sql), params
+
+
+def _is_date_column(col):
+    if pd.api.types.is_datetime64_any_dtype(col):
+        return True
+    values = col.dropna()
+    return len(values) > 0 and values.map(type).eq(dt.date).all()
+
+
+class LocalConnection:
+    '''
+    Stand-in for wrds.Connection serving the tables in local_dir.
+    '''
+    def __init__(self, local_dir=WRDS_LOCAL_DIR):
+        paths = sorted(Path(local_dir).glob('*.*.parquet'))
+        if not paths:
+            raise FileNotFoundError(f'no <schema>.<table>.parquet files in {local_dir}')
+
+        self.con = sqlite3.connect(':memory:')
+        self.tables = {}
+        self.date_columns = set()
+        for path in paths:
+            name = path.name[:-len('.parquet')]
+            df = pd.read_parquet(path)
+            for col in df.columns:
+                if _is_date_column(df[col]):
+                    df[col] = pd.to_datetime(df[col]).dt.strftime('%Y-%m-%d')
+                    self.date_columns.add(col)
+            local_name = name.replace('.', '__')
+            df.to_sql(local_name, self.con, index=False)
+            self.tables[name] = local_name
+
+        if 'trace.trace_enhanced' in self.tables:
+            self.con.execute('CREATE INDEX trace_cusip ON trace__trace_enhanced (cusip_id, trd_exctn_dt)')
+
+    def raw_sql(self, sql, params=None, **kwargs):
+        for name, local_name in self.tables.items():
+            sql = re.sub(rf'\b{re.escape(name)}\b', local_name, sql)
+        sql, params = translate_sql(sql, params)
+        df = pd.read_sql_query(sql, self.con, params=params)
+
+        for col in df.columns:
+            if col in self.date_columns:
+                df[col] = pd.to_datetime(df[col]).dt.date
+        return df
+
+    def close(self):
+        self.con.close()